@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+
+# Benchmark verify.py validators and DictDiffer against synthetic cmds.json
+# pairs.  Runs offline as any user; nothing outside the output file is
+# written.  Compare runs between commits with -b <previous results file>.
+
+import sys
+import os
+import json
+import random
+import getopt
+import platform
+import subprocess
+import statistics
+import tracemalloc
+import importlib.util
+from time import perf_counter, localtime, strftime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FILES_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'files')
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+# Default scale (roughly a busy Kubernetes node)
+SCALE = {
+    'mounts': 10000,
+    'interfaces': 1000,
+    'sockets': 50000,
+    'packages': 5000,
+    'swaps': 4,
+}
+
+# Fraction of entries that differ between the previous and current snapshot
+CHANGE_RATE = 0.02
+
+
+def usage(exit_code=0):
+    """ Display help message if -h option used or invalid syntax. """
+    print(os.path.basename(__file__) + ' [-m <mounts>] [-i <interfaces>]'
+          ' [-s <sockets>] [-p <packages>] [-r <repeat>] [-o <out.json>]'
+          ' [-b <baseline.json>] [-T <pct>] [-w <dir>] [-k <substring>]')
+    print("\t-m\tnumber of mounts (default {0})".format(SCALE['mounts']))
+    print("\t-i\tnumber of interfaces (default {0})".format(
+        SCALE['interfaces']))
+    print("\t-s\tnumber of listening sockets (default {0})".format(
+        SCALE['sockets']))
+    print("\t-p\tnumber of packages (default {0})".format(
+        SCALE['packages']))
+    print("\t-r\ttimed repetitions per benchmark (default 5)")
+    print("\t-o\tresults file (default benchmarks/results/<git rev>.json)")
+    print("\t-b\tbaseline results file to compare against")
+    print("\t-T\tregression threshold in percent for -b (default 20)")
+    print("\t-k\tonly run benchmarks whose name contains substring")
+    print("\t-w\talso write the synthetic snapshots to"
+          " <dir>/prev/cmds.json and <dir>/curr/cmds.json")
+    sys.exit(exit_code)
+
+
+def parse_args(arg_dict):
+    try:
+        opts, _args = getopt.getopt(sys.argv[1:], "hm:i:s:p:r:o:b:T:w:k:",
+                                    ["help"])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-m':
+            arg_dict['scale']['mounts'] = int(arg)
+        elif opt == '-i':
+            arg_dict['scale']['interfaces'] = int(arg)
+        elif opt == '-s':
+            arg_dict['scale']['sockets'] = int(arg)
+        elif opt == '-p':
+            arg_dict['scale']['packages'] = int(arg)
+        elif opt == '-r':
+            arg_dict['repeat'] = int(arg)
+        elif opt == '-o':
+            arg_dict['out_file'] = arg
+        elif opt == '-b':
+            arg_dict['baseline_file'] = arg
+        elif opt == '-T':
+            arg_dict['threshold'] = float(arg)
+        elif opt == '-w':
+            arg_dict['write_dir'] = arg
+        elif opt == '-k':
+            arg_dict['select'] = arg
+        elif opt in ('-h', '--help'):
+            usage(0)
+    return arg_dict
+
+
+def load_verify():
+    """ Import files/verify.py (and common.py) without installing them """
+    sys.path.insert(0, FILES_DIR)
+    spec = importlib.util.spec_from_file_location(
+        'verify', os.path.join(FILES_DIR, 'verify.py'))
+    verify = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(verify)
+    return verify
+
+
+#######################
+# Synthetic snapshots #
+#######################
+
+def gen_mounts(count, rng):
+    """ mount(8) lines: mostly overlay/tmpfs with some local and NFS fs """
+    lines = [
+        '/dev/sda1 on / type ext4 (rw,relatime)',
+        'proc on /proc type proc (rw,nosuid,nodev,noexec,relatime)',
+        'sysfs on /sys type sysfs (rw,nosuid,nodev,noexec,relatime)',
+    ]
+    for n in range(count - len(lines)):
+        kind = n % 10
+        if kind < 5:
+            lines.append(
+                'overlay on /run/containerd/io.containerd.runtime.v2.task/'
+                'k8s.io/{0:064x}/rootfs type overlay (rw,relatime,'
+                'lowerdir=/var/lib/containerd/snapshots/{1}/fs,'
+                'upperdir=/var/lib/containerd/snapshots/{2}/fs)'.format(
+                    rng.getrandbits(256), n, n + 1))
+        elif kind < 8:
+            lines.append(
+                'tmpfs on /var/lib/kubelet/pods/{0:032x}/volumes/'
+                'kubernetes.io~projected/kube-api-access-{1} type tmpfs '
+                '(rw,relatime,size={2}k)'.format(
+                    rng.getrandbits(128), n, rng.randint(1, 999999)))
+        elif kind == 8:
+            lines.append('/dev/mapper/vg{0}-lv{1} on /data/{0}/{1} type '
+                         'xfs (rw,relatime,attr2,inode64)'.format(n // 100, n))
+        else:
+            lines.append('nfs{0}:/export/{1} on /mnt/nfs/{1} type nfs4 '
+                         '(rw,relatime,vers=4.1,hard,proto=tcp)'.format(
+                             n % 7, n))
+    return lines
+
+
+def gen_interfaces(count, rng):
+    """ ifconfig -a stanzas: physical NICs with VLAN sub-interfaces """
+    lines = []
+    for n in range(count):
+        name = 'bond{0}.{1}'.format(n % 4, 100 + n) if n else 'lo'
+        lines.append('{0}: flags=4163<UP,BROADCAST,RUNNING,MULTICAST>  '
+                     'mtu 1500'.format(name))
+        lines.append('        inet 10.{0}.{1}.{2}  netmask 255.255.255.0  '
+                     'broadcast 10.{0}.{1}.255'.format(
+                         n // 65536 % 256, n // 256 % 256, n % 256))
+        lines.append('        ether 02:42:{0:02x}:{1:02x}:{2:02x}:{3:02x}  '
+                     'txqueuelen 1000  (Ethernet)'.format(
+                         *[rng.randint(0, 255) for _i in range(4)]))
+        lines.append('')
+    return lines
+
+
+def gen_sockets(count, rng):
+    """ <proto>\t<address>:<port> listeners as read from /proc/net """
+    lines = []
+    for n in range(count):
+        proto = rng.choice(['tcp', 'tcp6', 'udp'])
+        if proto == 'tcp6':
+            address = '[fd00::{0:x}]'.format(n % 65536)
+        else:
+            address = '10.0.{0}.{1}'.format(n // 256 % 256, n % 256)
+        lines.append('{0}\t{1}:{2}'.format(proto, address, 1 + n % 32000))
+    return lines
+
+
+def gen_packages(count, rng):
+    """ <name>\\t<version>\\t<arch> lines as collected by cmds-save.py """
+    lines = []
+    for n in range(count):
+        arch = 'i386' if n % 97 == 0 else 'amd64'
+        lines.append('pkg{0}\t{1}:{2}.{3}.{4}-{5}\t{6}'.format(
+            n, n % 3, rng.randint(0, 9), rng.randint(0, 99),
+            rng.randint(0, 999), rng.randint(1, 9), arch))
+    return lines
+
+
+def gen_swaps(count, rng):
+    lines = ['Filename\t\t\t\tType\t\tSize\t\tUsed\t\tPriority']
+    for n in range(count):
+        lines.append('/dev/dm-{0}\tpartition\t{1}\t0\t-{2}'.format(
+            n, rng.randint(1, 64) * 1048576, n + 2))
+    return lines
+
+
+def mutate(lines, rng, rate=CHANGE_RATE, keep=1):
+    """ Drop, duplicate and edit a fraction of the lines after the header """
+    header, body = lines[:keep], list(lines[keep:])
+    for _n in range(int(len(body) * rate)):
+        i = rng.randrange(len(body))
+        action = rng.randrange(3)
+        if action == 0:
+            del body[i]
+        elif action == 1:
+            body.append(body[i].replace('0', '1', 1))
+        else:
+            body[i] = body[i].replace('1', '2', 1)
+    return header + body
+
+
+def gen_snapshots(scale, seed=0):
+    """ Return (prev, curr) cmds.json dictionaries without parsed sections """
+    rng = random.Random(seed)
+    sections = {
+        'mount': (gen_mounts(scale['mounts'], rng), 0),
+        'ifconfig -a': (gen_interfaces(scale['interfaces'], rng), 0),
+        'sockets': (gen_sockets(scale['sockets'], rng), 0),
+        'packages': (gen_packages(scale['packages'], rng), 0),
+        'cat /proc/swaps': (gen_swaps(scale['swaps'], rng), 1),
+    }
+    prev, curr = {}, {}
+    for key, (lines, keep) in sections.items():
+        prev[key] = {'stdout': '\n'.join(lines), 'stderr': '', 'rc': 0}
+        curr[key] = {'stdout': '\n'.join(mutate(lines, rng, keep=keep)),
+                     'stderr': '', 'rc': 0}
+    return prev, curr
+
+
+def gen_mountinfo(verify, stdout):
+    """ [id, parent id, mountpoint, type] as saved by get_mount_native """
+    mountinfo = []
+    tops = {}
+    for n, m in enumerate(verify.get_mount_list({'stdout': stdout}), 1):
+        parent = 0
+        for path in verify.get_path_prefixes(m['mp']):
+            if path in tops:
+                parent = tops[path]
+                break
+        mountinfo.append([n, parent, m['mp'], m['type']])
+        tops[m['mp']] = n
+    return mountinfo
+
+
+def add_parsed(verify, cmds_dict):
+    """ Add parsed sections and digests the way cmds-save.py does """
+    cmds_dict['mount']['mountinfo'] = gen_mountinfo(
+        verify, cmds_dict['mount']['stdout'])
+    for key, section in cmds_dict.items():
+        parsed = verify.parse_section(key, section)
+        if parsed is not None:
+            section['parsed'] = parsed
+        verify.set_section_digests(section)
+    return cmds_dict
+
+
+##############
+# Benchmarks #
+##############
+
+def get_benchmarks(verify, prev, curr):
+    """ name -> callable.  Validators run on raw and pre-parsed snapshots
+    and on an unchanged pre-parsed snapshot (identical section digests) """
+    prev_parsed = add_parsed(verify, json.loads(json.dumps(prev)))
+    curr_parsed = add_parsed(verify, json.loads(json.dumps(curr)))
+    same_parsed = json.loads(json.dumps(prev_parsed))
+    packages_prev = prev_parsed['packages']['parsed']
+    packages_curr = curr_parsed['packages']['parsed']
+
+    def diff(current, past):
+        d = verify.DictDiffer(current, past)
+        return d.added(), d.removed(), d.changed(), d.unchanged()
+
+    benchmarks = {}
+    for func in ('validate_ifconfig', 'validate_fs_mounts',
+                 'validate_paging_space', 'validate_packages',
+                 'validate_listeners'):
+        validator = getattr(verify, func)
+        benchmarks[func + '[raw]'] = (validator, prev, curr)
+        benchmarks[func + '[parsed]'] = (validator, prev_parsed,
+                                         curr_parsed)
+        benchmarks[func + '[unchanged]'] = (validator, prev_parsed,
+                                            same_parsed)
+    benchmarks['DictDiffer[packages]'] = (diff, packages_curr,
+                                          packages_prev)
+    benchmarks['diff_sections[mount]'] = (verify.diff_sections, curr_parsed,
+                                          prev_parsed, 'mount')
+    return benchmarks
+
+
+def run_benchmark(func, args, repeat):
+    """ Best and median wall time over repeat runs, then peak memory """
+    times = []
+    for _n in range(repeat):
+        start = perf_counter()
+        func(*args)
+        times.append(perf_counter() - start)
+    tracemalloc.start()
+    func(*args)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'secs_min': round(min(times), 6),
+        'secs_median': round(statistics.median(times), 6),
+        'peak_kb': round(peak / 1024.0, 1),
+    }
+
+
+def get_git_rev():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, baseline, threshold):
+    """ Print the change against a baseline; return regressed names """
+    regressions = []
+    print('{0:32} {1:>12} {2:>12} {3:>8}'.format(
+        'benchmark', 'baseline', 'current', 'change'))
+    for name, result in sorted(results['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None or not base['secs_min']:
+            print('{0:32} {1:>12} {2:>12.6f}'.format(
+                name, '-', result['secs_min']))
+            continue
+        pct = (result['secs_min'] / base['secs_min'] - 1) * 100
+        flag = ''
+        if pct > threshold:
+            flag = ' REGRESSION'
+            regressions.append(name)
+        print('{0:32} {1:>12.6f} {2:>12.6f} {3:>+7.1f}%{4}'.format(
+            name, base['secs_min'], result['secs_min'], pct, flag))
+    return regressions
+
+
+def main():
+    arg_dict = parse_args({'scale': dict(SCALE), 'repeat': 5,
+                           'threshold': 20.0})
+    verify = load_verify()
+
+    prev, curr = gen_snapshots(arg_dict['scale'])
+    if 'write_dir' in arg_dict:
+        for name, cmds_dict in (('prev', prev), ('curr', curr)):
+            out_dir = os.path.join(arg_dict['write_dir'], name)
+            os.makedirs(out_dir, exist_ok=True)
+            verify.save_dict_to_file(
+                add_parsed(verify, json.loads(json.dumps(cmds_dict))),
+                os.path.join(out_dir, 'cmds.json'))
+
+    results = {
+        'time': strftime('%Y-%m-%d %H:%M:%S', localtime()),
+        'git_rev': get_git_rev(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'scale': arg_dict['scale'],
+        'repeat': arg_dict['repeat'],
+        'results': {},
+    }
+    for name, bench in sorted(get_benchmarks(verify, prev, curr).items()):
+        if arg_dict.get('select', '') not in name:
+            continue
+        results['results'][name] = run_benchmark(bench[0], bench[1:],
+                                                 arg_dict['repeat'])
+        print('{0:32} min {1[secs_min]:.6f}s  median {1[secs_median]:.6f}s'
+              '  peak {1[peak_kb]:.1f} KiB'.format(
+                  name, results['results'][name]))
+
+    out_file = arg_dict.get('out_file', os.path.join(
+        RESULTS_DIR, '{0}.json'.format(results['git_rev'])))
+    os.makedirs(os.path.dirname(os.path.abspath(out_file)), exist_ok=True)
+    with open(out_file, 'w') as fh:
+        json.dump(results, fh, indent=4, sort_keys=True)
+    print('results saved to {0}'.format(out_file))
+
+    if 'baseline_file' in arg_dict:
+        with open(arg_dict['baseline_file']) as fh:
+            baseline = json.load(fh)
+        if baseline.get('scale') != results['scale']:
+            print('warning: baseline scale differs: {0}'.format(
+                baseline.get('scale')))
+        if compare(results, baseline, arg_dict['threshold']):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,31 +8,105 @@ DATE_STAMP=`date +"%Y-%m-%d_%H%M"`
 BASEDIR=$(dirname "$0")
 cd $BASEDIR
 
+# timed <phase> <name> <command> [args]: run command and record its wall time, CPU time and peak RSS in timings.jsonl
+timed() {
+  phase=$1; name=$2; shift 2
+  if [[ -e ./timed.py ]] && command -v python3 >/dev/null 2>&1; then
+    python3 ./timed.py -p "$phase" -n "$name" -- "$@"
+  else
+    "$@"
+  fi
+}
+
+# conf_get <section> <key>: value from auto-patch.conf
+conf_get() {
+  awk -F= -v s="[$1]" -v k="$2" '$0 == s {f=1; next} /^\[/ {f=0} f && $1 ~ "^ *"k" *$" {gsub(/[ "\047]/, "", $2); print $2; exit}' ./auto-patch.conf 2>/dev/null
+}
+
+# prefetch_fresh: true if prefetch is enabled and prefetch.sh downloaded updates within max_age_hours
+PREFETCH_STAMP=/var/log/auto-patch/prefetch.stamp
+prefetch_fresh() {
+  [[ "$(conf_get prefetch enabled)" == "true" && -s $PREFETCH_STAMP ]] || return 1
+  max_age=$(conf_get prefetch max_age_hours)
+  [[ $(( $(date +%s) - $(cat $PREFETCH_STAMP) )) -lt $(( ${max_age:-24} * 3600 )) ]]
+}
+
+# Written by the update (or the RHEL reboot detection), removed by the reboot.  A run skips the noop shortcut
+# while it exists, so a reboot postponed by the reboot gate asks the gate again on the next run.
+REBOOT_REQUIRED_FILE=/var/run/reboot-required
+
+# record_noop: record a run skipped because no updates were pending (current/ still points to the last patch run)
+NOOP_FILE=/var/log/auto-patch/noop.json
+record_noop() {
+  echo "auto-patch: no pending updates, skipping snapshot, updates and hooks (`date`)"
+  mkdir -p /var/log/auto-patch
+  printf '{"time": %s, "result": "noop", "pending": 0, "current": "%s"}\n' "$(date +%s)" "$(readlink /var/log/auto-patch/current)" >$NOOP_FILE.tmp && mv -f $NOOP_FILE.tmp $NOOP_FILE
+  if [[ -e ./post_update.d/90-export-metrics.py ]]; then
+    python3 ./post_update.d/90-export-metrics.py
+  fi
+}
+
+# pending_updates: number of packages apt-get upgrade would install (nothing if the check fails)
+pending_updates() {
+  out=$(/usr/bin/apt-get -s -q upgrade 2>/dev/null) || return 1
+  echo "$out" | grep -c '^Inst '
+}
+
+# Skip the run when no updates are pending (package lists are refreshed here unless prefetch.sh just did it)
+UPDATED=0
+if [[ "$(conf_get run skip_noop)" != "false" ]]; then
+  if ! prefetch_fresh; then
+    /usr/bin/apt-get -q update >/dev/null 2>&1 && UPDATED=1
+  fi
+  PENDING=$(pending_updates)
+  if [[ "$PENDING" == "0" && -e $REBOOT_REQUIRED_FILE ]]; then
+    echo "auto-patch: no pending updates but a reboot is still required (postponed by the reboot gate), running hooks"
+  elif [[ "$PENDING" == "0" ]]; then
+    record_noop
+    exit 0
+  fi
+fi
+
+# Run directory for this run's snapshot, report and timings (cmds-save.py uses it instead of creating its own)
+export AUTO_PATCH_RUN_DIR=/var/log/auto-patch/`date +"%Y-%m-%d_%H%M%S"`
+mkdir -p $AUTO_PATCH_RUN_DIR
+
 if [[ -e ./pre_update.sh ]]; then
-  ./pre_update.sh
+  timed auto-patch pre_update.sh ./pre_update.sh
 fi
 
 echo "auto-patch:" >/var/log/auto-patch/auto-patch-update.${DATE_STAMP} 2>&1
 ln -sf /var/log/auto-patch/auto-patch-update.${DATE_STAMP} /var/log/auto-patch/auto-patch-update.latest
 
-/usr/bin/apt-get update
-/usr/bin/apt-get -q=2 upgrade >>/var/log/auto-patch/auto-patch-update.${DATE_STAMP} 2>&1
+# Install from the package cache when updates were prefetched, otherwise (or if the cache is incomplete) download them now
+CACHED=1
+if prefetch_fresh; then
+  echo "installing prefetched updates from the package cache" >>/var/log/auto-patch/auto-patch-update.${DATE_STAMP} 2>&1
+  timed auto-patch "apt-get upgrade (cached)" /usr/bin/apt-get -q=2 --no-download upgrade >>/var/log/auto-patch/auto-patch-update.${DATE_STAMP} 2>&1 && CACHED=0
+fi
+if [[ $CACHED -ne 0 ]]; then
+  if [[ $UPDATED -eq 0 ]]; then
+    timed auto-patch "apt-get update" /usr/bin/apt-get update
+  fi
+  timed auto-patch "apt-get upgrade" /usr/bin/apt-get -q=2 upgrade >>/var/log/auto-patch/auto-patch-update.${DATE_STAMP} 2>&1
+fi
+rm -f $PREFETCH_STAMP
 
 if [[ -e /usr/bin/snap ]]; then
   echo "" >> /var/log/auto-patch-update.out
   echo "snap refresh:" >> /var/log/auto-patch-update.out
-  snap refresh >>/var/log/auto-patch-update.out 2>&1
+  timed auto-patch "snap refresh" snap refresh >>/var/log/auto-patch-update.out 2>&1
 fi
 
 if [[ -e /usr/bin/flatpak ]]; then
   echo "" >> /var/log/auto-patch-update.out
   echo "flatpak update -y:" >> /var/log/auto-patch-update.out
-  flatpak update -y >>/var/log/auto-patch-update.out 2>&1
+  timed auto-patch "flatpak update" flatpak update -y >>/var/log/auto-patch-update.out 2>&1
 fi
 
 
 if [[ -e ./post_update.sh ]]; then
-  ./post_update.sh
+  timed auto-patch post_update.sh ./post_update.sh
 fi
 
 exit 0
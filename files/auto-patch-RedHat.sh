@@ -8,16 +8,94 @@
 BASEDIR=$(dirname "$0")
 cd $BASEDIR
 
+# timed <phase> <name> <command> [args]: run command and record its wall time, CPU time and peak RSS in timings.jsonl
+timed() {
+  phase=$1; name=$2; shift 2
+  if [[ -e ./timed.py ]] && command -v python3 >/dev/null 2>&1; then
+    python3 ./timed.py -p "$phase" -n "$name" -- "$@"
+  else
+    "$@"
+  fi
+}
+
+# conf_get <section> <key>: value from auto-patch.conf
+conf_get() {
+  awk -F= -v s="[$1]" -v k="$2" '$0 == s {f=1; next} /^\[/ {f=0} f && $1 ~ "^ *"k" *$" {gsub(/[ "\047]/, "", $2); print $2; exit}' ./auto-patch.conf 2>/dev/null
+}
+
+# prefetch_fresh: true if prefetch is enabled and prefetch.sh downloaded updates within max_age_hours
+PREFETCH_STAMP=/var/log/auto-patch/prefetch.stamp
+prefetch_fresh() {
+  [[ "$(conf_get prefetch enabled)" == "true" && -s $PREFETCH_STAMP ]] || return 1
+  max_age=$(conf_get prefetch max_age_hours)
+  [[ $(( $(date +%s) - $(cat $PREFETCH_STAMP) )) -lt $(( ${max_age:-24} * 3600 )) ]]
+}
+
+# Written by the update (or the RHEL reboot detection), removed by the reboot.  A run skips the noop shortcut
+# while it exists, so a reboot postponed by the reboot gate asks the gate again on the next run.
+REBOOT_REQUIRED_FILE=/var/run/reboot-required
+
+# record_noop: record a run skipped because no updates were pending (current/ still points to the last patch run)
+NOOP_FILE=/var/log/auto-patch/noop.json
+record_noop() {
+  echo "auto-patch: no pending updates, skipping snapshot, updates and hooks (`date`)"
+  mkdir -p /var/log/auto-patch
+  printf '{"time": %s, "result": "noop", "pending": 0, "current": "%s"}\n' "$(date +%s)" "$(readlink /var/log/auto-patch/current)" >$NOOP_FILE.tmp && mv -f $NOOP_FILE.tmp $NOOP_FILE
+  if [[ -e ./post_update.d/90-export-metrics.py ]]; then
+    python3 ./post_update.d/90-export-metrics.py
+  fi
+}
+
+# pending_updates [yum options]: number of packages yum update would install (nothing if the check fails)
+pending_updates() {
+  out=$(/usr/bin/yum "$@" -q check-update 2>/dev/null)
+  rc=$?
+  if [[ $rc -eq 0 ]]; then
+    echo 0
+  elif [[ $rc -eq 100 ]]; then
+    echo "$out" | awk '/^Obsoleting/ {exit} NF == 3 {n++} END {print (n > 0 ? n : 1)}'
+  else
+    return 1
+  fi
+}
+
+# Skip the run when no updates are pending (from the metadata cache if prefetch.sh just refreshed it)
+if [[ "$(conf_get run skip_noop)" != "false" ]]; then
+  if prefetch_fresh; then
+    PENDING=$(pending_updates -C)
+  else
+    PENDING=$(pending_updates)
+  fi
+  if [[ "$PENDING" == "0" && -e $REBOOT_REQUIRED_FILE ]]; then
+    echo "auto-patch: no pending updates but a reboot is still required (postponed by the reboot gate), running hooks"
+  elif [[ "$PENDING" == "0" ]]; then
+    record_noop
+    exit 0
+  fi
+fi
+
+# Run directory for this run's snapshot, report and timings (cmds-save.py uses it instead of creating its own)
+export AUTO_PATCH_RUN_DIR=/var/log/auto-patch/`date +"%Y-%m-%d_%H%M%S"`
+mkdir -p $AUTO_PATCH_RUN_DIR
+
 if [[ -e ./pre_update.sh ]]; then
-  ./pre_update.sh
+  timed auto-patch pre_update.sh ./pre_update.sh
 fi
 
-/usr/bin/yum -y -e 0 update >/var/log/auto-patch/current/auto-patch-update.out 2>&1
+# Install from the package cache when updates were prefetched, otherwise (or if the cache is incomplete) download them now
+CACHED=1
+if prefetch_fresh; then
+  timed auto-patch "yum update (cached)" /usr/bin/yum -C -y -e 0 update >/var/log/auto-patch/current/auto-patch-update.out 2>&1 && CACHED=0
+fi
+if [[ $CACHED -ne 0 ]]; then
+  timed auto-patch "yum update" /usr/bin/yum -y -e 0 update >>/var/log/auto-patch/current/auto-patch-update.out 2>&1
+fi
+rm -f $PREFETCH_STAMP
 # /usr/bin/yum -y -e 0 update >/var/log/auto-patch/auto-patch-update.${DATE_STAMP} 2>&1
 # ln -sf /var/log/auto-patch/auto-patch-update.${DATE_STAMP} /var/log/auto-patch/auto-patch-update.latest
 
 if [[ -e ./post_update.sh ]]; then
-  ./post_update.sh
+  timed auto-patch post_update.sh ./post_update.sh
 fi
 
 exit 0
\ No newline at end of file
@@ -1,8 +1,15 @@
 #!/bin/sh
 
-MAX=14
+# Number of previous run directories to keep (keep_runs in auto-patch.conf, default 14).
+# The current run directory (AUTO_PATCH_RUN_DIR, already created when this hook runs) is not counted or removed.
+CONF="$(dirname "$0")/../auto-patch.conf"
+MAX=$(sed -n 's/^keep_runs *= *\([0-9][0-9]*\).*/\1/p' "$CONF" 2>/dev/null)
+MAX=${MAX:-14}
 COUNT=0
-for cmds_dir in `ls -d /var/log/auto-patch/20[2-9][0-9]-[0-1][1-2]-[0-3][0-9]_* 2>/dev/null | sort -r`; do
+for cmds_dir in `ls -d /var/log/auto-patch/20[2-9][0-9]-[0-1][0-9]-[0-3][0-9]_* 2>/dev/null | sort -r`; do
+  if [ "$cmds_dir" = "${AUTO_PATCH_RUN_DIR%/}" ]; then
+    continue
+  fi
   COUNT=$((COUNT+1))
   if [ $COUNT -gt $MAX ]; then
     rm -rf $cmds_dir
@@ -9,6 +9,8 @@ from time import time, localtime, strftime
 import getopt
 
 from common import *
+from history import update_history
+from metrics import export_metrics
 
 ####################
 # Global variables #
@@ -21,16 +23,21 @@ cmds_dict = dict()
 # Help message
 def usage(exit_code=0):
     """ Display help message if -h option used or invalid syntax. """
-    print(os.path.basename(__file__) + ' [-o <save_file.json>] [-v ] [-l <log_file>]')
+    print(os.path.basename(__file__) + ' [-o <save_file.json>] [-f <format>] [-j <workers>] [-t <deadline>] [-c <config_file>] [-v ] [-l <log_file>]')
     print("\t-l\tlog file for commands (default /var/log/auto-patch/current/cmds.log)")
-    print("\t-o\tJSON file to save command output to (default /var/log/auto-patch/current/cmds.json)")
+    print("\t-o\tJSON file to save command output to (default /var/log/auto-patch/current/cmds.json[.gz|.zst])")
+    print("\t-f\tsnapshot format: {0} (default from config file or json)".format(', '.join(SNAPSHOT_FORMATS)))
+    print("\t\tstore saves deduplicated sections in the store_dir set in the config file and writes a manifest to cmds.json")
+    print("\t-j\tnumber of commands to collect concurrently (default {0})".format(COLLECT_WORKERS))
+    print("\t-t\tdeadline in seconds for collecting all commands, 0 to disable (default {0})".format(COLLECT_DEADLINE))
+    print("\t-c\tconfiguration file (default {0})".format(CONFIG_FILE))
     print("\t-v\tverbose output")
     sys.exit(exit_code)
 
 def parse_args(arg_dict):
     # Parse CLI input #
     try:
-        opts, _args = getopt.getopt(sys.argv[1:], "hvl:o:", ["help"])
+        opts, _args = getopt.getopt(sys.argv[1:], "hvl:o:f:j:t:c:", ["help"])
     except getopt.GetoptError as err:
         logging.error(err)
         sys.exit(2)
@@ -41,55 +48,20 @@ def parse_args(arg_dict):
             arg_dict['log_file'] = arg
         elif opt == '-o':
             arg_dict['save_file'] = arg
+        elif opt == '-f':
+            arg_dict['format'] = arg
+        elif opt == '-c':
+            arg_dict['config_file'] = arg
+        elif opt == '-j':
+            arg_dict['workers'] = int(arg)
+        elif opt == '-t':
+            arg_dict['deadline'] = int(arg)
         elif opt == '-h':
             arg_dict['usage'] = True
         elif opt == '--help':
             arg_dict['usage'] = True
     return arg_dict
 
-def save_cmd_to_dict(cmd, timeout=None, key=None):
-    rc, stdout, stderr = get_cmd3(cmd, timeout=timeout)
-    if key == None:
-        key = cmd
-    cmds_dict[key] = {}
-    if key != cmd:
-        cmds_dict[key]['cmd'] = cmd
-    cmds_dict[key]['stdout'] = stdout
-    cmds_dict[key]['stderr'] = stderr
-    cmds_dict[key]['rc'] = rc
-
-def collect_cmds():
-    save_cmd_to_dict("date +\"%Y-%m-%d %H:%M:%S\"")
-    save_cmd_to_dict("date +\"%s\"")
-    save_cmd_to_dict('uname')
-    # save_cmd_to_dict("echo \$TZ")
-    save_cmd_to_dict('uptime')
-    save_cmd_to_dict('netstat -rn')
-    save_cmd_to_dict('/sbin/ifconfig -a', key='ifconfig -a')
-    save_cmd_to_dict('cat /proc/swaps')
-    save_cmd_to_dict('df -k', timeout=15)
-    save_cmd_to_dict('mount')
-    save_cmd_to_dict('cat /etc/resolv.conf')
-    # save_cmd_to_dict('ntpq -pn')
-    if os.path.exists('/usr/bin/dpkg'):
-        save_cmd_to_dict('dpkg --list')
-    if os.path.exists('/usr/bin/rpm'):
-        save_cmd_to_dict("rpm -qa --queryformat=\"%{NAME}:%{VERSION}\\n\"", key='rpm_custom')
-    save_cmd_to_dict('netstat -an')
-    save_cmd_to_dict("ps -www -eo \"pmem pcpu time vsz rss user pid args\"", key='ps_custom')
-    save_cmd_to_dict('cat /etc/ssh/sshd_config')
-
-def save_cmd_dict_to_file(cmd_out_file):
-
-    output_text = json.dumps(cmds_dict, indent=4)
-
-    # write output to specified file
-    fh = open(cmd_out_file, "w")
-    fh.write(output_text)
-    fh.close()
-    os.chmod(cmd_out_file, 0o600)
-
-
 if __name__ == '__main__':
 
     # default configuration options
@@ -110,7 +82,17 @@ if __name__ == '__main__':
     else:
         setup_logging(log_file=None, log_file_level='info', log_print_level='warn')
 
+    # configuration file settings apply unless overridden by CLI
+    config = get_config(arg_dict.get('config_file'))
+    arg_dict.setdefault('format', config['snapshot']['format'])
+    arg_dict.setdefault('workers', int(config['snapshot']['workers']))
+    arg_dict.setdefault('deadline', int(config['snapshot']['deadline']))
+    arg_dict['format'] = resolve_snapshot_format(arg_dict['format'])
+
+    # garbage collect the snapshot store and update the history index only for the default data directory layout
+    default_layout = False
     if 'save_file' not in arg_dict:
+        default_layout = True
 
         # Create data directory if it doesn't exist
         if not os.path.exists(arg_dict['data_dir']):
@@ -124,14 +106,41 @@ if __name__ == '__main__':
             os.remove("current")
 
         # Create directory with date-stamp and symlink current to new directory
-        datetime = strftime("%Y-%m-%d_%H%M%S", localtime())
+        # (auto-patch.sh creates the run directory first and exports it so its timings are saved in the same place)
+        run_dir = os.environ.get(RUN_DIR_ENV, '')
+        if os.path.dirname(os.path.abspath(run_dir)) == os.path.abspath(arg_dict['data_dir']):
+            datetime = os.path.basename(run_dir)
+        else:
+            datetime = strftime("%Y-%m-%d_%H%M%S", localtime())
         # date_dir = os.path.join(arg_dict['data_dir'], datetime)
         date_dir = datetime
-        os.makedirs(date_dir)
+        if not os.path.isdir(date_dir):
+            os.makedirs(date_dir)
         ln_src = os.path.join(arg_dict['data_dir'], "current")
         os.symlink(datetime, ln_src)
-        arg_dict['save_file'] = os.path.join(arg_dict['data_dir'], 'current', 'cmds.json')
+        arg_dict['save_file'] = get_snapshot_file(os.path.join(arg_dict['data_dir'], 'current', 'cmds.json'), arg_dict['format'])
+
+    # Sections whose inputs are unchanged (package database, config files) are reused from the section cache
+    cache = get_section_cache(config)
+    # Output over the capture limit is kept in spill/collect/<section>.out next to the snapshot
+    capture = get_capture_settings(config, os.path.join(os.path.dirname(os.path.realpath(arg_dict['save_file'])), 'spill', 'collect'))
+    collect_cmds(cmds_dict, workers=arg_dict['workers'], deadline=arg_dict['deadline'], cache=cache, capture=capture)
+    if cache is not None:
+        cache.evict()
+
+    save_snapshot(cmds_dict, arg_dict['save_file'], fmt=arg_dict['format'], store_dir=config['snapshot']['store_dir'])
+
+    # Per-command wall time, CPU time and peak RSS are appended to the timings file next to the snapshot
+    append_timings(get_cmd_timings(cmds_dict, 'collect'), os.path.join(os.path.dirname(arg_dict['save_file']), TIMINGS_FILE))
+
+    # Remove store blobs no longer referenced by a run directory (cmds-cleanup.sh removes old run directories)
+    if arg_dict['format'] == 'store' and default_layout:
+        gc_store(arg_dict['data_dir'], config['snapshot']['store_dir'], grace_secs=int(config['snapshot']['store_grace']))
 
-    collect_cmds()
+    # Record run metadata and section hashes in the history database
+    if default_layout and config_bool(config['history']['enabled']):
+        update_history(config['history']['db_file'], snapshot_file=arg_dict['save_file'], cmds_dict=cmds_dict)
 
-    save_cmd_dict_to_file(arg_dict['save_file'])
+    # Export run metrics for node_exporter's textfile collector (disabled unless textfile_dir is set)
+    if default_layout:
+        export_metrics(config['metrics']['textfile_dir'], os.path.dirname(os.path.realpath(arg_dict['save_file'])), cache=cache)
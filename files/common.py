@@ -7,6 +7,163 @@ import subprocess
 import json
 import re
 import inspect
+import signal
+import pwd
+import io
+import gzip
+import tempfile
+import glob
+import importlib.util
+import hashlib
+import selectors
+import socket
+from collections.abc import Mapping
+from functools import partial
+from time import time, monotonic
+try:
+    from time import thread_time
+except ImportError:  # Python < 3.7
+    from time import process_time as thread_time
+from concurrent.futures import ThreadPoolExecutor
+
+# zstd compression for snapshots is optional (gzip is always available)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Defaults for collect_cmds(): number of worker threads and overall deadline in seconds (0 = no deadline)
+COLLECT_WORKERS = 8
+COLLECT_DEADLINE = 300
+
+# Streaming capture for collected commands: at most CAPTURE_MAX_BYTES of stdout is kept in memory (the full output is
+# spilled to a file when a spill directory is given) and debug logs only get LOG_EXCERPT_BYTES of each stream
+CAPTURE_MAX_BYTES = 8 * 1024 * 1024
+CAPTURE_MAX_STDERR_BYTES = 64 * 1024
+CAPTURE_CHUNK_BYTES = 64 * 1024
+LOG_EXCERPT_BYTES = 4096
+
+# Cached sections are re-collected after CACHE_MAX_AGE seconds even if their fingerprint still matches (0 disables the cache)
+CACHE_MAX_AGE = 86400
+CACHE_VERSION = 2
+
+# Default number of validators run concurrently by run_validators()
+VALIDATOR_WORKERS = 4
+
+# Configuration file is in script_dir (common.py is copied to script_dir and to the *.d directories below it)
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'auto-patch.conf')
+if not os.path.exists(CONFIG_FILE):
+    CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'auto-patch.conf')
+CONFIG_DEFAULTS = {
+    'snapshot': {
+        'format': 'json',
+        'store_dir': '/var/log/auto-patch/store',
+        'store_grace': '3600',
+        'workers': str(COLLECT_WORKERS),
+        'deadline': str(COLLECT_DEADLINE),
+        'cache_dir': '/var/log/auto-patch/cache',
+        'cache_max_age': str(CACHE_MAX_AGE),
+        'capture_max_bytes': str(CAPTURE_MAX_BYTES),
+        'capture_max_lines': '0',
+    },
+    'report': {
+        'format': 'json',
+    },
+    'validators': {
+        'disable': '',
+        'workers': str(VALIDATOR_WORKERS),
+    },
+    'history': {
+        'enabled': 'true',
+        'db_file': '/var/log/auto-patch/history.db',
+    },
+    'metrics': {
+        'textfile_dir': '',
+    },
+    'hooks': {
+        'timeout': '0',
+        'workers': '8',
+    },
+    'hook_timeouts': {},
+    'verify': {
+        'wait': 'false',
+        'wait_deadline': '300',
+        'wait_interval': '2',
+        'wait_max_interval': '30',
+    },
+    'restart': {
+        'enabled': 'false',
+        'workers': '8',
+        'exclude': 'dbus.service,dbus-broker.service,systemd-logind.service',
+        'restart_pkgs': 'libssl*,openssl',
+        'timeout': '120',
+    },
+    'reboot_gate': {
+        'enabled': 'false',
+        'backend': 'dir',
+        'group': 'default',
+        'max_concurrent': '1',
+        'lease_secs': '3600',
+        'wait_secs': '1200',
+        'poll_interval': '30',
+        'lock_dir': '',
+        'url': 'http://127.0.0.1:8765',
+        'holder': '',
+    },
+    'quiesce': {
+        'interfaces': '',
+        'max_pps': '10',
+        'window_secs': '5',
+        'min_quiet_secs': '5',
+        'max_wait_secs': '1200',
+        'interval': '1',
+    },
+}
+
+# Snapshot formats: json (indented), compact (no whitespace), gzip and zstd (compact + compressed),
+# store (cmds.json is a small manifest of section hashes, sections are deduplicated blobs in STORE_DIR)
+SNAPSHOT_FORMATS = ('json', 'compact', 'gzip', 'zstd', 'store')
+SNAPSHOT_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+MAGIC_GZIP = b'\x1f\x8b'
+MAGIC_ZSTD = b'\x28\xb5\x2f\xfd'
+
+# Package databases (dpkg status is read directly, rpm is queried once with a tab separated format)
+DPKG_STATUS = '/var/lib/dpkg/status'
+RPM_QUERY = "rpm -qa --queryformat=\"%{NAME}\\t%|EPOCH?{%{EPOCH}:}:{}|%{VERSION}-%{RELEASE}\\t%{ARCH}\\n\""
+# Socket tables read by get_sockets_native() (replaces netstat -an, only listeners and per-state counts are kept)
+PROC_NET_INET = ('tcp', 'tcp6', 'udp', 'udp6')
+TCP_STATES = {
+    '01': 'ESTABLISHED', '02': 'SYN_SENT', '03': 'SYN_RECV', '04': 'FIN_WAIT1', '05': 'FIN_WAIT2', '06': 'TIME_WAIT',
+    '07': 'CLOSE', '08': 'CLOSE_WAIT', '09': 'LAST_ACK', '0A': 'LISTEN', '0B': 'CLOSING', '0C': 'NEW_SYN_RECV',
+}
+UNIX_STATES = {'01': 'UNCONNECTED', '02': 'CONNECTING', '03': 'CONNECTED', '04': 'DISCONNECTING'}
+UNIX_ACCEPTCON = 0x10000
+
+# rpm database files (BerkeleyDB or SQLite, /usr/lib/sysimage/rpm on newer distributions) fingerprinted for the section cache
+RPMDB_FILES = ('/var/lib/rpm/Packages', '/var/lib/rpm/rpmdb.sqlite', '/var/lib/rpm/rpmdb.sqlite-wal',
+               '/usr/lib/sysimage/rpm/rpmdb.sqlite', '/usr/lib/sysimage/rpm/rpmdb.sqlite-wal')
+
+# Output parsers keyed by cmds_dict key (see register_parser)
+PARSERS = {}
+
+# Package sections of snapshots saved by earlier versions (dpkg --list output or rpm <name>:<version> lines)
+LEGACY_PACKAGE_KEYS = ['dpkg --list', 'rpm_custom']
+
+# Validators keyed by name in registration order (see register_validator)
+VALIDATORS = {}
+
+# Per-run timings (one JSON record per line) are appended to TIMINGS_FILE in the run directory.
+# auto-patch.sh creates the run directory and exports it as AUTO_PATCH_RUN_DIR for the scripts it runs.
+DATA_DIR = '/var/log/auto-patch'
+RUN_DIR_ENV = 'AUTO_PATCH_RUN_DIR'
+TIMINGS_FILE = 'timings.jsonl'
+
+# auto-patch.sh writes NOOP_FILE in DATA_DIR instead of starting a run when no updates are pending
+NOOP_FILE = 'noop.json'
+# Flag file checked by 99-reboot.sh (Debian/Ubuntu, the RHEL detection script writes it too)
+REBOOT_REQUIRED_FILE = '/var/run/reboot-required'
+# restart-services.py reports the services it restarted instead of rebooting in RESTART_FILE in the run directory
+RESTART_FILE = 'restart.json'
 
 def setup_logging(log_file=None, log_file_level='debug', log_print_level='info'):
 
@@ -40,33 +197,207 @@ def setup_logging(log_file=None, log_file_level='debug', log_print_level='info')
         # add handler to root logger
         logger_root.addHandler(handler_file)
 
-def get_cmd3(cmd, timeout=None, no_log=False):
-    def_name = inspect.currentframe().f_code.co_name
-    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+class RusagePopen(subprocess.Popen):
+    """ Popen that reaps the child with os.wait4() and keeps its resource usage (including reaped descendants) in rusage """
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        try:
+            (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            # SIGCHLD is ignored or the child was already reaped, its status is lost
+            return (self.pid, 0)
+        if pid == self.pid:
+            self.rusage = rusage
+        return (pid, sts)
+
+def get_rusage_stats(rusage):
+    """ CPU seconds (user + system) and peak RSS in KiB from a resource usage struct (None when unknown) """
+    if rusage is None:
+        return {'cpu_secs': None, 'max_rss_kb': None}
+    return {'cpu_secs': round(rusage.ru_utime + rusage.ru_stime, 3), 'max_rss_kb': rusage.ru_maxrss}
+
+def get_excerpt(text, max_len=LOG_EXCERPT_BYTES):
+    """ First max_len characters of text for log messages """
+    if len(text) <= max_len:
+        return text
+    return '{0}... ({1} more characters)'.format(text[:max_len], len(text) - max_len)
+
+class StreamCapture(object):
+    """
+    Bounded capture of one output stream: the first max_bytes (and max_lines if set) are kept in memory, the running
+    sha256 and size cover the whole stream.  Once the limit is passed the full stream is written to spill_file
+    (if set) and the in-memory head is cut back to the last complete line.
+    """
+
+    def __init__(self, max_bytes, max_lines=0, spill_file=None):
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.spill_file = spill_file
+        self.head = bytearray()
+        self.lines = 0
+        self.total = 0
+        self.sha256 = hashlib.sha256()
+        self.truncated = False
+        self.spill_fh = None
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.total += len(data)
+        if self.truncated:
+            if self.spill_fh is not None:
+                self.spill_fh.write(data)
+            return
+        self.head += data
+        self.lines += data.count(b'\n')
+        if len(self.head) > self.max_bytes or (self.max_lines and self.lines > self.max_lines):
+            self.overflow()
+
+    def overflow(self):
+        self.truncated = True
+        if self.spill_file is not None:
+            try:
+                spill_dir = os.path.dirname(self.spill_file)
+                if not os.path.isdir(spill_dir):
+                    os.makedirs(spill_dir, exist_ok=True)
+                self.spill_fh = open(self.spill_file, 'wb')
+                self.spill_fh.write(self.head)
+            except (IOError, OSError) as err:
+                logging.warning('StreamCapture: could not spill to {0}: {1}'.format(self.spill_file, err))
+                self.spill_fh = None
+        cut = self.max_bytes
+        if self.max_lines:
+            pos = -1
+            for _i in range(self.max_lines):
+                pos = self.head.find(b'\n', pos + 1)
+                if pos < 0:
+                    break
+            if 0 <= pos < cut:
+                cut = pos + 1
+        newline = self.head.rfind(b'\n', 0, cut)
+        if newline >= 0:
+            cut = newline + 1
+        del self.head[cut:]
+
+    def close(self):
+        if self.spill_fh is not None:
+            self.spill_fh.close()
+            self.spill_fh = None
+
+    def get_text(self):
+        return self.head.decode('utf-8', 'replace')
+
+    def get_info(self):
+        """ Section fields describing the captured stream """
+        info = {'stdout_bytes': self.total, 'stdout_sha256': self.sha256.hexdigest()}
+        if self.truncated:
+            info['stdout_truncated'] = True
+            if self.spill_file is not None and os.path.exists(self.spill_file):
+                info['stdout_file'] = self.spill_file
+        return info
+
+def read_streams(process, captures, timeout=None):
+    """
+    Read process stdout and stderr incrementally into StreamCapture objects until both reach EOF.
+    On timeout the process group is killed and output is drained for up to 5 more seconds.  Returns True if timed out.
+    """
+    selector = selectors.DefaultSelector()
+    for name in captures:
+        selector.register(getattr(process, name), selectors.EVENT_READ, name)
+    deadline = monotonic() + timeout if timeout is not None else None
+    timed_out = False
     try:
-        # when Popen's shell argument is True, pid is sthe process ID for the spawned shell instead of child process
-        pid = process.pid
-        if no_log:
-            logging.info('{0}: pid={1}, cmd={2}'.format(def_name, pid, "masked due to no_log=True"))
-        else:
-            logging.info('{0}: pid={1}, cmd={2}'.format(def_name, pid, cmd))
-        stdout, stderr = process.communicate(timeout=timeout)
-    except subprocess.TimeoutExpired:
-        process.kill()
-        stdout, stderr = process.communicate()
-        stderr += '\n(timed out after {0} seconds)'.format(timeout)
+        while selector.get_map():
+            remaining = None if deadline is None else deadline - monotonic()
+            if remaining is not None and remaining <= 0:
+                if timed_out:
+                    # a child stuck in uninterruptible sleep (e.g. hung NFS) can hold the pipes open, give up on its output
+                    break
+                timed_out = True
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    process.kill()
+                deadline = monotonic() + 5
+                continue
+            for key, _events in selector.select(remaining):
+                data = os.read(key.fd, CAPTURE_CHUNK_BYTES)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    continue
+                captures[key.data].write(data)
+    finally:
+        selector.close()
+        for name in captures:
+            getattr(process, name).close()
+            captures[name].close()
+    return timed_out
+
+def get_cmd3(cmd, timeout=None, no_log=False, stats=None, capture=None):
+    """
+    Run cmd in a shell and return (rc, stdout, stderr).  If stats is a dict, wall_secs, cpu_secs and max_rss_kb are set in it.
+    With capture (dict with max_bytes, optional max_lines and spill_file) output is streamed with bounded memory and the
+    StreamCapture fields (stdout_bytes, stdout_sha256, stdout_truncated, stdout_file) are set in capture['info'].
+    """
+    def_name = inspect.currentframe().f_code.co_name
+    start = monotonic()
+    # start_new_session puts the shell and its children in their own process group so a timeout kills all of them
+    process = RusagePopen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=capture is None, start_new_session=True)  # noqa: E501
+    # when Popen's shell argument is True, pid is sthe process ID for the spawned shell instead of child process
+    pid = process.pid
+    if no_log:
+        logging.info('{0}: pid={1}, cmd={2}'.format(def_name, pid, "masked due to no_log=True"))
+    else:
+        logging.info('{0}: pid={1}, cmd={2}'.format(def_name, pid, cmd))
+    if capture is not None:
+        captures = {
+            'stdout': StreamCapture(capture['max_bytes'], capture.get('max_lines', 0), capture.get('spill_file')),
+            'stderr': StreamCapture(CAPTURE_MAX_STDERR_BYTES),
+        }
+        timed_out = read_streams(process, captures, timeout=timeout)
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            pass
+        stdout, stderr = captures['stdout'].get_text(), captures['stderr'].get_text()
+        capture['info'] = captures['stdout'].get_info()
+        if captures['stdout'].truncated:
+            logging.warning('{0}: pid={1}, stdout truncated to {2} of {3} bytes{4}'.format(
+                def_name, pid, len(captures['stdout'].head), captures['stdout'].total,
+                ', full output in ' + capture['info']['stdout_file'] if 'stdout_file' in capture['info'] else ''))
+        if timed_out:
+            stderr += '\n(timed out after {0} seconds)'.format(round(timeout, 2))
+    else:
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                process.kill()
+            try:
+                stdout, stderr = process.communicate(timeout=5)
+            except subprocess.TimeoutExpired:
+                # a child stuck in uninterruptible sleep (e.g. hung NFS) can hold the pipes open, give up on its output
+                stdout, stderr = '', ''
+            stderr += '\n(timed out after {0} seconds)'.format(round(timeout, 2))
     retval = process.returncode
+    usage = get_rusage_stats(process.rusage)
+    usage['wall_secs'] = round(monotonic() - start, 3)
+    if stats is not None:
+        stats.update(usage)
 
-    # Logging
+    # Logging (only excerpts of large outputs)
     if retval != 0:
         logging.warn('{0}: pid={1}, rc={2}'.format(def_name, pid, retval))
     else:
         logging.debug('{0}: pid={1}, rc={2}'.format(def_name, pid, retval))
+    logging.debug('{0}: pid={1}, wall_secs={2[wall_secs]}, cpu_secs={2[cpu_secs]}, max_rss_kb={2[max_rss_kb]}'.format(def_name, pid, usage))
     if not no_log:
         if len(stdout) > 0:
-            logging.debug('{0}: pid={1}, stdout={2}'.format(def_name, pid, stdout))
+            logging.debug('{0}: pid={1}, stdout={2}'.format(def_name, pid, get_excerpt(stdout)))
         if len(stderr) > 0:
-            logging.warn('{0}: pid={1}, stderr={2}'.format(def_name, pid, stderr))
+            logging.warn('{0}: pid={1}, stderr={2}'.format(def_name, pid, get_excerpt(stderr)))
     return retval, stdout, stderr
 
 # realtime (no polling, output to stdout/stderr)
@@ -106,19 +437,1061 @@ def run_cmd_poll(cmd):
     retval = process.poll()
     return retval
 
+##########################################################################
+# Native collectors read files and procfs directly instead of forking a #
+# shell.  Each returns (rc, stdout, stderr) like get_cmd3() and produces #
+# the same output format as the command it replaces.                    #
+##########################################################################
+
+def read_file_native(path):
+    """ Read a plain file (replaces cat <path>) """
+    try:
+        with open(path) as fh:
+            return 0, fh.read(), ''
+    except (IOError, OSError) as err:
+        return 1, '', '{0}: {1}'.format(path, err.strerror)
+
+def read_mountinfo(path='/proc/self/mountinfo'):
+    """ Parse mountinfo into a list of dicts in mount order (octal escapes such as \\040 are kept so fields never contain spaces) """
+    mounts = []
+    with open(path) as fh:
+        for line in fh:
+            fields = line.split()
+            if '-' not in fields:
+                continue
+            sep = fields.index('-')
+            mount_opts = fields[5].split(',')
+            super_opts = fields[sep + 3].split(',') if len(fields) > sep + 3 else []
+            # merge per-mount and superblock options the same way mount(8) displays them
+            options = mount_opts + [o for o in super_opts if o not in mount_opts and o not in ('rw', 'ro')]
+            mounts.append({
+                'id': int(fields[0]),
+                'parent': int(fields[1]),
+                'mp': fields[4],
+                'type': fields[sep + 1],
+                'dev': fields[sep + 2],
+                'options': ','.join(options),
+            })
+    return mounts
+
+def get_mount_native():
+    """
+    Replaces mount (output format: <dev> on <mountpoint> type <type> (<options>)).
+    Also returns the mount topology ([id, parent id, mountpoint, type] in mount order) saved as section['mountinfo'].
+    """
+    try:
+        mounts = read_mountinfo()
+    except (IOError, OSError):
+        return get_cmd3('mount')
+    lines = ['{0} on {1} type {2} ({3})'.format(m['dev'], m['mp'], m['type'], m['options']) for m in mounts]
+    mountinfo = [[m['id'], m['parent'], m['mp'], m['type']] for m in mounts]
+    return 0, '\n'.join(lines) + '\n', '', {'mountinfo': mountinfo}
+
+def read_dpkg_status(path=DPKG_STATUS):
+    """ Stream the dpkg status file and return (name, version, arch) for each installed package """
+    packages = []
+    pkg = {}
+    with open(path) as fh:
+        for line in fh:
+            if line[0] in ' \t':
+                continue  # continuation of a multi-line field (Description, Conffiles, ...)
+            if line == '\n':
+                if pkg.get('Status', '').endswith(' installed'):
+                    packages.append((pkg['Package'], pkg.get('Version', ''), pkg.get('Architecture', '')))
+                pkg = {}
+                continue
+            field, _sep, value = line.partition(':')
+            if field in ('Package', 'Status', 'Version', 'Architecture'):
+                pkg[field] = value.strip()
+    if pkg.get('Status', '').endswith(' installed'):
+        packages.append((pkg['Package'], pkg.get('Version', ''), pkg.get('Architecture', '')))
+    return packages
+
+def get_dpkg_packages_native():
+    """ Replaces dpkg --list with <name>\\t<version>\\t<arch> lines read from the dpkg status file """
+    try:
+        packages = read_dpkg_status()
+    except (IOError, OSError) as err:
+        return 1, '', '{0}: {1}'.format(DPKG_STATUS, err.strerror)
+    return 0, ''.join('{0}\t{1}\t{2}\n'.format(*pkg) for pkg in packages), ''
+
+def format_cpu_time(secs):
+    """ Format CPU seconds as [DD-]HH:MM:SS like ps """
+    days, secs = divmod(int(secs), 86400)
+    hours, secs = divmod(secs, 3600)
+    mins, secs = divmod(secs, 60)
+    if days:
+        return '{0}-{1:02d}:{2:02d}:{3:02d}'.format(days, hours, mins, secs)
+    return '{0:02d}:{1:02d}:{2:02d}'.format(hours, mins, secs)
+
+def decode_proc_net_address(address):
+    """ /proc/net/{tcp,udp}[6] hex address (32-bit words in host byte order) and port -> (ip, port) """
+    hex_ip, hex_port = address.split(':')
+    raw = b''.join(bytes.fromhex(hex_ip[i:i + 8])[::-1] for i in range(0, len(hex_ip), 8))
+    family = socket.AF_INET6 if len(raw) == 16 else socket.AF_INET
+    return socket.inet_ntop(family, raw), int(hex_port, 16)
+
+def read_proc_net_inet(proto, listeners, states):
+    """
+    Stream /proc/net/<proto> and add listening sockets (TCP LISTEN, unconnected bound UDP) to listeners and
+    per-state counts to states[proto] without keeping the rest of the table
+    """
+    counts = states.setdefault(proto, {})
+    udp = proto.startswith('udp')
+    with open('/proc/net/' + proto) as fh:
+        fh.readline()  # header
+        for line in fh:
+            fields = line.split(None, 4)
+            if len(fields) < 4:
+                continue
+            state = TCP_STATES.get(fields[3], fields[3])
+            counts[state] = counts.get(state, 0) + 1
+            if udp:
+                if state != 'CLOSE' or not fields[2].endswith(':0000'):
+                    continue
+            elif state != 'LISTEN':
+                continue
+            ip, port = decode_proc_net_address(fields[1])
+            listeners.add((proto, ip, port))
+
+def read_proc_net_unix(states):
+    """ Stream /proc/net/unix and count sockets by state (LISTEN for sockets accepting connections) """
+    counts = states.setdefault('unix', {})
+    with open('/proc/net/unix') as fh:
+        fh.readline()  # header
+        for line in fh:
+            fields = line.split(None, 7)
+            if len(fields) < 6:
+                continue
+            if int(fields[3], 16) & UNIX_ACCEPTCON:
+                state = 'LISTEN'
+            else:
+                state = UNIX_STATES.get(fields[5], fields[5])
+            counts[state] = counts.get(state, 0) + 1
+
+def get_ephemeral_ports():
+    """ [low, high] local port range used for ephemeral ports (None if unknown) """
+    try:
+        with open('/proc/sys/net/ipv4/ip_local_port_range') as fh:
+            return [int(port) for port in fh.read().split()[:2]]
+    except (IOError, OSError, ValueError):
+        return None
+
+def format_listener(proto, ip, port):
+    if ':' in ip:
+        return '{0}\t[{1}]:{2}'.format(proto, ip, port)
+    return '{0}\t{1}:{2}'.format(proto, ip, port)
+
+def get_sockets_native():
+    """
+    Replaces netstat -an with the listening sockets (<proto>\t<address>:<port> lines) read from /proc/net.
+    Per-state socket counts of each table and the ephemeral port range are saved as section['states'] and
+    section['ephemeral_ports'], established connections are only counted.
+    """
+    listeners = set()
+    states = {}
+    errors = []
+    for proto in PROC_NET_INET:
+        try:
+            read_proc_net_inet(proto, listeners, states)
+        except (IOError, OSError) as err:
+            # tcp6/udp6 are missing when IPv6 is disabled
+            if proto in ('tcp', 'udp'):
+                errors.append('/proc/net/{0}: {1}'.format(proto, err.strerror))
+    try:
+        read_proc_net_unix(states)
+    except (IOError, OSError) as err:
+        errors.append('/proc/net/unix: {0}'.format(err.strerror))
+    lines = [format_listener(*listener) for listener in sorted(listeners)]
+    stdout = '\n'.join(lines) + '\n' if lines else ''
+    return 1 if errors else 0, stdout, '\n'.join(errors), {'states': states, 'ephemeral_ports': get_ephemeral_ports()}
+
+def get_ps_native():
+    """ Replaces ps -www -eo "pmem pcpu time vsz rss user pid args" using /proc/[pid]/{stat,status,cmdline} """
+    ticks = os.sysconf('SC_CLK_TCK')
+    page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+    try:
+        with open('/proc/uptime') as fh:
+            uptime = float(fh.read().split()[0])
+        with open('/proc/meminfo') as fh:
+            mem_total_kb = int(fh.readline().split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        return get_cmd3("ps -www -eo \"pmem pcpu time vsz rss user pid args\"")
+
+    users = {}
+    lines = ['%MEM %CPU     TIME    VSZ   RSS USER         PID COMMAND']
+    for pid in sorted(int(d) for d in os.listdir('/proc') if d.isdigit()):
+        proc_dir = '/proc/{0}'.format(pid)
+        # processes can exit while being read, skip them
+        try:
+            with open(proc_dir + '/stat') as fh:
+                stat = fh.read()
+            with open(proc_dir + '/status') as fh:
+                uid = None
+                for line in fh:
+                    if line.startswith('Uid:'):
+                        uid = int(line.split()[2])  # effective uid
+                        break
+            with open(proc_dir + '/cmdline', 'rb') as fh:
+                cmdline = fh.read()
+        except (IOError, OSError):
+            continue
+
+        # comm can contain spaces and parentheses, fields after the last ')' start at field 3 (state)
+        comm = stat[stat.index('(') + 1:stat.rindex(')')]
+        rest = stat[stat.rindex(')') + 2:].split()
+        cpu_secs = (int(rest[11]) + int(rest[12])) / ticks
+        elapsed = uptime - int(rest[19]) / ticks
+        vsz_kb = int(rest[20]) // 1024
+        rss_kb = int(rest[21]) * page_kb
+
+        if uid not in users:
+            try:
+                users[uid] = pwd.getpwuid(uid).pw_name
+            except (KeyError, TypeError):
+                users[uid] = str(uid)
+        args = cmdline.replace(b'\0', b' ').decode('utf-8', 'replace').strip()
+        if not args:
+            args = '[{0}]'.format(comm)
+        pmem = rss_kb * 100.0 / mem_total_kb if mem_total_kb else 0.0
+        pcpu = cpu_secs * 100.0 / elapsed if elapsed > 0 else 0.0
+
+        lines.append('{0:4.1f} {1:4.1f} {2:>8} {3:6d} {4:5d} {5:<8.8} {6:>7d} {7}'.format(
+            pmem, pcpu, format_cpu_time(cpu_secs), vsz_kb, rss_kb, users[uid], pid, args))
+    return 0, '\n'.join(lines) + '\n', ''
+
+def get_cmd_list():
+    """
+    Return the commands saved in each snapshot as a list of dicts (cmd, optional key and timeout).
+    Entries with func are collected natively in Python, source records what was read.
+    Entries with fingerprint can be reused from the section cache while their fingerprint is unchanged.
+    """
+    cmd_list = []
+    cmd_list.append({'cmd': "date +\"%Y-%m-%d %H:%M:%S\""})
+    cmd_list.append({'cmd': "date +\"%s\""})
+    cmd_list.append({'cmd': 'uname'})
+    # cmd_list.append({'cmd': "echo \$TZ"})
+    cmd_list.append({'cmd': 'uptime'})
+    cmd_list.append({'cmd': 'netstat -rn'})
+    cmd_list.append({'cmd': '/sbin/ifconfig -a', 'key': 'ifconfig -a'})
+    cmd_list.append({'cmd': 'cat /proc/swaps', 'func': partial(read_file_native, '/proc/swaps'), 'source': '/proc/swaps'})
+    cmd_list.append({'cmd': 'df -k', 'timeout': 15})
+    cmd_list.append({'cmd': 'mount', 'func': get_mount_native, 'source': '/proc/self/mountinfo'})
+    # small config files are read directly, a cache entry would cost as much to read and fingerprint
+    cmd_list.append({'cmd': 'cat /etc/resolv.conf', 'func': partial(read_file_native, '/etc/resolv.conf'), 'source': '/etc/resolv.conf'})
+    # cmd_list.append({'cmd': 'ntpq -pn'})
+    if os.path.exists('/usr/bin/dpkg'):
+        cmd_list.append({'cmd': 'dpkg --list', 'key': 'packages', 'func': get_dpkg_packages_native, 'source': DPKG_STATUS,
+                         'fingerprint': partial(stat_fingerprint, DPKG_STATUS)})
+    elif os.path.exists('/usr/bin/rpm'):
+        cmd_list.append({'cmd': RPM_QUERY, 'key': 'packages', 'fingerprint': partial(stat_fingerprint, *RPMDB_FILES)})
+    cmd_list.append({'cmd': 'netstat -an', 'key': 'sockets', 'func': get_sockets_native, 'source': '/proc/net'})
+    cmd_list.append({'cmd': "ps -www -eo \"pmem pcpu time vsz rss user pid args\"", 'key': 'ps_custom', 'func': get_ps_native, 'source': '/proc'})
+    cmd_list.append({'cmd': 'cat /etc/ssh/sshd_config', 'func': partial(read_file_native, '/etc/ssh/sshd_config'), 'source': '/etc/ssh/sshd_config'})
+    return cmd_list
+
+#######################################################################
+# Parsers turn command output into structured sections when commands #
+# are collected.  The result is saved next to the raw output in the  #
+# "parsed" key so validators compare dicts instead of re-parsing.    #
+#######################################################################
+
+def register_parser(key):
+    """ Decorator to register a parser function (stdout -> dict) for a cmds_dict key """
+    def decorator(func):
+        PARSERS[key] = func
+        return func
+    return decorator
+
+@register_parser('ifconfig -a')
+def parse_ifconfig(stdout):
+    """ interface -> list of IPs """
+    re_interface = re.compile(r'(^\S.*?)\s')
+    re_ip1 = re.compile(r'inet addr:(.*?)\s')
+    re_ip2 = re.compile(r'inet (.*?)\s')
+    interfaces = {}
+    interface = None
+    for line in stdout.split('\n'):
+        line = line.rstrip()
+
+        # Find each interface
+        m = re_interface.search(line)
+        if m:
+            interface = m.group(1)
+            interface = interface.replace(':', '')  # remove colon
+            interfaces[interface] = []
+        if interface is None:
+            continue
+
+        # Check for IP using 2 patterns (covers multiple Operating Systems)
+        m = re_ip1.search(line) or re_ip2.search(line)
+        if m:
+            interfaces[interface].append(m.group(1))
+    return interfaces
+
+@register_parser('mount')
+def parse_mount(stdout):
+    """ mountpoint -> {dev, type, options} in mount order (the last mount wins for a repeated mountpoint) """
+    mps = {}
+    for line in stdout.split('\n'):
+        fields = line.rstrip().split()
+        if len(fields) != 6:
+            continue
+        dev, _on, mp, _type, fs_type, options = fields
+        mps[mp] = {'dev': dev, 'type': fs_type, 'options': options}
+    return mps
+
+def get_mount_list(section):
+    """
+    Mounts in mount order as dicts {mp, type} with {id, parent} when the section has mountinfo topology.
+    Unlike the parsed section, repeated mountpoints are kept.
+    """
+    if section.get('mountinfo'):
+        return [{'id': m[0], 'parent': m[1], 'mp': m[2], 'type': m[3]} for m in section['mountinfo']]
+    mounts = []
+    for line in section.get('stdout', '').split('\n'):
+        fields = line.rstrip().split()
+        if len(fields) != 6:
+            continue
+        mounts.append({'mp': fields[2], 'type': fields[4]})
+    return mounts
+
+def get_path_prefixes(path):
+    """ path and each parent directory up to / (/a/b -> /a/b, /a, /) """
+    path = path.rstrip('/') or '/'
+    while True:
+        yield path
+        if path == '/' or '/' not in path:
+            return
+        path = path.rsplit('/', 1)[0] or '/'
+
+def find_overmounts(mounts):
+    """
+    Find mounts hidden by a later mount on the same mountpoint or on a parent directory
+    (e.g. /data/a mounted before /data).  Returns [(hidden index, covering index)] in list order.
+
+    With mountinfo parent IDs (mountinfo is not always in mount order) a mount is hidden when another
+    mount is stacked on it or when its parent is not the topmost mount on the nearest parent directory.
+    Without them (plain mount output) mounts are walked in reverse order and a mount is hidden when a
+    later mount is on its mountpoint or a parent directory (other than /).
+    Both use a mountpoint index and walk path components, so the check is near-linear.
+    """
+    overmounts = []
+    if mounts and all('parent' in m for m in mounts):
+        ids = dict((m['id'], i) for i, m in enumerate(mounts))
+        stacked = set((m['mp'], m['parent']) for m in mounts)  # (mountpoint, id of the mount stacked on)
+        tops = {}  # mountpoint -> index of the topmost mount
+        for i, m in enumerate(mounts):
+            if (m['mp'], m['id']) not in stacked:
+                tops[m['mp']] = i
+        for i, m in enumerate(mounts):
+            if m['parent'] not in ids or m['parent'] == m['id']:
+                continue  # root of the mount namespace
+            if (m['mp'], m['id']) in stacked:
+                overmounts.append((i, tops.get(m['mp'], i)))
+                continue
+            if mounts[ids[m['parent']]]['mp'] == m['mp']:
+                continue  # stacked on the mount below it
+            for path in get_path_prefixes(m['mp']):
+                if path == m['mp'] or path not in tops:
+                    continue
+                if mounts[tops[path]]['id'] != m['parent']:
+                    overmounts.append((i, tops[path]))
+                break
+    else:
+        later = {}  # mountpoint -> nearest later mount index
+        for i in range(len(mounts) - 1, -1, -1):
+            for path in get_path_prefixes(mounts[i]['mp']):
+                if path in later and (path != '/' or mounts[i]['mp'] == '/'):
+                    overmounts.append((i, later[path]))
+                    break
+            later[mounts[i]['mp']] = i
+        overmounts.reverse()
+    return overmounts
+
+@register_parser('cat /proc/swaps')
+def parse_swaps(stdout):
+    """ swap file/device -> size """
+    swaps = {}
+    for line in stdout.split('\n'):
+        if line.startswith('File'):
+            continue
+        swap_info = line.split()
+        if len(swap_info) > 2:  # Check number of fields because last line is blank
+            swaps[swap_info[0]] = swap_info[2]
+    return swaps
+
+@register_parser('sockets')
+def parse_sockets(stdout):
+    """ <proto> <address>:<port> -> [proto, address, port] from the listener lines of get_sockets_native() """
+    listeners = {}
+    for line in stdout.split('\n'):
+        fields = line.split('\t')
+        if len(fields) != 2 or ':' not in fields[1]:
+            continue
+        address, _sep, port = fields[1].rpartition(':')
+        listeners['{0} {1}'.format(fields[0], fields[1])] = [fields[0], address.strip('[]'), int(port)]
+    return listeners
+
+def get_package_records(rows):
+    """
+    package -> [version, arch] from (name, version, arch) rows.
+    Packages installed for more than one architecture are keyed <name>:<arch>.
+    """
+    counts = {}
+    for row in rows:
+        counts[row[0]] = counts.get(row[0], 0) + 1
+    packages = {}
+    for name, version, arch in rows:
+        if counts[name] > 1:
+            name = '{0}:{1}'.format(name, arch)
+        packages[name] = [version, arch]
+    return packages
+
+@register_parser('packages')
+def parse_packages(stdout):
+    """ package -> [version, arch] from <name>\\t<version>\\t<arch> lines """
+    rows = []
+    for line in stdout.split('\n'):
+        fields = line.split('\t')
+        if len(fields) == 3:
+            rows.append(fields)
+    return get_package_records(rows)
+
+@register_parser('dpkg --list')
+def parse_dpkg_list(stdout):
+    """ package -> [version, arch] from the installed lines of dpkg --list (snapshots saved before 'packages') """
+    rows = []
+    has_arch = False
+    for line in stdout.split('\n'):
+        if line.startswith('||/'):
+            has_arch = 'Architecture' in line
+            continue
+        fields = line.split()
+        if len(fields) < 3 or len(fields[0]) < 2 or fields[0][1] != 'i':
+            continue  # header or not installed (the second status column is i for installed)
+        name, _sep, arch = fields[1].partition(':')
+        if has_arch and len(fields) > 3:
+            arch = fields[3]
+        rows.append((name, fields[2], arch))
+    return get_package_records(rows)
+
+@register_parser('rpm_custom')
+def parse_rpm_custom(stdout):
+    """
+    package -> [version, ''] from <name>:<version> lines (snapshots saved before 'packages').
+    Without an architecture, packages installed more than once (multilib, kernels) keep one entry.
+    """
+    packages = {}
+    for line in stdout.split('\n'):
+        name, sep, version = line.strip().partition(':')
+        if sep:
+            packages[name] = [version, '']
+    return packages
+
+def get_rpm_upstream_version(version):
+    """ [EPOCH:]VERSION-RELEASE -> VERSION (the version saved in rpm_custom) """
+    return version.split(':', 1)[-1].rsplit('-', 1)[0]
+
+def get_legacy_package_key(cmds_dict):
+    """ Key of the package section of a snapshot saved before it was collected as 'packages' (None if there is none) """
+    for key in LEGACY_PACKAGE_KEYS:
+        if key in cmds_dict:
+            return key
+    return None
+
+def parse_section(key, section):
+    """ Run the registered parser for key over a collected section (returns None if there is no parser) """
+    if key not in PARSERS:
+        return None
+    try:
+        return PARSERS[key](section.get('stdout', ''))
+    except Exception as err:
+        logging.warning('parse_section: {0}: {1}'.format(key, err))
+        return None
+
+def get_parsed(cmds_dict, key):
+    """ Return the parsed section for key, parsing raw output for snapshots saved without it """
+    section = cmds_dict[key]
+    if 'parsed' in section:
+        return section['parsed']
+    return parse_section(key, section) or {}
+
+def get_digest(value):
+    """ Short digest of a JSON value (keys sorted, so equal values have equal digests) """
+    return hashlib.blake2b(json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf-8'), digest_size=8).hexdigest()
+
+def get_section_digest(section):
+    """ Digest of the raw output (rc, stdout, stderr) of a section, equal raw output parses to equal records """
+    stdout_sha256 = section.get('stdout_sha256') or hashlib.sha256(section.get('stdout', '').encode('utf-8')).hexdigest()
+    return get_digest([section.get('rc'), stdout_sha256, section.get('stderr', '')])
+
+def set_section_digests(section):
+    """ Save the section digest and a digest of each parsed record (interface, mountpoint, swap, ...) in section """
+    section['digest'] = get_section_digest(section)
+    if isinstance(section.get('parsed'), dict):
+        section['record_digests'] = dict((key, get_digest(record)) for key, record in section['parsed'].items())
+    return section
+
+def sections_identical(section_prev, section_curr):
+    """ True if both sections have the same raw output (O(1) for sections saved with their digest) """
+    if 'digest' in section_prev and 'digest' in section_curr:
+        return section_prev['digest'] == section_curr['digest']
+    # snapshots saved without digests: comparing the output directly is cheaper than hashing it
+    fields = ('rc', 'stdout_sha256', 'stderr') if 'stdout_sha256' in section_prev and 'stdout_sha256' in section_curr else ('rc', 'stdout', 'stderr')
+    return all(section_prev.get(field) == section_curr.get(field) for field in fields)
+
+#########################################################################
+# Section cache.  Expensive sections are saved with a cheap fingerprint #
+# of their inputs (stat of the package database files)                 #
+# and reused while the fingerprint matches and the entry is younger    #
+# than max_age, so an unchanged rpmdb is never queried twice.          #
+#########################################################################
+
+def stat_fingerprint(*paths):
+    """ mtime_ns:size:inode of each path ('-' if missing) """
+    fingerprint = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            fingerprint.append('{0}:{1}:{2}'.format(st.st_mtime_ns, st.st_size, st.st_ino))
+        except OSError:
+            fingerprint.append('-')
+    return ','.join(fingerprint)
+
+class SectionCache(object):
+    """ Sections keyed by cmds_dict key in <cache_dir>/<sha1 of key>.json with the fingerprint they were collected at """
+
+    def __init__(self, cache_dir, max_age=CACHE_MAX_AGE):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+
+    def get_cache_file(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get_fingerprint(self, cmd_spec):
+        """ Fingerprint of the command and its inputs (None if the command can't be cached) """
+        if 'fingerprint' not in cmd_spec:
+            return None
+        return '{0}|{1}|{2}'.format(CACHE_VERSION, cmd_spec['cmd'], cmd_spec['fingerprint']())
+
+    def get(self, key, fingerprint):
+        """ Return the cached section for key if the fingerprint matches and it hasn't expired, else None """
+        cache_file = self.get_cache_file(key)
+        try:
+            with open(cache_file) as fh:
+                entry = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('key') != key or entry.get('fingerprint') != fingerprint:
+            return None
+        if time() - entry.get('time', 0) > self.max_age:
+            return None
+        return entry['section']
+
+    def put(self, key, fingerprint, section):
+        """ Save a section (errors are logged, the cache is only an optimization) """
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            save_dict_to_file({'key': key, 'fingerprint': fingerprint, 'time': int(time()), 'section': section},
+                              self.get_cache_file(key), fmt='compact')
+        except (IOError, OSError) as err:
+            logging.warning('SectionCache: could not save {0}: {1}'.format(key, err))
+
+    def evict(self):
+        """ Remove entries older than max_age and return the number removed """
+        removed = 0
+        for cache_file in glob.glob(os.path.join(self.cache_dir, '*.json')):
+            try:
+                if time() - os.path.getmtime(cache_file) > self.max_age:
+                    os.remove(cache_file)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+def get_capture_settings(config, spill_dir=None):
+    """ Capture limits for collect_cmds() from the [snapshot] settings, full outputs are spilled to spill_dir """
+    return {
+        'max_bytes': int(config['snapshot']['capture_max_bytes']),
+        'max_lines': int(config['snapshot']['capture_max_lines']),
+        'spill_dir': spill_dir,
+    }
+
+def get_section_cache(config):
+    """ SectionCache from the [snapshot] cache settings (None if cache_max_age is 0) """
+    max_age = int(config['snapshot']['cache_max_age'])
+    if max_age <= 0:
+        return None
+    return SectionCache(config['snapshot']['cache_dir'], max_age)
+
+def collect_cmd(cmd_spec, deadline=None, cache=None, capture=None):
+    """
+    Run one command from get_cmd_list() and return (key, section, stats).
+    stats has rc, wall_secs, cpu_secs and max_rss_kb (native collectors run in this process, so only their thread CPU time is known).
+    With a SectionCache, sections with a fingerprint are reused from the cache while it matches (stats has cached=True).
+    Command output is streamed with bounded memory (capture: max_bytes, max_lines and spill_dir for the full output).
+    """
+    cmd = cmd_spec['cmd']
+    key = cmd_spec.get('key', cmd)
+    timeout = cmd_spec.get('timeout')
+    extra = {}
+    stats = {'cpu_secs': None, 'max_rss_kb': None}
+    start = monotonic()
+
+    # The fingerprint is taken before collecting so a change during collection is picked up next time
+    fingerprint = cache.get_fingerprint(cmd_spec) if cache is not None else None
+    if fingerprint is not None:
+        section = cache.get(key, fingerprint)
+        if section is not None:
+            logging.debug('collect_cmd: {0} reused from the section cache'.format(key))
+            stats.update({'rc': section['rc'], 'wall_secs': round(monotonic() - start, 3), 'cached': True})
+            return key, section, stats
+
+    # Never let a single command run past the global deadline
+    if deadline is not None:
+        remaining = deadline - start
+        if timeout is None or remaining < timeout:
+            timeout = remaining
+
+    if timeout is not None and timeout <= 0:
+        logging.warning('collect_cmd: skipped {0} (collection deadline exceeded)'.format(key))
+        rc, stdout, stderr = -1, '', '(cancelled: collection deadline exceeded)'
+    elif 'func' in cmd_spec:
+        # native collectors return (rc, stdout, stderr) and optionally a dict of extra section fields
+        cpu_start = thread_time()
+        result = cmd_spec['func']()
+        stats['cpu_secs'] = round(thread_time() - cpu_start, 3)
+        rc, stdout, stderr = result[:3]
+        extra = result[3] if len(result) > 3 else {}
+        logging.debug('collect_cmd: {0} read natively from {1}, rc={2}'.format(key, cmd_spec.get('source'), rc))
+    else:
+        if capture is None:
+            capture = {}
+        cmd_capture = {'max_bytes': capture.get('max_bytes', CAPTURE_MAX_BYTES), 'max_lines': capture.get('max_lines', 0)}
+        if capture.get('spill_dir'):
+            cmd_capture['spill_file'] = os.path.join(capture['spill_dir'], re.sub(r'[^A-Za-z0-9_.-]+', '_', key) + '.out')
+        rc, stdout, stderr = get_cmd3(cmd, timeout=timeout, stats=stats, capture=cmd_capture)
+        extra = cmd_capture['info']
+
+    section = {}
+    if 'func' in cmd_spec:
+        section['source'] = cmd_spec.get('source')
+    elif key != cmd:
+        section['cmd'] = cmd
+    section['stdout'] = stdout
+    section['stderr'] = stderr
+    section['rc'] = rc
+    section.update(extra)
+    parsed = parse_section(key, section)
+    if parsed is not None:
+        section['parsed'] = parsed
+    set_section_digests(section)
+    if fingerprint is not None and rc == 0 and not section.get('stdout_truncated'):
+        cache.put(key, fingerprint, section)
+    stats['rc'] = rc
+    stats['wall_secs'] = round(monotonic() - start, 3)
+    return key, section, stats
+
+def collect_cmds(cmds_dict, cmd_list=None, workers=COLLECT_WORKERS, deadline=COLLECT_DEADLINE, cache=None, capture=None):
+    """
+    Run commands concurrently in a bounded thread pool and save each result in cmds_dict.
+    Commands still queued when the deadline passes are cancelled, running ones are killed at the deadline.
+    Keys are added in cmd_list order and run statistics are saved under cmds_dict['collect_stats'].
+    Sections reused from the section cache are listed in collect_stats['cached'], sections whose output passed the
+    capture limits in collect_stats['truncated'].
+    """
+    if cmd_list is None:
+        cmd_list = get_cmd_list()
+
+    start = monotonic()
+    end = start + deadline if deadline else None
+    results = []
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    futures = [executor.submit(collect_cmd, cmd_spec, end, cache, capture) for cmd_spec in cmd_list]
+    try:
+        for future in futures:
+            results.append(future.result())
+    except KeyboardInterrupt:
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=True)
+    wall_secs = monotonic() - start
+
+    serial_secs = 0.0
+    cancelled = []
+    cached = []
+    truncated = []
+    cmd_stats = {}
+    for key, section, stats in results:
+        cmds_dict[key] = section
+        cmd_stats[key] = stats
+        serial_secs += stats['wall_secs']
+        if section['rc'] == -1:
+            cancelled.append(key)
+        if stats.get('cached'):
+            cached.append(key)
+        if section.get('stdout_truncated'):
+            truncated.append(key)
+
+    cmds_dict['collect_stats'] = {
+        'time': int(time()),
+        'workers': workers,
+        'deadline': deadline,
+        'wall_secs': round(wall_secs, 3),
+        'serial_secs': round(serial_secs, 3),
+        'cancelled': cancelled,
+        'cached': cached,
+        'truncated': truncated,
+        'cmds': cmd_stats,
+    }
+    logging.info('collect_cmds: {0} commands in {1:.2f}s wall time ({2:.2f}s serial, workers={3})'.format(
+        len(results), wall_secs, serial_secs, workers))
+    return cmds_dict
+
+def get_run_dir():
+    """ Directory of the current run (AUTO_PATCH_RUN_DIR set by auto-patch.sh, else DATA_DIR/current) or None """
+    run_dir = os.environ.get(RUN_DIR_ENV)
+    if run_dir and os.path.isdir(run_dir):
+        return run_dir
+    current = os.path.join(DATA_DIR, 'current')
+    if os.path.isdir(current):
+        return os.path.realpath(current)
+    return None
+
+def get_cmd_timings(cmds_dict, phase):
+    """ Timing records for the commands collected by the last collect_cmds() call """
+    collect_stats = cmds_dict.get('collect_stats', {})
+    records = []
+    for key, stats in collect_stats.get('cmds', {}).items():
+        record = {'time': collect_stats.get('time'), 'phase': phase, 'name': key}
+        record.update(stats)
+        records.append(record)
+    return records
+
+def append_timings(records, timings_file=None):
+    """ Append timing records as JSON lines to the run's timings file (errors are logged, never raised) """
+    if timings_file is None:
+        run_dir = get_run_dir()
+        if run_dir is None:
+            return
+        timings_file = os.path.join(run_dir, TIMINGS_FILE)
+    data = ''.join(json.dumps(record, sort_keys=True) + '\n' for record in records)
+    try:
+        # a single O_APPEND write per call so concurrent writers do not interleave records
+        fd = os.open(timings_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, data.encode())
+        finally:
+            os.close(fd)
+    except OSError as err:
+        logging.warning('append_timings: {0}: {1}'.format(timings_file, err))
+
+def read_timings(timings_file):
+    """ Timing records from a timings file (unreadable lines are skipped) """
+    records = []
+    try:
+        with open(timings_file) as fh:
+            for line in fh:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except (IOError, OSError):
+        pass
+    return records
+
+def summarize_timings(records):
+    """ Totals per phase plus all records in start time order (the timings section of report.json) """
+    phases = {}
+    for record in records:
+        phase = phases.setdefault(record.get('phase'), {'count': 0, 'wall_secs': 0.0, 'cpu_secs': 0.0, 'max_rss_kb': 0})
+        phase['count'] += 1
+        phase['wall_secs'] = round(phase['wall_secs'] + (record.get('wall_secs') or 0), 3)
+        phase['cpu_secs'] = round(phase['cpu_secs'] + (record.get('cpu_secs') or 0), 3)
+        phase['max_rss_kb'] = max(phase['max_rss_kb'], record.get('max_rss_kb') or 0)
+    return {'phases': phases, 'records': sorted(records, key=lambda record: record.get('time') or 0)}
+
+##########################################################################
+# Validators compare the previous and current snapshots.  Built-in ones #
+# are in verify.py, site-specific ones can be dropped into post_reboot.d #
+# as validate_<name>.py modules (not executable, like common.py).        #
+##########################################################################
+
+def register_validator(name, sections=None):
+    """
+    Decorator to register a validator function(cmds_dict_prev, cmds_dict_curr) -> {report_key: {status, msgs}}.
+    sections lists the cmds_dict keys the validator reads.
+    """
+    def decorator(func):
+        VALIDATORS[name] = {'func': func, 'sections': sections or []}
+        return func
+    return decorator
+
+def load_validator_modules(module_dir):
+    """ Import validate_*.py modules from module_dir so they can register validators """
+    for module_file in sorted(glob.glob(os.path.join(module_dir, 'validate_*.py'))):
+        module_name = os.path.splitext(os.path.basename(module_file))[0]
+        try:
+            spec = importlib.util.spec_from_file_location(module_name, module_file)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            logging.info('load_validator_modules: loaded {0}'.format(module_file))
+        except Exception as err:
+            logging.error('load_validator_modules: {0}: {1}'.format(module_file, err))
+
+def run_validator(name, cmds_dict_prev, cmds_dict_curr):
+    """ Run one validator and add its name and duration to each report entry """
+    start = monotonic()
+    try:
+        results = VALIDATORS[name]['func'](cmds_dict_prev, cmds_dict_curr)
+    except Exception as err:
+        logging.exception('run_validator: {0}'.format(name))
+        results = {name: {'status': 'failed', 'msgs': ['validator raised {0}: {1}'.format(type(err).__name__, err)]}}
+    duration = round(monotonic() - start, 3)
+    for entry in results.values():
+        entry['validator'] = name
+        entry['duration_secs'] = duration
+    return results
+
+def get_validator_names(disable=None):
+    """ Return registered validator names in registration order, excluding disabled ones """
+    return [name for name in VALIDATORS if name not in (disable or [])]
+
+def run_validators(cmds_dict_prev, cmds_dict_curr, names=None, disable=None, workers=VALIDATOR_WORKERS):
+    """ Run validators (default all enabled) in a thread pool and return their merged results in registration order """
+    if names is None:
+        names = get_validator_names(disable)
+    for name in disable or []:
+        if name in VALIDATORS:
+            logging.info('run_validators: {0} disabled'.format(name))
+    report = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(run_validator, name, cmds_dict_prev, cmds_dict_curr) for name in names]
+        for future in futures:
+            report.update(future.result())
+    return report
+
+def get_config(config_file=None):
+    """ Return configuration dict ({section: {key: value}}) from auto-patch.conf merged over CONFIG_DEFAULTS """
+    config = dict((section, dict(values)) for section, values in CONFIG_DEFAULTS.items())
+    if config_file is None:
+        config_file = CONFIG_FILE
+    if not os.path.exists(config_file):
+        logging.debug('{0} not found, using default configuration'.format(config_file))
+        return config
+    for section, values in get_dict_from_toml_file(config_file).items():
+        config.setdefault(section, {})
+        for k, v in values.items():
+            config[section][k] = v.strip('"\'')
+    return config
+
+def config_bool(value):
+    """ Convert a configuration value (true/yes/1) to bool """
+    return str(value).strip().lower() in ('true', 'yes', '1', 'on')
+
+def resolve_snapshot_format(fmt):
+    """ Validate a snapshot format and fall back to gzip if the zstandard module is not installed """
+    if fmt not in SNAPSHOT_FORMATS:
+        logging.error('Invalid snapshot format {0} (choices: {1})'.format(fmt, ', '.join(SNAPSHOT_FORMATS)))
+        sys.exit(2)
+    if fmt == 'zstd' and zstandard is None:
+        logging.warning('zstandard module not installed, using gzip snapshot format')
+        fmt = 'gzip'
+    return fmt
+
+def get_snapshot_file(file_name, fmt):
+    """ Append the compression suffix for fmt (cmds.json -> cmds.json.gz) """
+    return file_name + SNAPSHOT_SUFFIXES.get(fmt, '')
+
+def find_snapshot_file(file_name):
+    """ Return file_name or its compressed variant if only that exists """
+    if os.path.exists(file_name):
+        return file_name
+    for suffix in SNAPSHOT_SUFFIXES.values():
+        if os.path.exists(file_name + suffix):
+            return file_name + suffix
+    return file_name
+
+def save_dict_to_file(data, output_file, fmt='json'):
+    """
+    Stream data as JSON to a temporary file in the same directory, fsync it and atomically
+    rename it over output_file so a crash mid-write never leaves a truncated file behind.
+    """
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    fd, tmp_file = tempfile.mkstemp(prefix='.{0}.'.format(os.path.basename(output_file)), dir=output_dir)
+    try:
+        with os.fdopen(fd, 'wb') as fh_raw:
+            if fmt == 'gzip':
+                fh = gzip.GzipFile(fileobj=fh_raw, mode='wb', mtime=0)
+            elif fmt == 'zstd':
+                fh = zstandard.ZstdCompressor().stream_writer(fh_raw)
+            else:
+                fh = fh_raw
+            fh_text = io.TextIOWrapper(fh, encoding='utf-8')
+            if fmt == 'json':
+                json.dump(data, fh_text, indent=4)
+            else:
+                json.dump(data, fh_text, separators=(',', ':'))
+            fh_text.flush()
+            fh_text.detach()  # don't let the wrapper close the underlying file objects
+            if fmt == 'gzip':
+                fh.close()  # writes gzip trailer, leaves fh_raw open
+            elif fmt == 'zstd':
+                fh.flush(zstandard.FLUSH_FRAME)
+            fh_raw.flush()
+            os.fsync(fh_raw.fileno())
+        os.chmod(tmp_file, 0o600)
+        os.replace(tmp_file, output_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+    # fsync directory so the rename itself is durable
+    try:
+        dir_fd = os.open(output_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+#############################################################################
+# Content-addressed snapshot store.  Each section is saved once as a gzip  #
+# blob named by the sha256 of its JSON in <store_dir>/objects/ab/cdef...   #
+# and each run keeps a manifest mapping section keys to blob hashes.       #
+#############################################################################
+
+MANIFEST_KEY = '_manifest'
+
+def section_hash(section):
+    """ sha256 of the compact JSON of a section (the name of its blob in the store) """
+    return hashlib.sha256(json.dumps(section, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+def get_blob_file(store_dir, digest):
+    return os.path.join(store_dir, 'objects', digest[:2], digest[2:])
+
+def save_blob(store_dir, section):
+    """ Save a section in the store unless an identical one exists and return (hash, True if a new blob was written) """
+    data = json.dumps(section, separators=(',', ':')).encode('utf-8')
+    digest = hashlib.sha256(data).hexdigest()
+    blob_file = get_blob_file(store_dir, digest)
+    if os.path.exists(blob_file):
+        # refresh mtime so gc_store() never removes a blob that is about to be referenced
+        os.utime(blob_file, None)
+        return digest, False
+    blob_dir = os.path.dirname(blob_file)
+    if not os.path.isdir(blob_dir):
+        os.makedirs(blob_dir, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(prefix='.tmp.', dir=blob_dir)
+    with os.fdopen(fd, 'wb') as fh:
+        fh.write(gzip.compress(data, mtime=0))
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_file, blob_file)
+    return digest, True
+
+def load_blob(store_dir, digest):
+    with open(get_blob_file(store_dir, digest), 'rb') as fh:
+        return json.loads(gzip.decompress(fh.read()).decode('utf-8'))
+
+def save_snapshot_to_store(cmds_dict, manifest_file, store_dir):
+    """ Save each section as a blob and write the manifest (section key -> hash) to manifest_file """
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    manifest = {}
+    new_blobs = 0
+    for key, section in cmds_dict.items():
+        manifest[key], created = save_blob(store_dir, section)
+        new_blobs += 1 if created else 0
+    # store path is relative to the manifest so run directories and store can be copied together
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    manifest[MANIFEST_KEY] = {'version': 1, 'store': os.path.relpath(os.path.abspath(store_dir), manifest_dir)}
+    save_dict_to_file(manifest, manifest_file, fmt='json')
+    logging.info('save_snapshot_to_store: {0} sections, {1} new blobs in {2}'.format(len(cmds_dict), new_blobs, store_dir))
+
+class LazySnapshot(Mapping):
+    """ Read-only snapshot built from a manifest, sections are loaded from the store on first access """
+
+    def __init__(self, manifest, manifest_file):
+        self.hashes = dict((k, v) for k, v in manifest.items() if k != MANIFEST_KEY)
+        self.store_dir = os.path.join(os.path.dirname(os.path.abspath(manifest_file)), manifest[MANIFEST_KEY]['store'])
+        self.sections = {}
+
+    def __getitem__(self, key):
+        if key not in self.sections:
+            self.sections[key] = load_blob(self.store_dir, self.hashes[key])
+        return self.sections[key]
+
+    def __iter__(self):
+        return iter(self.hashes)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, key):
+        return key in self.hashes
+
+def gc_store(data_dir, store_dir, grace_secs=3600):
+    """ Remove blobs not referenced by any manifest in data_dir/*/cmds.json (blobs newer than grace_secs are kept) """
+    referenced = set()
+    for manifest_file in glob.glob(os.path.join(data_dir, '*', 'cmds.json')):
+        try:
+            with open(manifest_file) as fh:
+                manifest = json.load(fh)
+        except (IOError, OSError, ValueError):
+            continue
+        if MANIFEST_KEY in manifest:
+            referenced.update(v for k, v in manifest.items() if k != MANIFEST_KEY)
+
+    # never empty the store because manifests were not found (e.g. wrong data_dir)
+    if not referenced:
+        logging.warning('gc_store: no manifests found in {0}, skipping'.format(data_dir))
+        return 0
+
+    removed = 0
+    cutoff = time() - grace_secs
+    for blob_file in glob.glob(os.path.join(store_dir, 'objects', '??', '*')):
+        digest = os.path.basename(os.path.dirname(blob_file)) + os.path.basename(blob_file)
+        if digest in referenced:
+            continue
+        try:
+            if os.path.getmtime(blob_file) < cutoff:
+                os.remove(blob_file)
+                removed += 1
+        except OSError:
+            pass
+    logging.info('gc_store: {0} blobs referenced, {1} removed'.format(len(referenced), removed))
+    return removed
+
+def save_snapshot(cmds_dict, output_file, fmt='json', store_dir=None):
+    """ Save a snapshot in one of SNAPSHOT_FORMATS """
+    if fmt == 'store':
+        save_snapshot_to_store(cmds_dict, output_file, store_dir)
+    else:
+        save_dict_to_file(cmds_dict, output_file, fmt=fmt)
+
 def get_dict_from_file(input_file):
     if not input_file:
         logging.error('input_file not specified in {0}'.format('get_dict_from_file'))
         sys.exit(1)
 
+    input_file = find_snapshot_file(input_file)
     if not os.path.exists(input_file):
         logging.error('{0} not found'.format(input_file))
         sys.exit(1)
 
     doc = dict()
-    # read json
+    # read json (plain or compressed), a store manifest is returned as a snapshot that loads sections on access
     if re.search(r'\.json', input_file):
         doc = get_dict_from_json_file(input_file)
+        if MANIFEST_KEY in doc[0]:
+            doc[0] = LazySnapshot(doc[0], input_file)
     else:
         logging.error('Could not determine file type for {0} (should be *.json)'.format(input_file))
         sys.exit(1)
@@ -128,13 +1501,23 @@ def get_dict_from_file(input_file):
 
 def get_dict_from_json_file(input_file):
 
-    # Read json from file
-    json_string = open(input_file).read()
+    # Detect compression from magic bytes and stream-parse json from file
+    with open(input_file, 'rb') as fh_raw:
+        magic = fh_raw.read(4)
+        fh_raw.seek(0)
+        if magic.startswith(MAGIC_GZIP):
+            fh = gzip.GzipFile(fileobj=fh_raw, mode='rb')
+        elif magic.startswith(MAGIC_ZSTD):
+            if zstandard is None:
+                logging.error('{0} is zstd compressed but the zstandard module is not installed'.format(input_file))
+                sys.exit(1)
+            fh = zstandard.ZstdDecompressor().stream_reader(fh_raw)
+        else:
+            fh = fh_raw
 
-    # Parse (validate) json
-    json_docs = []
-    json_docs.append(json.loads(json_string))
-    # json_dict = json.loads(json_string)
+        # Parse (validate) json
+        json_docs = []
+        json_docs.append(json.load(io.TextIOWrapper(fh, encoding='utf-8')))
 
     # return dict representation
     return json_docs
@@ -180,6 +1563,50 @@ def get_dict_from_toml_file(input_file):
             toml_dict[section][k] = v
     return toml_dict
 
+def diff_dicts(current_dict, past_dict, current_digests=None, past_digests=None):
+    """
+    Return (added, removed, changed) keys of current_dict against past_dict in a single sweep over current_dict
+    (past_dict is only scanned for removed keys when some of its keys were not seen).
+    With record digests (key -> digest of the value) for both sides, values are compared by digest.
+    """
+    added, changed = set(), set()
+    use_digests = current_digests is not None and past_digests is not None
+    common = 0
+    for key, value in current_dict.items():
+        if key not in past_dict:
+            added.add(key)
+            continue
+        common += 1
+        if use_digests and key in current_digests and key in past_digests:
+            if current_digests[key] != past_digests[key]:
+                changed.add(key)
+        elif value != past_dict[key]:
+            changed.add(key)
+    if common == len(past_dict):
+        removed = set()
+    else:
+        removed = set(key for key in past_dict if key not in current_dict)
+    return added, removed, changed
+
+def diff_sections(cmds_dict_curr, cmds_dict_prev, key, select=None, parsed_curr=None, parsed_prev=None):
+    """
+    Return (added, removed, changed) records of the parsed section key.  Sections with identical raw output are
+    neither parsed nor diffed, otherwise records are compared by their saved digests.
+    select(record key, record) limits the compared records (e.g. to some filesystem types).
+    Callers that already have the parsed sections pass them as parsed_curr and parsed_prev.
+    """
+    section_curr, section_prev = cmds_dict_curr[key], cmds_dict_prev[key]
+    if sections_identical(section_prev, section_curr):
+        return set(), set(), set()
+    if parsed_curr is None:
+        parsed_curr = get_parsed(cmds_dict_curr, key)
+    if parsed_prev is None:
+        parsed_prev = get_parsed(cmds_dict_prev, key)
+    if select is not None:
+        parsed_curr = dict((k, v) for k, v in parsed_curr.items() if select(k, v))
+        parsed_prev = dict((k, v) for k, v in parsed_prev.items() if select(k, v))
+    return diff_dicts(parsed_curr, parsed_prev, section_curr.get('record_digests'), section_prev.get('record_digests'))
+
 class DictDiffer(object):
     """
     Calculate the difference between two dictionaries as:
@@ -187,6 +1614,7 @@ class DictDiffer(object):
     (2) items removed
     (3) keys same in both but changed values
     (4) keys same in both and unchanged values
+    Added, removed and changed are computed once with diff_dicts() (optionally by record digests).
 
     Example:
     dict_diff = DictDiffer(dict_current, dict_past)
@@ -196,23 +1624,18 @@ class DictDiffer(object):
     print("Unchanged:", dict_diff.unchanged())
     """
 
-    def __init__(self, current_dict, past_dict):
+    def __init__(self, current_dict, past_dict, current_digests=None, past_digests=None):
         self.current_dict, self.past_dict = current_dict, past_dict
-        self.current_keys, self.past_keys = [
-            set(d.keys()) for d in (current_dict, past_dict)
-        ]
-        self.intersect = self.current_keys.intersection(self.past_keys)
+        self._added, self._removed, self._changed = diff_dicts(current_dict, past_dict, current_digests, past_digests)
 
     def added(self):
-        return self.current_keys - self.intersect
+        return self._added
 
     def removed(self):
-        return self.past_keys - self.intersect
+        return self._removed
 
     def changed(self):
-        return set(o for o in self.intersect
-                   if self.past_dict[o] != self.current_dict[o])
+        return self._changed
 
     def unchanged(self):
-        return set(o for o in self.intersect
-                   if self.past_dict[o] == self.current_dict[o])
+        return set(key for key in self.current_dict if key not in self._added and key not in self._changed)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+# Summarize report.json (and cmds.json) files collected from many hosts into a central directory:
+#   <reports_dir>/<host>/report.json and <reports_dir>/<host>/cmds.json[.gz|.zst]
+#   (<reports_dir>/<host>/current/... is also accepted)
+# This script runs centrally and is not installed on patched hosts.
+
+import sys
+import os
+import json
+import sqlite3
+from time import time, localtime, strftime
+from multiprocessing import Pool
+import getopt
+
+from common import *
+
+####################
+# Global variables #
+####################
+
+# Initialize arg_dict
+arg_dict = dict()
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hosts (
+    host TEXT PRIMARY KEY,
+    report_stat TEXT,       -- mtime:size of report.json when summarized
+    snapshot_stat TEXT,     -- mtime:size of cmds.json when summarized
+    exit INTEGER,           -- NULL when report.json is missing or unreadable
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS failures (
+    host TEXT,
+    validator TEXT,
+    report_key TEXT,
+    msg TEXT
+);
+CREATE INDEX IF NOT EXISTS failures_host ON failures (host);
+CREATE TABLE IF NOT EXISTS packages (
+    host TEXT,
+    name TEXT,
+    version TEXT
+);
+CREATE INDEX IF NOT EXISTS packages_host ON packages (host);
+CREATE INDEX IF NOT EXISTS packages_name ON packages (name, version);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,  -- packages_filter: JSON list of the -P packages (null for all) the packages rows were built with
+    value TEXT
+);
+"""
+
+# Help message
+def usage(exit_code=0):
+    """ Display help message if -h option used or invalid syntax. """
+    print(os.path.basename(__file__) + ' -d <reports_dir> [-C <cache.db>] [-H <hosts_file>] [-P <packages>] [-j <workers>] [-o <out_file.json>] [-v]')
+    print("\t-d\tdirectory with one sub-directory per host containing report.json and cmds.json")
+    print("\t-C\tcache database used to skip unchanged files (default <reports_dir>/.fleet-report.db)")
+    print("\t-H\tfile with expected host names (one per line) to report hosts without a directory as missing")
+    print("\t-P\tcomma separated package names to track for version skew (default all packages)")
+    print("\t-j\tnumber of worker processes (default number of CPUs)")
+    print("\t-o\tJSON file to write the rollup to (default print to stdout)")
+    print("\t-v\tverbose output")
+    sys.exit(exit_code)
+
+def parse_args(arg_dict):
+    # Parse CLI input #
+    try:
+        opts, _args = getopt.getopt(sys.argv[1:], "hvd:C:H:P:j:o:", ["help"])
+    except getopt.GetoptError as err:
+        logging.error(err)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-v':
+            arg_dict['verbose'] = True
+        elif opt == '-d':
+            arg_dict['reports_dir'] = arg
+        elif opt == '-C':
+            arg_dict['cache_file'] = arg
+        elif opt == '-H':
+            arg_dict['hosts_file'] = arg
+        elif opt == '-P':
+            arg_dict['packages'] = set(p.strip() for p in arg.split(',') if p.strip())
+        elif opt == '-j':
+            arg_dict['workers'] = int(arg)
+        elif opt == '-o':
+            arg_dict['out_file'] = arg
+        elif opt == '-h':
+            arg_dict['usage'] = True
+        elif opt == '--help':
+            arg_dict['usage'] = True
+    return arg_dict
+
+def get_file_stat(file_name):
+    """ Return 'mtime:size' of a file or None if it does not exist """
+    try:
+        st = os.stat(file_name)
+    except OSError:
+        return None
+    return '{0}:{1}'.format(st.st_mtime_ns, st.st_size)
+
+def find_host_files(host_dir):
+    """ Return (report_file, snapshot_file) for a host directory (either may not exist) """
+    for base in (host_dir, os.path.join(host_dir, 'current')):
+        report_file = os.path.join(base, 'report.json')
+        snapshot_file = find_snapshot_file(os.path.join(base, 'cmds.json'))
+        if os.path.exists(report_file) or os.path.exists(snapshot_file):
+            return report_file, snapshot_file
+    return os.path.join(host_dir, 'report.json'), os.path.join(host_dir, 'cmds.json')
+
+def summarize_host(task):
+    """
+    Worker: parse one host's files into a small summary (runs in a separate process).
+    The summary keeps the file stats of the scan, taken before the files were read, so a file rewritten
+    meanwhile is summarized again on the next run.
+    """
+    host, report_file, snapshot_file, stats, packages_filter = task
+    summary = {'host': host, 'stats': stats, 'exit': None, 'failures': [], 'packages': [], 'error': None}
+    try:
+        if os.path.exists(report_file):
+            report = get_dict_from_json_file(report_file)[0]
+            summary['exit'] = report.get('exit')
+            for key, entry in report.items():
+                if isinstance(entry, dict) and entry.get('status', 'success') != 'success':
+                    msgs = entry.get('msgs') or ['']
+                    summary['failures'].append((entry.get('validator', key), key, str(msgs[0])))
+        if os.path.exists(snapshot_file):
+            snapshot = get_dict_from_json_file(snapshot_file)[0]
+            if MANIFEST_KEY in snapshot:
+                # store manifest, the package section is loaded from the store next to it
+                snapshot = LazySnapshot(snapshot, snapshot_file)
+            if 'packages' in snapshot:
+                try:
+                    packages = get_parsed(snapshot, 'packages')
+                except (IOError, OSError) as err:
+                    logging.warning('summarize_host: {0}: packages skipped, store blob not readable: {1}'.format(host, err))
+                    packages = {}
+                for name, (version, _arch) in packages.items():
+                    if packages_filter is None or name in packages_filter:
+                        summary['packages'].append((name, version))
+    except Exception as err:
+        summary['error'] = '{0}: {1}'.format(type(err).__name__, err)
+    return summary
+
+def open_cache(cache_file):
+    conn = sqlite3.connect(cache_file)
+    conn.executescript(CACHE_SCHEMA)
+    return conn
+
+def update_cache(conn, reports_dir, packages_filter, workers):
+    """
+    Summarize hosts whose report.json or cmds.json changed (by mtime and size) and drop hosts that disappeared.
+    All hosts are summarized again when the packages filter differs from the one the cache was built with.
+    """
+    cached = dict((row[0], (row[1], row[2])) for row in conn.execute('SELECT host, report_stat, snapshot_stat FROM hosts'))
+    packages_key = json.dumps(sorted(packages_filter) if packages_filter is not None else None)
+    row = conn.execute("SELECT value FROM settings WHERE name = 'packages_filter'").fetchone()
+    refresh = row is None or row[0] != packages_key
+    if refresh and cached:
+        logging.info('update_cache: packages filter changed, summarizing all hosts')
+    seen = set()
+    tasks = []
+    for entry in os.scandir(reports_dir):
+        if not entry.is_dir() or entry.name.startswith('.'):
+            continue
+        seen.add(entry.name)
+        report_file, snapshot_file = find_host_files(entry.path)
+        stats = (get_file_stat(report_file), get_file_stat(snapshot_file))
+        if refresh or cached.get(entry.name) != stats:
+            tasks.append((entry.name, report_file, snapshot_file, stats, packages_filter))
+
+    removed = [host for host in cached if host not in seen]
+    with conn:
+        for host in removed:
+            for table in ('hosts', 'failures', 'packages'):
+                conn.execute('DELETE FROM {0} WHERE host = ?'.format(table), (host,))
+    logging.info('update_cache: {0} hosts, {1} changed, {2} removed'.format(len(seen), len(tasks), len(removed)))
+
+    # Summaries are streamed into the cache as workers finish, so memory does not grow with the fleet size
+    pool = Pool(processes=workers)
+    try:
+        for count, summary in enumerate(pool.imap_unordered(summarize_host, tasks, chunksize=16), 1):
+            host = summary['host']
+            with conn:
+                conn.execute('DELETE FROM failures WHERE host = ?', (host,))
+                conn.execute('DELETE FROM packages WHERE host = ?', (host,))
+                conn.execute('INSERT OR REPLACE INTO hosts VALUES (?, ?, ?, ?, ?)',
+                             (host, summary['stats'][0], summary['stats'][1], summary['exit'], summary['error']))
+                conn.executemany('INSERT INTO failures VALUES (?, ?, ?, ?)', [(host,) + tuple(f) for f in summary['failures']])
+                conn.executemany('INSERT INTO packages VALUES (?, ?, ?)', [(host,) + tuple(p) for p in summary['packages']])
+            if count % 1000 == 0:
+                logging.info('update_cache: {0}/{1} hosts summarized'.format(count, len(tasks)))
+    finally:
+        pool.close()
+        pool.join()
+    # saved last, so an interrupted run summarizes all hosts again
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO settings VALUES ('packages_filter', ?)", (packages_key,))
+    return seen
+
+def build_rollup(conn, expected_hosts=None):
+    """ Fleet rollup computed in SQLite (bounded memory) """
+    rollup = {'time': strftime('%Y-%m-%d %H:%M:%S', localtime())}
+    rollup['hosts'] = conn.execute('SELECT count(*) FROM hosts').fetchone()[0]
+    rollup['exit'] = dict((str(k), v) for k, v in conn.execute('SELECT exit, count(*) FROM hosts GROUP BY exit'))
+    rollup['failures_by_validator'] = dict(conn.execute(
+        'SELECT validator, count(DISTINCT host) FROM failures GROUP BY validator ORDER BY 2 DESC'))
+    rollup['hosts_missing_report'] = [row[0] for row in conn.execute('SELECT host FROM hosts WHERE exit IS NULL ORDER BY host')]
+    if expected_hosts is not None:
+        known = set(row[0] for row in conn.execute('SELECT host FROM hosts'))
+        rollup['hosts_missing_report'].extend(sorted(h for h in expected_hosts if h not in known))
+    rollup['hosts_unreadable'] = dict(conn.execute('SELECT host, error FROM hosts WHERE error IS NOT NULL ORDER BY host'))
+
+    # Package version skew: packages installed with more than one version across the fleet
+    skew = {}
+    for name, version, hosts in conn.execute(
+            'SELECT name, version, count(*) FROM packages WHERE name IN '
+            '(SELECT name FROM packages GROUP BY name HAVING count(DISTINCT version) > 1) '
+            'GROUP BY name, version ORDER BY name, 3 DESC'):
+        skew.setdefault(name, {})[version] = hosts
+    rollup['package_version_skew'] = skew
+    return rollup
+
+
+if __name__ == '__main__':
+
+    # default configuration options
+    arg_dict['usage'] = False
+    arg_dict['verbose'] = False
+    arg_dict['packages'] = None
+    arg_dict['workers'] = os.cpu_count() or 1
+
+    # call function to parse CLI arguments to override defaults
+    arg_dict = parse_args(arg_dict)
+
+    if arg_dict['usage'] or 'reports_dir' not in arg_dict:
+        usage(2)
+
+    # Setup logging options based on verbose setting
+    if arg_dict['verbose']:
+        setup_logging(log_file=None, log_file_level='debug', log_print_level='info')
+    else:
+        setup_logging(log_file=None, log_file_level='info', log_print_level='warn')
+
+    if not os.path.isdir(arg_dict['reports_dir']):
+        logging.error('{0} not found'.format(arg_dict['reports_dir']))
+        sys.exit(1)
+    arg_dict.setdefault('cache_file', os.path.join(arg_dict['reports_dir'], '.fleet-report.db'))
+
+    expected_hosts = None
+    if 'hosts_file' in arg_dict:
+        with open(arg_dict['hosts_file']) as fh:
+            expected_hosts = set(line.strip() for line in fh if line.strip() and not line.startswith('#'))
+
+    start = time()
+    conn = open_cache(arg_dict['cache_file'])
+    update_cache(conn, arg_dict['reports_dir'], arg_dict['packages'], arg_dict['workers'])
+    rollup = build_rollup(conn, expected_hosts)
+    conn.close()
+    rollup['elapsed_secs'] = round(time() - start, 3)
+
+    if 'out_file' in arg_dict:
+        save_dict_to_file(rollup, arg_dict['out_file'], fmt='json')
+    else:
+        print(json.dumps(rollup, indent=4))
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import sqlite3
+import json
+import glob
+from time import time
+import getopt
+
+from common import *
+
+####################
+# Global variables #
+####################
+
+# Initialize arg_dict
+arg_dict = dict()
+
+# Version 2 indexes the section digest (raw output) instead of the hash of the section JSON
+SCHEMA_VERSION = 2
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run TEXT PRIMARY KEY,           -- run directory name (<datetime_stamp>)
+    snapshot_time INTEGER,          -- epoch seconds cmds.json was indexed
+    snapshot_mtime REAL,
+    collect_wall_secs REAL,
+    collect_serial_secs REAL,
+    verify_time INTEGER,            -- epoch seconds report.json was indexed
+    report_mtime REAL,
+    exit INTEGER                    -- report.json exit (NULL until verified)
+);
+CREATE TABLE IF NOT EXISTS validations (
+    run TEXT,
+    report_key TEXT,
+    validator TEXT,
+    status TEXT,
+    duration_secs REAL,
+    converge_secs REAL,
+    msgs TEXT,
+    PRIMARY KEY (run, report_key)
+);
+CREATE INDEX IF NOT EXISTS validations_status ON validations (status, run);
+CREATE TABLE IF NOT EXISTS sections (
+    run TEXT,
+    key TEXT,
+    hash TEXT,
+    PRIMARY KEY (run, key)
+);
+CREATE INDEX IF NOT EXISTS sections_key ON sections (key, run);
+CREATE TABLE IF NOT EXISTS package_changes (
+    run TEXT,
+    name TEXT,
+    change TEXT,                    -- upgraded, added or removed
+    old_version TEXT,
+    new_version TEXT
+);
+CREATE INDEX IF NOT EXISTS package_changes_name ON package_changes (name, run);
+"""
+
+# Help message
+def usage(exit_code=0):
+    """ Display help message if -h option used or invalid syntax. """
+    print(os.path.basename(__file__) + ' [-d <db_file>] [-n <limit>] [-c <config_file>] [-v] <command> [<arg>]')
+    print("\t-d\tSQLite history database (default from config file or /var/log/auto-patch/history.db)")
+    print("\t-n\tmaximum number of rows to print (default 20)")
+    print("\t-c\tconfiguration file (default {0})".format(CONFIG_FILE))
+    print("\t-v\tverbose output")
+    print("commands:")
+    print("\truns\t\t\trecent runs with exit code and collection times")
+    print("\tfailures\t\tfailed validations, most recent first")
+    print("\tlast-failure [validator]\tmost recent failed validation (optionally for one validator)")
+    print("\ttrend <validator>\tvalidator status and duration per run")
+    print("\tchanges <section>\truns where a section (e.g. mount) changed from the previous run")
+    print("\tpackages [name]\t\tpackage upgrades, additions and removals")
+    print("\treindex [data_dir]\tindex run directories not indexed yet (default /var/log/auto-patch)")
+    sys.exit(exit_code)
+
+def parse_args(arg_dict):
+    # Parse CLI input #
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hvd:n:c:", ["help"])
+    except getopt.GetoptError as err:
+        logging.error(err)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-v':
+            arg_dict['verbose'] = True
+        elif opt == '-d':
+            arg_dict['db_file'] = arg
+        elif opt == '-n':
+            arg_dict['limit'] = int(arg)
+        elif opt == '-c':
+            arg_dict['config_file'] = arg
+        elif opt == '-h':
+            arg_dict['usage'] = True
+        elif opt == '--help':
+            arg_dict['usage'] = True
+    arg_dict['args'] = args
+    return arg_dict
+
+def open_db(db_file):
+    """ Open (and create if needed) the history database """
+    db_dir = os.path.dirname(os.path.abspath(db_file))
+    if not os.path.isdir(db_dir):
+        os.makedirs(db_dir)
+    conn = sqlite3.connect(db_file, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    user_version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if user_version < SCHEMA_VERSION:
+        conn.executescript(SCHEMA)
+        if user_version == 1:
+            # hashes of version 1 can't be compared with digests, snapshots are indexed again by reindex
+            conn.execute('DELETE FROM sections')
+            conn.execute('UPDATE runs SET snapshot_mtime = NULL')
+        conn.execute('PRAGMA user_version = {0}'.format(SCHEMA_VERSION))
+        conn.commit()
+    os.chmod(db_file, 0o600)
+    return conn
+
+def get_run_name(file_name):
+    """ Run name is the <datetime_stamp> directory containing cmds.json/report.json (current is resolved) """
+    return os.path.basename(os.path.dirname(os.path.realpath(file_name)))
+
+def index_snapshot(conn, run, cmds_dict, snapshot_mtime=None):
+    """
+    Record run metadata and section digests from a snapshot.  The digest covers the raw output only (see
+    get_section_digest), so volatile fields such as mount ids, socket counts and spill files don't show as changes.
+    """
+    stats = cmds_dict['collect_stats'] if 'collect_stats' in cmds_dict else {}
+    with conn:
+        conn.execute('INSERT OR IGNORE INTO runs (run) VALUES (?)', (run,))
+        conn.execute('UPDATE runs SET snapshot_time = ?, snapshot_mtime = ?, collect_wall_secs = ?, collect_serial_secs = ? WHERE run = ?',
+                     (stats.get('time', int(time())), snapshot_mtime, stats.get('wall_secs'), stats.get('serial_secs'), run))
+        conn.execute('DELETE FROM sections WHERE run = ?', (run,))
+        conn.executemany('INSERT INTO sections (run, key, hash) VALUES (?, ?, ?)',
+                         [(run, key, section.get('digest') or get_section_digest(section)) for key, section in cmds_dict.items()
+                          if key != 'collect_stats' and isinstance(section, dict)])
+
+def index_report(conn, run, report_dict, report_mtime=None):
+    """ Record per-validator results and package changes from a report """
+    rows = []
+    package_rows = []
+    for key, entry in report_dict.items():
+        if not isinstance(entry, dict) or 'status' not in entry:
+            continue
+        rows.append((run, key, entry.get('validator', key), entry['status'], entry.get('duration_secs'),
+                     entry.get('converge_secs'), json.dumps(entry.get('msgs', []))))
+        for name, versions in entry.get('upgraded', {}).items():
+            package_rows.append((run, name, 'upgraded', versions[0], versions[1]))
+        for name, version in entry.get('added', {}).items():
+            package_rows.append((run, name, 'added', None, version))
+        for name, version in entry.get('removed', {}).items():
+            package_rows.append((run, name, 'removed', version, None))
+    with conn:
+        conn.execute('INSERT OR IGNORE INTO runs (run) VALUES (?)', (run,))
+        conn.execute('UPDATE runs SET verify_time = ?, report_mtime = ?, exit = ? WHERE run = ?',
+                     (int(time()), report_mtime, report_dict.get('exit'), run))
+        conn.execute('DELETE FROM validations WHERE run = ?', (run,))
+        conn.execute('DELETE FROM package_changes WHERE run = ?', (run,))
+        conn.executemany('INSERT INTO validations VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        conn.executemany('INSERT INTO package_changes VALUES (?, ?, ?, ?, ?)', package_rows)
+
+def update_history(db_file, snapshot_file=None, cmds_dict=None, report_file=None, report_dict=None):
+    """ Incrementally index one run after cmds-save.py or verify.py finishes (errors are logged, never raised) """
+    try:
+        conn = open_db(db_file)
+        try:
+            if cmds_dict is not None:
+                index_snapshot(conn, get_run_name(snapshot_file), cmds_dict, os.path.getmtime(snapshot_file))
+            if report_dict is not None:
+                index_report(conn, get_run_name(report_file), report_dict, os.path.getmtime(report_file))
+        finally:
+            conn.close()
+    except Exception as err:
+        logging.warning('update_history: {0}: {1}'.format(db_file, err))
+
+def reindex(conn, data_dir):
+    """ Index run directories whose cmds.json or report.json changed since they were last indexed """
+    indexed = dict((row[0], (row[1], row[2])) for row in conn.execute('SELECT run, snapshot_mtime, report_mtime FROM runs'))
+    count = 0
+    for run_dir in sorted(glob.glob(os.path.join(data_dir, '20[2-9][0-9]-[0-1][0-9]-[0-3][0-9]_*'))):
+        run = os.path.basename(run_dir)
+        snapshot_mtime, report_mtime = indexed.get(run, (None, None))
+        snapshot_file = find_snapshot_file(os.path.join(run_dir, 'cmds.json'))
+        report_file = os.path.join(run_dir, 'report.json')
+        try:
+            if os.path.exists(snapshot_file) and os.path.getmtime(snapshot_file) != snapshot_mtime:
+                index_snapshot(conn, run, get_dict_from_file(snapshot_file)[0], os.path.getmtime(snapshot_file))
+                count += 1
+            if os.path.exists(report_file) and os.path.getmtime(report_file) != report_mtime:
+                index_report(conn, run, get_dict_from_file(report_file)[0], os.path.getmtime(report_file))
+                count += 1
+        except (ValueError, IOError, OSError, EOFError) as err:
+            # truncated or corrupt file (e.g. an interrupted run), the other runs are still indexed
+            logging.warning('reindex: {0}: skipped: {1}'.format(run_dir, err))
+    logging.info('reindex: {0} files indexed from {1}'.format(count, data_dir))
+    return count
+
+def print_rows(header, rows):
+    """ Print rows as aligned columns """
+    rows = [['' if v is None else str(v) for v in row] for row in rows]
+    widths = [max([len(header[i])] + [len(row[i]) for row in rows]) for i in range(len(header))]
+    print('  '.join(h.ljust(w) for h, w in zip(header, widths)).rstrip())
+    for row in rows:
+        print('  '.join(v.ljust(w) for v, w in zip(row, widths)).rstrip())
+
+def query(conn, command, args, limit):
+    """ Run a query command and print its results, returns exit code """
+    if command == 'runs':
+        print_rows(['run', 'exit', 'collect_wall_secs', 'collect_serial_secs'], conn.execute(
+            'SELECT run, exit, collect_wall_secs, collect_serial_secs FROM runs ORDER BY run DESC LIMIT ?', (limit,)))
+    elif command == 'failures':
+        print_rows(['run', 'validator', 'report_key', 'msgs'], conn.execute(
+            "SELECT run, validator, report_key, msgs FROM validations WHERE status != 'success' ORDER BY run DESC LIMIT ?", (limit,)))
+    elif command == 'last-failure':
+        sql = "SELECT run, validator, report_key, msgs FROM validations WHERE status != 'success'"
+        params = []
+        if args:
+            sql += ' AND validator = ?'
+            params.append(args[0])
+        rows = list(conn.execute(sql + ' ORDER BY run DESC LIMIT 1', params))
+        if not rows:
+            print('no failures recorded')
+            return 1
+        print_rows(['run', 'validator', 'report_key', 'msgs'], rows)
+    elif command == 'trend':
+        if not args:
+            usage(2)
+        print_rows(['run', 'status', 'duration_secs', 'converge_secs'], conn.execute(
+            'SELECT run, status, duration_secs, converge_secs FROM validations WHERE validator = ? ORDER BY run DESC LIMIT ?', (args[0], limit)))
+    elif command == 'changes':
+        if not args:
+            usage(2)
+        # compare each run's hash with the previous run that has the section
+        changes = []
+        prev_hash = None
+        for run, digest in conn.execute('SELECT run, hash FROM sections WHERE key = ? ORDER BY run', (args[0],)):
+            if prev_hash is not None and digest != prev_hash:
+                changes.append((run, digest[:12]))
+            prev_hash = digest
+        print_rows(['run', 'hash'], list(reversed(changes))[:limit])
+    elif command == 'packages':
+        sql = 'SELECT run, name, change, old_version, new_version FROM package_changes'
+        params = []
+        if args:
+            sql += ' WHERE name = ?'
+            params.append(args[0])
+        print_rows(['run', 'name', 'change', 'old_version', 'new_version'], conn.execute(sql + ' ORDER BY run DESC, name LIMIT ?', params + [limit]))
+    else:
+        logging.error('unknown command {0}'.format(command))
+        usage(2)
+    return 0
+
+
+if __name__ == '__main__':
+
+    # default configuration options
+    arg_dict['usage'] = False
+    arg_dict['verbose'] = False
+    arg_dict['limit'] = 20
+
+    # call function to parse CLI arguments to override defaults
+    arg_dict = parse_args(arg_dict)
+
+    if arg_dict['usage'] or not arg_dict['args']:
+        usage(2)
+
+    # Setup logging options based on verbose setting
+    if arg_dict['verbose']:
+        setup_logging(log_file=None, log_file_level='debug', log_print_level='info')
+    else:
+        setup_logging(log_file=None, log_file_level='info', log_print_level='warn')
+
+    config = get_config(arg_dict.get('config_file'))
+    arg_dict.setdefault('db_file', config['history']['db_file'])
+
+    command = arg_dict['args'][0]
+    if command != 'reindex' and not os.path.exists(arg_dict['db_file']):
+        logging.error('{0} not found (run reindex to create it from existing run directories)'.format(arg_dict['db_file']))
+        sys.exit(1)
+
+    conn = open_db(arg_dict['db_file'])
+    if command == 'reindex':
+        data_dir = arg_dict['args'][1] if len(arg_dict['args']) > 1 else '/var/log/auto-patch'
+        reindex(conn, data_dir)
+        rc = 0
+    else:
+        rc = query(conn, command, arg_dict['args'][1:], arg_dict['limit'])
+    conn.close()
+    sys.exit(rc)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+# Export the state of the current auto-patch run as Prometheus metrics for node_exporter's textfile collector.
+# Called by cmds-save.py and verify.py and deployed as post_update.d/90-export-metrics.py.
+
+import sys
+import os
+import tempfile
+from time import mktime, strptime
+import getopt
+
+from common import *
+
+####################
+# Global variables #
+####################
+
+# Initialize arg_dict
+arg_dict = dict()
+
+PROM_FILE = 'auto_patch.prom'
+
+# name -> (type, help)
+METRICS = {
+    'auto_patch_last_run_timestamp_seconds': ('gauge', 'Start time of the last auto-patch run.'),
+    'auto_patch_phase_duration_seconds': ('gauge', 'Wall time of each phase of the last run (sum of its timed commands).'),
+    'auto_patch_step_duration_seconds': ('gauge', 'Wall time of each package manager step and hook runner of the last run.'),
+    'auto_patch_step_exit_code': ('gauge', 'Exit code of each package manager step and hook runner of the last run.'),
+    'auto_patch_packages_changed': ('gauge', 'Packages upgraded, added or removed by the last run.'),
+    'auto_patch_last_noop_timestamp_seconds': ('gauge', 'Time of the last run skipped because no updates were pending.'),
+    'auto_patch_reboot_required': ('gauge', '1 if /var/run/reboot-required exists.'),
+    'auto_patch_reboot_performed': ('gauge', '1 if the host booted after the last run started.'),
+    'auto_patch_reboot_avoided': ('gauge', '1 if the last run restarted services instead of rebooting.'),
+    'auto_patch_service_restart_seconds': ('gauge', 'Wall time of each service restart of the last run.'),
+    'auto_patch_service_restart_exit_code': ('gauge', 'Exit code of each service restart of the last run.'),
+    'auto_patch_verify_timestamp_seconds': ('gauge', 'Time the last verification report was written.'),
+    'auto_patch_verify_seconds_since_boot': ('gauge', 'Seconds from boot until the last verification report was written.'),
+    'auto_patch_verify_exit_code': ('gauge', 'Exit code of the last verification (0 = all validators passed).'),
+    'auto_patch_validator_success': ('gauge', '1 if the validator passed in the last verification.'),
+    'auto_patch_validator_duration_seconds': ('gauge', 'Duration of the validator in the last verification.'),
+    'auto_patch_validator_converge_seconds': ('gauge', 'Seconds until the validator passed in wait mode.'),
+}
+
+# Help message
+def usage(exit_code=0):
+    """ Display help message if -h option used or invalid syntax. """
+    print(os.path.basename(__file__) + ' [-d <textfile_dir>] [-r <run_dir>] [-c <config_file>] [-v]')
+    print("\t-d\tnode_exporter textfile collector directory (default from config file, export is disabled if not set)")
+    print("\t-r\trun directory (default ${0} or {1}/current)".format(RUN_DIR_ENV, DATA_DIR))
+    print("\t-c\tconfiguration file (default {0})".format(CONFIG_FILE))
+    print("\t-v\tverbose output")
+    sys.exit(exit_code)
+
+def parse_args(arg_dict):
+    # Parse CLI input #
+    try:
+        opts, _args = getopt.getopt(sys.argv[1:], "hvd:r:c:", ["help"])
+    except getopt.GetoptError as err:
+        logging.error(err)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-v':
+            arg_dict['verbose'] = True
+        elif opt == '-d':
+            arg_dict['textfile_dir'] = arg
+        elif opt == '-r':
+            arg_dict['run_dir'] = arg
+        elif opt == '-c':
+            arg_dict['config_file'] = arg
+        elif opt == '-h':
+            arg_dict['usage'] = True
+        elif opt == '--help':
+            arg_dict['usage'] = True
+    return arg_dict
+
+def get_boot_time():
+    """ Boot time in epoch seconds from /proc/stat (None if unknown) """
+    try:
+        with open('/proc/stat') as fh:
+            for line in fh:
+                if line.startswith('btime '):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+def get_run_start(run_dir, cmds_dict):
+    """ Start of the run from the snapshot collection time, else the run directory name (<datetime_stamp>) """
+    if cmds_dict is not None and 'collect_stats' in cmds_dict:
+        return cmds_dict['collect_stats'].get('time')
+    try:
+        return int(mktime(strptime(os.path.basename(run_dir), '%Y-%m-%d_%H%M%S')))
+    except ValueError:
+        return int(os.path.getmtime(run_dir))
+
+def get_package_changes(cmds_dict, cache=None):
+    """
+    Package changes since the snapshot, from a fresh read of the package database (before verify.py has run).
+    With a SectionCache the new package list is cached, so verify.py can reuse it after the reboot.
+    """
+    if cmds_dict is None or 'packages' not in cmds_dict:
+        return None
+    cmd_list = [cmd_spec for cmd_spec in get_cmd_list() if cmd_spec.get('key', cmd_spec['cmd']) == 'packages']
+    if not cmd_list:
+        return None
+    section = collect_cmd(cmd_list[0], cache=cache)[1]
+    if section['rc'] != 0:
+        return None
+    added, removed, changed = diff_sections({'packages': section}, cmds_dict, 'packages')
+    return {'upgraded': len(changed), 'added': len(added), 'removed': len(removed)}
+
+def format_labels(labels):
+    """ {name: value} -> {name="value",...} with Prometheus escaping """
+    if not labels:
+        return ''
+    escaped = []
+    for name in sorted(labels):
+        value = str(labels[name]).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('{0}="{1}"'.format(name, value))
+    return '{' + ','.join(escaped) + '}'
+
+def format_metrics(samples):
+    """ [(name, labels, value)] -> Prometheus text format (HELP/TYPE once per metric, None values skipped) """
+    lines = []
+    for name in METRICS:
+        metric_samples = [(labels, value) for sample_name, labels, value in samples if sample_name == name and value is not None]
+        if not metric_samples:
+            continue
+        lines.append('# HELP {0} {1}'.format(name, METRICS[name][1]))
+        lines.append('# TYPE {0} {1}'.format(name, METRICS[name][0]))
+        for labels, value in metric_samples:
+            lines.append('{0}{1} {2}'.format(name, format_labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+def get_metrics(run_dir, cache=None):
+    """ Collect samples for the run in run_dir from cmds.json, report.json, restart.json and timings.jsonl """
+    samples = []
+
+    cmds_dict = None
+    snapshot_file = find_snapshot_file(os.path.join(run_dir, 'cmds.json'))
+    if os.path.exists(snapshot_file):
+        cmds_dict = get_dict_from_file(snapshot_file)[0]
+    run_start = get_run_start(run_dir, cmds_dict)
+    samples.append(('auto_patch_last_run_timestamp_seconds', {}, run_start))
+
+    timings = summarize_timings(read_timings(os.path.join(run_dir, TIMINGS_FILE)))
+    for phase, totals in sorted(timings['phases'].items()):
+        samples.append(('auto_patch_phase_duration_seconds', {'phase': phase}, totals['wall_secs']))
+    for record in timings['records']:
+        if record.get('phase') == 'auto-patch':
+            samples.append(('auto_patch_step_duration_seconds', {'step': record.get('name')}, record.get('wall_secs')))
+            samples.append(('auto_patch_step_exit_code', {'step': record.get('name')}, record.get('rc')))
+
+    # Runs skipped by auto-patch.sh because nothing was pending don't change the current run directory
+    noop_dict = None
+    noop_file = os.path.join(DATA_DIR, NOOP_FILE)
+    if os.path.exists(noop_file):
+        noop_dict = get_dict_from_json_file(noop_file)[0]
+    if noop_dict is not None:
+        samples.append(('auto_patch_last_noop_timestamp_seconds', {}, noop_dict.get('time')))
+
+    boot_time = get_boot_time()
+    samples.append(('auto_patch_reboot_required', {}, int(os.path.exists(REBOOT_REQUIRED_FILE))))
+    if boot_time is not None and run_start is not None:
+        samples.append(('auto_patch_reboot_performed', {}, int(boot_time > run_start)))
+
+    # Services restarted by post_update.d/50-restart-services.py instead of a reboot
+    restart_file = os.path.join(run_dir, RESTART_FILE)
+    restart_dict = None
+    if os.path.exists(restart_file):
+        restart_dict = get_dict_from_json_file(restart_file)[0]
+    if restart_dict is not None:
+        samples.append(('auto_patch_reboot_avoided', {}, int(bool(restart_dict.get('reboot_avoided')))))
+        for unit, entry in sorted(restart_dict.get('units', {}).items()):
+            if 'rc' in entry:
+                samples.append(('auto_patch_service_restart_seconds', {'unit': unit}, entry.get('wall_secs')))
+                samples.append(('auto_patch_service_restart_exit_code', {'unit': unit}, entry['rc']))
+
+    # After verification the report has package changes and validator results, before it the package database is compared to the snapshot
+    report_file = os.path.join(run_dir, 'report.json')
+    report_dict = None
+    if os.path.exists(report_file):
+        report_dict = get_dict_from_json_file(report_file)[0]
+    if report_dict is not None and 'packages' in report_dict and 'upgraded' in report_dict['packages']:
+        changes = dict((change, len(report_dict['packages'][change])) for change in ('upgraded', 'added', 'removed'))
+    else:
+        changes = get_package_changes(cmds_dict, cache)
+    for change, count in sorted((changes or {}).items()):
+        samples.append(('auto_patch_packages_changed', {'change': change}, count))
+
+    if report_dict is not None:
+        report_time = int(os.path.getmtime(report_file))
+        samples.append(('auto_patch_verify_timestamp_seconds', {}, report_time))
+        if boot_time is not None and report_time >= boot_time:
+            samples.append(('auto_patch_verify_seconds_since_boot', {}, report_time - boot_time))
+        samples.append(('auto_patch_verify_exit_code', {}, report_dict.get('exit')))
+        for key, entry in report_dict.items():
+            if not isinstance(entry, dict) or 'status' not in entry:
+                continue
+            labels = {'validator': entry.get('validator', key), 'key': key}
+            samples.append(('auto_patch_validator_success', labels, int(entry['status'] == 'success')))
+            samples.append(('auto_patch_validator_duration_seconds', labels, entry.get('duration_secs')))
+            samples.append(('auto_patch_validator_converge_seconds', labels, entry.get('converge_secs')))
+    return samples
+
+def write_prom_file(text, textfile_dir):
+    """ Write the metrics atomically (node_exporter only reads *.prom files, so the temporary file is never scraped) """
+    prom_file = os.path.join(textfile_dir, PROM_FILE)
+    fd, tmp_file = tempfile.mkstemp(prefix='.' + PROM_FILE + '.', dir=textfile_dir)
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(text)
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, prom_file)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+    return prom_file
+
+def export_metrics(textfile_dir, run_dir=None, cache=None):
+    """ Export metrics for the current run when textfile_dir is set (errors are logged, never raised) """
+    if not textfile_dir:
+        return None
+    try:
+        if run_dir is None:
+            run_dir = get_run_dir()
+        if run_dir is None:
+            logging.warning('export_metrics: no run directory found')
+            return None
+        prom_file = write_prom_file(format_metrics(get_metrics(run_dir, cache)), textfile_dir)
+        logging.info('export_metrics: wrote {0}'.format(prom_file))
+        return prom_file
+    except Exception as err:
+        logging.warning('export_metrics: {0}: {1}'.format(type(err).__name__, err))
+        return None
+
+
+if __name__ == '__main__':
+
+    # default configuration options
+    arg_dict['usage'] = False
+    arg_dict['verbose'] = False
+
+    # call function to parse CLI arguments to override defaults
+    arg_dict = parse_args(arg_dict)
+
+    if arg_dict['usage']:
+        usage(2)
+
+    # Setup logging options based on verbose setting
+    if arg_dict['verbose']:
+        setup_logging(log_file=None, log_file_level='debug', log_print_level='info')
+    else:
+        setup_logging(log_file=None, log_file_level='info', log_print_level='warn')
+
+    config = get_config(arg_dict.get('config_file'))
+    arg_dict.setdefault('textfile_dir', config['metrics']['textfile_dir'])
+    if not arg_dict['textfile_dir']:
+        logging.info('metrics export is disabled (textfile_dir is not set)')
+        sys.exit(0)
+
+    prom_file = export_metrics(arg_dict['textfile_dir'], arg_dict.get('run_dir'), cache=get_section_cache(config))
+    sys.exit(0 if prom_file else 1)
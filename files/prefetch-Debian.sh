@@ -0,0 +1,34 @@
+#!/bin/bash
+
+# This file is managed by Ansible. See roles/auto_patch/files/prefetch-Debian.sh
+
+# Download pending updates ahead of the maintenance window (auto-patch.sh then installs them from the local cache).
+# Runs from its own cron entry hours before auto-patch.sh with a bandwidth limit and low CPU/IO priority.
+
+# Ensure running from directory of script
+BASEDIR=$(dirname "$0")
+cd $BASEDIR
+
+# conf_get <section> <key>: value from auto-patch.conf
+conf_get() {
+  awk -F= -v s="[$1]" -v k="$2" '$0 == s {f=1; next} /^\[/ {f=0} f && $1 ~ "^ *"k" *$" {gsub(/[ "\047]/, "", $2); print $2; exit}' ./auto-patch.conf 2>/dev/null
+}
+
+# Freshness stamp read by auto-patch.sh (removed first so a failed prefetch never looks fresh)
+STAMP=/var/log/auto-patch/prefetch.stamp
+rm -f $STAMP
+
+# Bandwidth limit in KB/s (0 = no limit)
+LIMIT=$(conf_get prefetch bandwidth_kbps)
+APT_OPTS=""
+if [[ ${LIMIT:-0} -gt 0 ]]; then
+  APT_OPTS="-o Acquire::http::Dl-Limit=${LIMIT} -o Acquire::https::Dl-Limit=${LIMIT}"
+fi
+
+echo "prefetch: `date`"
+nice -n 19 ionice -c 3 /usr/bin/apt-get $APT_OPTS -q update || exit 1
+nice -n 19 ionice -c 3 /usr/bin/apt-get $APT_OPTS -q=2 --download-only upgrade || exit 1
+date +%s > $STAMP
+echo "prefetch: done `date`"
+
+exit 0
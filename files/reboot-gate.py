@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+
+# Reboot gate: a semaphore allowing at most max_concurrent hosts of a group to reboot at the same time.
+# 99-reboot.sh acquires a slot before rebooting and verify-reboot.sh releases it once verification passed.
+# Slots are leases that expire after lease_secs, so a host that never comes back can't hold its slot forever.
+# Backends:
+#   dir   lease files <lock_dir>/<group>/slot-<n>.lease on a filesystem shared by the group (e.g. NFS)
+#   http  a lock service at url (reboot-gate.py serve is a minimal in-memory implementation):
+#         POST <url>/<group>/acquire {"holder", "max", "lease_secs"} -> 200 (granted) or 409 {"holders"}
+#         POST <url>/<group>/release {"holder"} -> 200,  GET <url>/<group> -> 200 {"holders": {holder: expires}}
+
+import sys
+import os
+import json
+import random
+import socket
+import threading
+from time import time, sleep, monotonic, strftime, localtime
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+import getopt
+
+from common import *
+
+####################
+# Global variables #
+####################
+
+# Initialize arg_dict
+arg_dict = dict()
+
+ACTIONS = ('acquire', 'release', 'status', 'serve')
+BACKENDS = ('dir', 'http')
+HTTP_TIMEOUT = 10
+
+# Help message
+def usage(exit_code=0):
+    """ Display help message if -h option used or invalid syntax. """
+    print(os.path.basename(__file__) + ' [-w <wait_secs>] [-c <config_file>] [-v] acquire|release|status')
+    print(os.path.basename(__file__) + ' [-b <address>] [-p <port>] [-v] serve')
+    print("\tacquire\twait for a reboot slot (exit 0 when granted or the gate is disabled, 1 when not granted in time)")
+    print("\trelease\trelease the slot of this host")
+    print("\tstatus\tlist the current slot holders of the group")
+    print("\tserve\trun a minimal HTTP lock service (leases are kept in memory)")
+    print("\t-w\tseconds to wait for a slot (default from config file or 1200)")
+    print("\t-b\taddress the lock service listens on (default 127.0.0.1)")
+    print("\t-p\tport the lock service listens on (default 8765)")
+    print("\t-c\tconfiguration file (default {0})".format(CONFIG_FILE))
+    print("\t-v\tverbose output")
+    sys.exit(exit_code)
+
+def parse_args(arg_dict):
+    # Parse CLI input #
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hvw:b:p:c:", ["help"])
+    except getopt.GetoptError as err:
+        logging.error(err)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-v':
+            arg_dict['verbose'] = True
+        elif opt == '-w':
+            arg_dict['wait_secs'] = int(arg)
+        elif opt == '-b':
+            arg_dict['address'] = arg
+        elif opt == '-p':
+            arg_dict['port'] = int(arg)
+        elif opt == '-c':
+            arg_dict['config_file'] = arg
+        elif opt == '-h':
+            arg_dict['usage'] = True
+        elif opt == '--help':
+            arg_dict['usage'] = True
+    arg_dict['args'] = args
+    return arg_dict
+
+class DirBackend(object):
+    """
+    Slots are lease files <lock_dir>/<group>/slot-<n>.lease created with O_EXCL (atomic on local filesystems and NFSv3+).
+    An expired lease is renamed to a name unique to the caller before it is removed, so only one host breaks it.
+    Leases are identified by inode and mtime, so empty or corrupt leases (the holder crashed before writing) are
+    broken like any other once they expire lease_secs after their mtime.
+    """
+
+    def __init__(self, lock_dir, group):
+        if not lock_dir:
+            raise ValueError('lock_dir is not set in the [reboot_gate] section')
+        self.group_dir = os.path.join(lock_dir, group)
+
+    def get_slot_file(self, slot):
+        return os.path.join(self.group_dir, 'slot-{0}.lease'.format(slot))
+
+    def get_identity(self, path):
+        """ (inode, mtime) of path or None (kept by rename, changed when the lease is replaced or refreshed) """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns)
+
+    def read_lease(self, path, lease_secs):
+        """
+        (identity, lease) of path or (None, None).  The identity is taken before the lease is read, so a lease
+        replaced in between never gets the identity of the expired one.  An unreadable lease (still being written
+        or left empty by a crash) expires lease_secs after its mtime.
+        """
+        identity = self.get_identity(path)
+        if identity is None:
+            return None, None
+        try:
+            with open(path) as fh:
+                return identity, json.load(fh)
+        except FileNotFoundError:
+            return None, None
+        except (IOError, OSError, ValueError):
+            return identity, {'holder': None, 'expires': identity[1] / 1e9 + lease_secs}
+
+    def write_lease(self, path, holder, lease_secs, exclusive=True):
+        """ Create the lease file (exclusive) or replace it (refresh of our own lease) """
+        lease = {'holder': holder, 'acquired': int(time()), 'expires': int(time()) + lease_secs}
+        if exclusive:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        else:
+            tmp_file = '{0}.{1}.tmp'.format(path, holder)
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(lease, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        if not exclusive:
+            os.replace(tmp_file, path)
+        return lease
+
+    def remove_lease(self, path, identity, holder):
+        """ Remove path if it is still the lease file with identity (another host may have replaced it since) """
+        moved = '{0}.{1}.{2}.stale'.format(path, holder, os.getpid())
+        try:
+            os.rename(path, moved)
+        except FileNotFoundError:
+            return False
+        if self.get_identity(moved) != identity:
+            # a new lease was created in the meantime, put it back unless the slot was taken again
+            try:
+                os.link(moved, path)
+            except OSError:
+                pass
+            os.unlink(moved)
+            return False
+        os.unlink(moved)
+        return True
+
+    def get_holders(self, max_concurrent, lease_secs):
+        """ holder -> (slot file, lease) of the unexpired leases """
+        holders = dict()
+        now = time()
+        for slot in range(max_concurrent):
+            path = self.get_slot_file(slot)
+            _identity, lease = self.read_lease(path, lease_secs)
+            if lease is not None and lease['expires'] > now:
+                holders[lease['holder']] = (path, lease)
+        return holders
+
+    def acquire(self, holder, max_concurrent, lease_secs):
+        """ Take a free or expired slot (or refresh the slot already held) and return True if granted """
+        os.makedirs(self.group_dir, exist_ok=True)
+        holders = self.get_holders(max_concurrent, lease_secs)
+        if holder in holders:
+            self.write_lease(holders[holder][0], holder, lease_secs, exclusive=False)
+            return True
+        for slot in range(max_concurrent):
+            path = self.get_slot_file(slot)
+            identity, lease = self.read_lease(path, lease_secs)
+            if lease is not None:
+                if lease['expires'] > time():
+                    continue
+                logging.info('reboot gate: lease of {0} on {1} expired, breaking it'.format(lease['holder'], path))
+                self.remove_lease(path, identity, holder)
+            try:
+                self.write_lease(path, holder, lease_secs)
+                return True
+            except FileExistsError:
+                continue
+        return False
+
+    def release(self, holder, max_concurrent, lease_secs):
+        released = False
+        for slot in range(max_concurrent):
+            path = self.get_slot_file(slot)
+            identity, lease = self.read_lease(path, lease_secs)
+            if lease is not None and lease['holder'] == holder:
+                released = self.remove_lease(path, identity, holder) or released
+        return released
+
+    def status(self, max_concurrent, lease_secs):
+        return dict((holder, lease['expires']) for holder, (path, lease) in self.get_holders(max_concurrent, lease_secs).items())
+
+class HttpBackend(object):
+    """ Client of the HTTP lock service (the service owns the clock, so hosts don't need synchronized clocks) """
+
+    def __init__(self, url, group):
+        self.url = url.rstrip('/') + '/' + group
+
+    def request(self, path='', data=None):
+        """ (status, response dict) of a GET (data None) or JSON POST """
+        body = None if data is None else json.dumps(data).encode('utf-8')
+        req = Request(self.url + path, data=body, headers={'Content-Type': 'application/json'})
+        try:
+            with urlopen(req, timeout=HTTP_TIMEOUT) as resp:
+                return resp.status, json.loads(resp.read().decode('utf-8'))
+        except HTTPError as err:
+            return err.code, json.loads(err.read().decode('utf-8') or '{}')
+
+    def acquire(self, holder, max_concurrent, lease_secs):
+        status, response = self.request('/acquire', {'holder': holder, 'max': max_concurrent, 'lease_secs': lease_secs})
+        if status not in (200, 409):
+            raise IOError('lock service returned {0}: {1}'.format(status, response))
+        return bool(response.get('granted'))
+
+    def release(self, holder, max_concurrent, lease_secs):
+        return bool(self.request('/release', {'holder': holder})[1].get('released'))
+
+    def status(self, max_concurrent, lease_secs):
+        return self.request()[1].get('holders', {})
+
+def get_backend(config):
+    """ Backend selected in the [reboot_gate] section """
+    gate = config['reboot_gate']
+    if gate['backend'] == 'dir':
+        return DirBackend(gate['lock_dir'], gate['group'])
+    if gate['backend'] == 'http':
+        return HttpBackend(gate['url'], gate['group'])
+    raise ValueError('invalid reboot gate backend {0} (choices: {1})'.format(gate['backend'], ', '.join(BACKENDS)))
+
+def wait_for_slot(backend, holder, max_concurrent, lease_secs, wait_secs, poll_interval):
+    """
+    Poll backend until a slot is granted or wait_secs pass and return True if granted.
+    Polls are jittered so the hosts of a cron slot don't retry in lockstep, backend errors are retried.
+    """
+    start = monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            if backend.acquire(holder, max_concurrent, lease_secs):
+                logging.info('reboot gate: slot granted to {0} after {1:.1f}s ({2} attempts)'.format(holder, monotonic() - start, attempt))
+                return True
+            logging.info('reboot gate: all {0} slots taken: {1}'.format(max_concurrent, ', '.join(sorted(backend.status(max_concurrent, lease_secs)))))
+        except (IOError, OSError, URLError, ValueError) as err:
+            logging.warning('reboot gate: {0}'.format(err))
+        remaining = wait_secs - (monotonic() - start)
+        if remaining <= 0:
+            logging.warning('reboot gate: no slot granted to {0} within {1}s ({2} attempts)'.format(holder, wait_secs, attempt))
+            return False
+        sleep(min(remaining, poll_interval * random.uniform(0.5, 1.5)))
+
+class LockServer(ThreadingMixIn, HTTPServer):
+    """ Minimal HTTP lock service, leases are lost when it restarts (hosts then re-acquire) """
+    daemon_threads = True
+
+    def __init__(self, server_address):
+        HTTPServer.__init__(self, server_address, LockHandler)
+        self.leases = dict()  # group -> {holder: expires}
+        self.lock = threading.Lock()
+
+    def get_holders(self, group):
+        now = time()
+        holders = self.leases.setdefault(group, {})
+        for holder in [holder for holder, expires in holders.items() if expires <= now]:
+            logging.info('{0}: lease of {1} expired'.format(group, holder))
+            del holders[holder]
+        return holders
+
+class LockHandler(BaseHTTPRequestHandler):
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logging.debug('{0} {1}'.format(self.address_string(), fmt % args))
+
+    def do_GET(self):
+        group = self.path.strip('/')
+        with self.server.lock:
+            self.send_json(200, {'holders': dict(self.server.get_holders(group))})
+
+    def do_POST(self):
+        group, _sep, action = self.path.strip('/').rpartition('/')
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            holder = request['holder']
+        except (ValueError, KeyError):
+            self.send_json(400, {'error': 'invalid request'})
+            return
+        with self.server.lock:
+            holders = self.server.get_holders(group)
+            if action == 'acquire':
+                if holder in holders or len(holders) < int(request.get('max', 1)):
+                    holders[holder] = time() + int(request.get('lease_secs', 3600))
+                    logging.info('{0}: slot granted to {1}'.format(group, holder))
+                    self.send_json(200, {'granted': True, 'holders': holders})
+                else:
+                    self.send_json(409, {'granted': False, 'holders': holders})
+            elif action == 'release':
+                released = holders.pop(holder, None) is not None
+                if released:
+                    logging.info('{0}: slot released by {1}'.format(group, holder))
+                self.send_json(200, {'released': released})
+            else:
+                self.send_json(404, {'error': 'unknown action {0}'.format(action)})
+
+
+if __name__ == '__main__':
+
+    # default configuration options
+    arg_dict['usage'] = False
+    arg_dict['verbose'] = False
+    arg_dict['address'] = '127.0.0.1'
+    arg_dict['port'] = 8765
+
+    # call function to parse CLI arguments to override defaults
+    arg_dict = parse_args(arg_dict)
+
+    if arg_dict['usage'] or len(arg_dict['args']) != 1 or arg_dict['args'][0] not in ACTIONS:
+        usage(2)
+    action = arg_dict['args'][0]
+
+    # Setup logging options based on verbose setting
+    if arg_dict['verbose']:
+        setup_logging(log_file=None, log_file_level='debug', log_print_level='info')
+    else:
+        setup_logging(log_file=None, log_file_level='info', log_print_level='warn' if action != 'serve' else 'info')
+
+    if action == 'serve':
+        server = LockServer((arg_dict['address'], arg_dict['port']))
+        logging.info('lock service listening on {0}:{1}'.format(arg_dict['address'], arg_dict['port']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    # configuration file settings apply unless overridden by CLI (the gate is disabled by default)
+    config = get_config(arg_dict.get('config_file'))
+    gate = config['reboot_gate']
+    if not config_bool(gate['enabled']):
+        logging.info('reboot gate is disabled (enabled is not set in the [reboot_gate] section)')
+        sys.exit(0)
+    arg_dict.setdefault('wait_secs', int(gate['wait_secs']))
+    holder = gate['holder'] or socket.gethostname()
+    max_concurrent = max(int(gate['max_concurrent']), 1)
+    lease_secs = int(gate['lease_secs'])
+    try:
+        backend = get_backend(config)
+    except ValueError as err:
+        logging.error(err)
+        sys.exit(2)
+
+    if action == 'acquire':
+        granted = wait_for_slot(backend, holder, max_concurrent, lease_secs, arg_dict['wait_secs'], int(gate['poll_interval']))
+        sys.exit(0 if granted else 1)
+    try:
+        if action == 'release':
+            released = backend.release(holder, max_concurrent, lease_secs)
+            logging.info('reboot gate: slot of {0} {1}'.format(holder, 'released' if released else 'not held'))
+        else:
+            for slot_holder, expires in sorted(backend.status(max_concurrent, lease_secs).items()):
+                print('{0}\texpires {1}'.format(slot_holder, strftime('%Y-%m-%d %H:%M:%S', localtime(expires))))
+    except (IOError, OSError, URLError, ValueError) as err:
+        logging.error('reboot gate: {0}'.format(err))
+        sys.exit(1)
+    sys.exit(0)
@@ -1,10 +1,16 @@
 #!/bin/sh
 
 if [ -e "/var/run/reboot-required" ]; then
+    # Wait for a slot in the reboot gate (returns right away when the gate is disabled in auto-patch.conf),
+    # the slot is released by verify-reboot.sh once verification passed
+    if ! python3 "$(dirname "$0")/../reboot-gate.py" acquire; then
+        echo "auto-patch: no reboot slot granted, reboot postponed to the next scheduled run"
+        exit 1
+    fi
     echo "auto-patch: rebooting"
     sync; sync; sync
     sleep 5
     /sbin/reboot
 else
     echo "auto-patch: no reboot is required"
-fi
\ No newline at end of file
+fi
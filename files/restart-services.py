@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+# Restart the systemd services still running deleted (replaced) shared objects after updates instead of rebooting.
+# Deployed as post_update.d/50-restart-services.py (after the reboot-required detection, before 99-reboot.sh).
+# A reboot is kept for kernel and glibc updates, packages in reboot-required.pkgs that are not in restart_pkgs,
+# services that can't be restarted and failed restarts.
+# Otherwise /var/run/reboot-required is renamed to reboot-required.avoided so 99-reboot.sh doesn't reboot.
+
+import sys
+import os
+import re
+from fnmatch import fnmatchcase
+from time import time, monotonic, strftime
+from concurrent.futures import ThreadPoolExecutor
+import getopt
+
+from common import *
+
+####################
+# Global variables #
+####################
+
+# Initialize arg_dict
+arg_dict = dict()
+
+REBOOT_REQUIRED_PKGS_FILE = REBOOT_REQUIRED_FILE + '.pkgs'
+REBOOT_AVOIDED_SUFFIX = '.avoided'
+
+# Mapped files that count as code (executables and shared objects), data files such as caches are ignored
+CODE_PREFIXES = ('/usr/', '/lib', '/bin/', '/sbin/', '/opt/')
+# glibc's loader and libraries are mapped by every process, an update needs a reboot
+RE_GLIBC = re.compile(r'^(libc|ld|ld-linux[\w.-]*|libpthread|libdl|librt|libm)([-.]\d|\.so)')
+# Kernel and glibc updates recorded in /var/run/reboot-required by the RHEL detection script
+RE_REBOOT_TAGS = re.compile(r'\[(KERNEL|GLIBC)\]')
+
+# Help message
+def usage(exit_code=0):
+    """ Display help message if -h option used or invalid syntax. """
+    print(os.path.basename(__file__) + ' [-n] [-j <workers>] [-c <config_file>] [-v]')
+    print("\t-n\tdry run (report what would be restarted without restarting or changing {0})".format(REBOOT_REQUIRED_FILE))
+    print("\t-j\tnumber of processes scanned concurrently (default from config file or 8)")
+    print("\t-c\tconfiguration file (default {0})".format(CONFIG_FILE))
+    print("\t-v\tverbose output")
+    sys.exit(exit_code)
+
+def parse_args(arg_dict):
+    # Parse CLI input #
+    try:
+        opts, _args = getopt.getopt(sys.argv[1:], "hvnj:c:", ["help"])
+    except getopt.GetoptError as err:
+        logging.error(err)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-v':
+            arg_dict['verbose'] = True
+        elif opt == '-n':
+            arg_dict['dry_run'] = True
+        elif opt == '-j':
+            arg_dict['workers'] = int(arg)
+        elif opt == '-c':
+            arg_dict['config_file'] = arg
+        elif opt == '-h':
+            arg_dict['usage'] = True
+        elif opt == '--help':
+            arg_dict['usage'] = True
+    return arg_dict
+
+def get_deleted_objects(pid):
+    """ Deleted executables and shared objects mapped by pid (replaced files are unlinked, so they show as deleted) """
+    objects = set()
+    try:
+        with open('/proc/{0}/maps'.format(pid)) as fh:
+            for line in fh:
+                if not line.endswith(' (deleted)\n'):
+                    continue
+                fields = line.split(None, 5)
+                if len(fields) < 6:
+                    continue
+                path = fields[5][:-len(' (deleted)\n')]
+                if path.startswith(CODE_PREFIXES) and ('x' in fields[1] or '.so' in os.path.basename(path)):
+                    objects.add(path)
+    except (IOError, OSError):
+        pass  # process exited or kernel thread
+    return objects
+
+def get_unit(pid):
+    """ systemd service of pid from its cgroup (None for sessions, scopes and processes outside system.slice) """
+    try:
+        with open('/proc/{0}/cgroup'.format(pid)) as fh:
+            cgroups = fh.read().split('\n')
+    except (IOError, OSError):
+        return None
+    for line in cgroups:
+        fields = line.split(':', 2)
+        # cgroup v2 (0::<path>) or the v1 systemd hierarchy (N:name=systemd:<path>)
+        if len(fields) != 3 or fields[1] not in ('', 'name=systemd'):
+            continue
+        for part in reversed(fields[2].split('/')):
+            if part.endswith('.service'):
+                return part if '/system.slice/' in fields[2] + '/' else None
+            if part.endswith('.scope'):
+                return None
+    return None
+
+def get_comm(pid):
+    try:
+        with open('/proc/{0}/comm'.format(pid)) as fh:
+            return fh.read().strip()
+    except (IOError, OSError):
+        return ''
+
+def get_ancestors(pid):
+    """ pid and its parent pids (processes of this run must not be restarted) """
+    pids = []
+    while pid > 1:
+        pids.append(pid)
+        try:
+            with open('/proc/{0}/stat'.format(pid)) as fh:
+                stat = fh.read()
+            pid = int(stat[stat.rindex(')') + 2:].split()[1])
+        except (IOError, OSError, ValueError, IndexError):
+            break
+    return pids
+
+def scan_processes(workers=8):
+    """ pid -> sorted deleted objects for every process mapping deleted code (scanned in a thread pool) """
+    pids = [int(d) for d in os.listdir('/proc') if d.isdigit()]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = executor.map(get_deleted_objects, pids)
+        return dict((pid, sorted(objects)) for pid, objects in zip(pids, results) if objects)
+
+def get_reboot_reasons(affected, restart_pkgs=()):
+    """
+    Reasons a reboot is still needed: kernel or glibc updates, packages in reboot-required.pkgs that don't match a
+    restart_pkgs pattern (packages known to be handled by restarting their services), a reboot-required without
+    a package list (the reason is unknown) and glibc or pid 1 mapping replaced objects
+    """
+    reasons = []
+    try:
+        with open(REBOOT_REQUIRED_FILE) as fh:
+            tags = sorted(set(RE_REBOOT_TAGS.findall(fh.read())))
+    except (IOError, OSError):
+        tags = None  # the updates didn't request a reboot
+    if tags is not None:
+        for tag in tags:
+            reasons.append('{0} updated'.format('kernel' if tag == 'KERNEL' else 'glibc'))
+        try:
+            with open(REBOOT_REQUIRED_PKGS_FILE) as fh:
+                pkgs = sorted(set(line.strip() for line in fh if line.strip()))
+        except (IOError, OSError):
+            pkgs = []
+        if not tags and not pkgs:
+            reasons.append('{0} exists without a package list'.format(REBOOT_REQUIRED_FILE))
+        for pkg in pkgs:
+            if not any(fnmatchcase(pkg, pattern) for pattern in restart_pkgs):
+                reasons.append('{0} updated'.format(pkg))
+    glibc = sorted(set(path for objects in affected.values() for path in objects if RE_GLIBC.match(os.path.basename(path))))
+    if glibc:
+        reasons.append('glibc replaced: ' + ', '.join(glibc))
+    if 1 in affected:
+        reasons.append('systemd (pid 1) maps replaced objects: ' + ', '.join(affected[1]))
+    return reasons
+
+def restart_unit(unit, timeout):
+    """ systemctl restart unit and return (rc, wall_secs, stderr) """
+    stats = {}
+    rc, _stdout, stderr = get_cmd3('systemctl restart {0}'.format(unit), timeout=timeout, stats=stats)
+    return rc, stats.get('wall_secs'), stderr.strip()
+
+def avoid_reboot():
+    """ Rename reboot-required (and .pkgs) so 99-reboot.sh doesn't reboot, the reasons are kept for reference """
+    for path in (REBOOT_REQUIRED_FILE, REBOOT_REQUIRED_PKGS_FILE):
+        if os.path.exists(path):
+            os.replace(path, path + REBOOT_AVOIDED_SUFFIX)
+
+def require_reboot(reasons):
+    """ Make sure 99-reboot.sh reboots (e.g. when glibc was replaced on a distribution that doesn't flag it) """
+    if not os.path.exists(REBOOT_REQUIRED_FILE):
+        with open(REBOOT_REQUIRED_FILE, 'a') as fh:
+            for reason in reasons:
+                fh.write('{0}: [RESTART] {1}\n'.format(strftime('%c'), reason))
+
+def restart_services(exclude=(), restart_pkgs=(), workers=8, timeout=120, dry_run=False):
+    """
+    Scan for processes mapping deleted code, restart their services unless a reboot is needed anyway and return
+    the report saved in restart.json (reboot, reasons, units with pids, objects, rc and wall_secs, unmanaged pids).
+    """
+    report = {'time': int(time()), 'dry_run': dry_run, 'reboot': False, 'reasons': [], 'units': {}, 'unmanaged': {}}
+    start = monotonic()
+    affected = scan_processes(workers)
+    report['scan_secs'] = round(monotonic() - start, 3)
+    own = set(get_ancestors(os.getpid()))
+    own_units = set(get_unit(pid) for pid in own) - set([None])
+
+    for pid, objects in sorted(affected.items()):
+        if pid in own:
+            continue
+        unit = get_unit(pid)
+        if unit is None:
+            # user sessions and scopes can't be restarted, they pick up new libraries when restarted by their owners
+            report['unmanaged'][str(pid)] = {'comm': get_comm(pid), 'objects': objects}
+            continue
+        entry = report['units'].setdefault(unit, {'pids': [], 'objects': []})
+        entry['pids'].append(pid)
+        entry['objects'] = sorted(set(entry['objects']) | set(objects))
+
+    report['reasons'] = get_reboot_reasons(affected, restart_pkgs)
+    for unit in sorted(report['units']):
+        if unit in exclude or unit in own_units:
+            report['units'][unit]['skipped'] = 'excluded' if unit in exclude else 'runs auto-patch'
+            if unit in exclude:
+                report['reasons'].append('{0} needs a restart but is excluded'.format(unit))
+
+    if report['reasons']:
+        # the reboot restarts everything, restarting services first would only add downtime
+        report['reboot'] = True
+        logging.info('restart_services: reboot needed: {0}'.format('; '.join(report['reasons'])))
+        if not dry_run:
+            require_reboot(report['reasons'])
+        report['restart_secs'] = 0.0
+        return report
+
+    start = monotonic()
+    for unit, entry in sorted(report['units'].items()):
+        if 'skipped' in entry:
+            continue
+        if dry_run:
+            logging.info('restart_services: would restart {0} (pids {1})'.format(unit, ', '.join(str(pid) for pid in entry['pids'])))
+            continue
+        entry['rc'], entry['wall_secs'], stderr = restart_unit(unit, timeout)
+        if entry['rc'] != 0:
+            entry['stderr'] = stderr
+            report['reasons'].append('restart of {0} failed (rc={1})'.format(unit, entry['rc']))
+        logging.info('restart_services: restarted {0} in {1}s, rc={2}'.format(unit, entry['wall_secs'], entry['rc']))
+    report['restart_secs'] = round(monotonic() - start, 3)
+
+    if report['reasons']:
+        report['reboot'] = True
+        if not dry_run:
+            require_reboot(report['reasons'])
+    elif not dry_run:
+        report['reboot_avoided'] = os.path.exists(REBOOT_REQUIRED_FILE)
+        avoid_reboot()
+    return report
+
+def print_report(report):
+    for unit, entry in sorted(report['units'].items()):
+        if 'skipped' in entry:
+            print('{0}: skipped ({1})'.format(unit, entry['skipped']))
+        elif 'rc' in entry:
+            print('{0}: restarted in {1}s, rc={2}'.format(unit, entry['wall_secs'], entry['rc']))
+        else:
+            print('{0}: {1}'.format(unit, 'needs restart' if report['dry_run'] or report['reboot'] else 'not restarted'))
+    for pid, entry in sorted(report['unmanaged'].items(), key=lambda item: int(item[0])):
+        print('pid {0} ({1}): not part of a service, restart it manually'.format(pid, entry['comm']))
+    if report['reboot']:
+        print('auto-patch: reboot required: {0}'.format('; '.join(report['reasons'])))
+    elif report.get('reboot_avoided'):
+        print('auto-patch: services restarted, reboot avoided')
+
+
+if __name__ == '__main__':
+
+    # default configuration options
+    arg_dict['usage'] = False
+    arg_dict['verbose'] = False
+    arg_dict['dry_run'] = False
+
+    # call function to parse CLI arguments to override defaults
+    arg_dict = parse_args(arg_dict)
+
+    if arg_dict['usage']:
+        usage(2)
+
+    # Setup logging options based on verbose setting
+    if arg_dict['verbose']:
+        setup_logging(log_file=None, log_file_level='debug', log_print_level='info')
+    else:
+        setup_logging(log_file=None, log_file_level='info', log_print_level='warn')
+
+    # configuration file settings apply unless overridden by CLI (the analyzer is disabled by default)
+    config = get_config(arg_dict.get('config_file'))
+    if not config_bool(config['restart']['enabled']) and not arg_dict['dry_run']:
+        logging.info('service restarts are disabled (enabled is not set in the [restart] section)')
+        sys.exit(0)
+    arg_dict.setdefault('workers', int(config['restart']['workers']))
+    exclude = [unit.strip() for unit in config['restart']['exclude'].split(',') if unit.strip()]
+    restart_pkgs = [pkg.strip() for pkg in config['restart']['restart_pkgs'].split(',') if pkg.strip()]
+
+    report = restart_services(exclude=exclude, restart_pkgs=restart_pkgs, workers=arg_dict['workers'], timeout=int(config['restart']['timeout']),
+                              dry_run=arg_dict['dry_run'])
+    print_report(report)
+
+    # Save the report and the restart timings in the run directory
+    run_dir = get_run_dir()
+    if run_dir is not None and not arg_dict['dry_run']:
+        save_dict_to_file(report, os.path.join(run_dir, RESTART_FILE), fmt='json')
+        records = [{'time': report['time'], 'phase': 'restart', 'name': unit, 'rc': entry['rc'], 'wall_secs': entry['wall_secs']}
+                   for unit, entry in sorted(report['units'].items()) if 'rc' in entry]
+        append_timings(records, os.path.join(run_dir, TIMINGS_FILE))
+    sys.exit(0)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+# Run the executable hooks in a *.d directory (pre_update.d, post_update.d, post_reboot.d).
+# Hooks run in name order.  Consecutive hooks sharing a numeric prefix (e.g. 10-cmds-cleanup.sh and 10-cmds-save.py)
+# form a group that runs in parallel, and each group starts after the previous group has finished.
+# Output is printed line by line as it arrives, prefixed with [<hook name>], and saved in the run directory.
+
+import sys
+import os
+import re
+import signal
+import threading
+from time import time, monotonic
+from concurrent.futures import ThreadPoolExecutor
+import getopt
+
+from common import *
+
+####################
+# Global variables #
+####################
+
+# Initialize arg_dict
+arg_dict = dict()
+
+# Hooks still running (killed when the runner is terminated, e.g. by the cron timeout)
+running = set()
+running_lock = threading.Lock()
+terminated = []
+
+# Lines of hooks running in parallel are printed whole
+print_lock = threading.Lock()
+# Seconds to wait for the rest of a hook's output after it exited (children that daemonized may keep the pipe open)
+STREAM_JOIN_SECS = 5
+
+# Help message
+def usage(exit_code=0):
+    """ Display help message if -h option used or invalid syntax. """
+    print(os.path.basename(__file__) + ' [-t <timeout>] [-j <workers>] [-c <config_file>] [-v] <hook_dir>')
+    print("\t-t\tdefault timeout in seconds for each hook, 0 for none (default from config file or 0)")
+    print("\t\tper-hook timeouts are set in the [hook_timeouts] section of the config file (<hook name> = <seconds>)")
+    print("\t-j\tmaximum number of hooks of a group run in parallel (default from config file or 8)")
+    print("\t-c\tconfiguration file (default {0})".format(CONFIG_FILE))
+    print("\t-v\tverbose output")
+    sys.exit(exit_code)
+
+def parse_args(arg_dict):
+    # Parse CLI input #
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hvt:j:c:", ["help"])
+    except getopt.GetoptError as err:
+        logging.error(err)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-v':
+            arg_dict['verbose'] = True
+        elif opt == '-t':
+            arg_dict['timeout'] = int(arg)
+        elif opt == '-j':
+            arg_dict['workers'] = int(arg)
+        elif opt == '-c':
+            arg_dict['config_file'] = arg
+        elif opt == '-h':
+            arg_dict['usage'] = True
+        elif opt == '--help':
+            arg_dict['usage'] = True
+    arg_dict['args'] = args
+    return arg_dict
+
+def get_hook_groups(hook_dir):
+    """ Executable files in hook_dir in name order, grouped by consecutive equal numeric prefix (no prefix = own group) """
+    re_prefix = re.compile(r'^(\d+)')
+    groups = []
+    prev_prefix = None
+    for name in sorted(os.listdir(hook_dir)):
+        path = os.path.join(hook_dir, name)
+        if os.path.isdir(path) or not os.access(path, os.X_OK):
+            continue
+        m = re_prefix.match(name)
+        prefix = m.group(1) if m else None
+        if prefix is not None and prefix == prev_prefix:
+            groups[-1].append(path)
+        else:
+            groups.append([path])
+        prev_prefix = prefix
+    return groups
+
+def write_line(name, log_fh, line):
+    """ Save a line of hook output in its log and print it prefixed with the hook name """
+    line = line if line.endswith('\n') else line + '\n'
+    if log_fh is not None:
+        log_fh.write(line)
+        log_fh.flush()
+    with print_lock:
+        sys.stdout.write('[{0}] {1}'.format(name, line))
+        sys.stdout.flush()
+
+def stream_output(pipe, name, log_fh):
+    """ Copy a hook's output line by line as it arrives (runs in its own thread) """
+    try:
+        for line in iter(pipe.readline, b''):
+            write_line(name, log_fh, line.decode('utf-8', 'replace'))
+    except (ValueError, OSError):
+        pass  # log closed after STREAM_JOIN_SECS
+    finally:
+        pipe.close()
+
+def run_hook(path, phase, timeout, log_dir):
+    """ Run one hook with its output streamed, return a timing record with rc """
+    name = os.path.basename(path)
+    record = {'time': int(time()), 'phase': phase, 'name': name}
+    log_fh = None
+    if log_dir is not None:
+        try:
+            log_fh = open(os.path.join(log_dir, '{0}.log'.format(name)), 'w')
+        except (IOError, OSError) as err:
+            logging.warning('run_hook: {0}: {1}'.format(log_dir, err))
+    start = monotonic()
+    try:
+        try:
+            # own process group so a timeout kills the hook and its children
+            process = RusagePopen([path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+        except OSError as err:
+            write_line(name, log_fh, '{0}: {1}'.format(path, err.strerror))
+            record.update({'rc': 127, 'wall_secs': 0.0, 'cpu_secs': None, 'max_rss_kb': None})
+            return record
+        reader = threading.Thread(target=stream_output, args=(process.stdout, name, log_fh))
+        reader.daemon = True
+        reader.start()
+        with running_lock:
+            running.add(process)
+        try:
+            rc = process.wait(timeout=timeout or None)
+        except subprocess.TimeoutExpired:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                process.kill()
+            rc = process.wait()
+            record['timed_out'] = True
+        finally:
+            with running_lock:
+                running.discard(process)
+        reader.join(STREAM_JOIN_SECS)
+        if record.get('timed_out'):
+            write_line(name, log_fh, '(timed out after {0} seconds)'.format(timeout))
+        record['rc'] = rc
+        record['wall_secs'] = round(monotonic() - start, 3)
+        record.update(get_rusage_stats(process.rusage))
+    finally:
+        if log_fh is not None:
+            log_fh.close()
+    return record
+
+def terminate(signum, _frame):
+    """ Pass termination signals on to the running hooks and skip the remaining groups """
+    terminated.append(signum)
+    with running_lock:
+        for process in running:
+            try:
+                os.killpg(process.pid, signum)
+            except OSError:
+                pass
+
+def run_hooks(hook_dir, timeout=0, hook_timeouts=None, workers=8):
+    """ Run the hook groups of hook_dir in order, return 1 if any hook failed or timed out """
+    phase = os.path.basename(os.path.normpath(hook_dir))
+    if phase.endswith('.d'):
+        phase = phase[:-2]
+    hook_timeouts = hook_timeouts or {}
+
+    # captured output is kept in the run directory next to the timings
+    log_dir = None
+    run_dir = get_run_dir()
+    if run_dir is not None:
+        log_dir = os.path.join(run_dir, 'hooks', phase)
+        try:
+            if not os.path.isdir(log_dir):
+                os.makedirs(log_dir)
+        except OSError as err:
+            logging.warning('run_hooks: {0}: {1}'.format(log_dir, err))
+            log_dir = None
+
+    exit_code = 0
+    for group in get_hook_groups(hook_dir):
+        if terminated:
+            print('skipping {0} (terminated)'.format(', '.join(group)))
+            exit_code = 1
+            continue
+        for path in group:
+            print('Running {0}'.format(path))
+        sys.stdout.flush()
+        executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(group))))
+        futures = [executor.submit(run_hook, path, phase, int(hook_timeouts.get(os.path.basename(path), timeout)), log_dir)
+                   for path in group]
+        executor.shutdown(wait=True)
+
+        records = []
+        for path, future in zip(group, futures):
+            record = future.result()
+            if record['rc'] != 0:
+                print('{0} returned non-zero return code ({1}, {2}s)'.format(path, record['rc'], record['wall_secs']))
+                exit_code = 1
+            logging.info('run_hooks: {0} rc={1[rc]} wall_secs={1[wall_secs]} cpu_secs={1[cpu_secs]} max_rss_kb={1[max_rss_kb]}'.format(path, record))
+            records.append(record)
+        sys.stdout.flush()
+        append_timings(records)
+    return exit_code
+
+
+if __name__ == '__main__':
+
+    # default configuration options
+    arg_dict['usage'] = False
+    arg_dict['verbose'] = False
+
+    # call function to parse CLI arguments to override defaults
+    arg_dict = parse_args(arg_dict)
+
+    if arg_dict['usage'] or len(arg_dict['args']) != 1:
+        usage(2)
+
+    # Setup logging options based on verbose setting
+    if arg_dict['verbose']:
+        setup_logging(log_file=None, log_file_level='debug', log_print_level='info')
+    else:
+        setup_logging(log_file=None, log_file_level='info', log_print_level='warn')
+
+    config = get_config(arg_dict.get('config_file'))
+    arg_dict.setdefault('timeout', int(config['hooks']['timeout']))
+    arg_dict.setdefault('workers', int(config['hooks']['workers']))
+
+    hook_dir = arg_dict['args'][0]
+    if not os.path.isdir(hook_dir):
+        # Create hook directory if it doesn't exist
+        os.makedirs(hook_dir, 0o700)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    signal.signal(signal.SIGHUP, terminate)
+
+    rc = run_hooks(hook_dir, timeout=arg_dict['timeout'], hook_timeouts=config['hook_timeouts'], workers=arg_dict['workers'])
+    if terminated:
+        rc = 128 + terminated[0]
+    sys.exit(rc)
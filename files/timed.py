@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Run a command and append its wall time, CPU time, peak RSS and exit code to the run's timings file.
+# Used by auto-patch.sh and the *.d runners to time package manager phases and hook scripts.
+
+import sys
+import os
+import signal
+from time import time, monotonic
+import getopt
+
+from common import *
+
+####################
+# Global variables #
+####################
+
+# Initialize arg_dict
+arg_dict = dict()
+
+# Help message
+def usage(exit_code=0):
+    """ Display help message if -h option used or invalid syntax. """
+    print(os.path.basename(__file__) + ' -p <phase> [-n <name>] [-f <timings_file>] [--] <command> [args]')
+    print("\t-p\tphase the command belongs to (e.g. auto-patch, pre_update, post_update, post_reboot)")
+    print("\t-n\tname recorded for the command (default basename of the command)")
+    print("\t-f\ttimings file (default ${0}/{1} or {2}/current/{1})".format(RUN_DIR_ENV, TIMINGS_FILE, DATA_DIR))
+    sys.exit(exit_code)
+
+def parse_args(arg_dict):
+    # Parse CLI input (options end at the first non-option argument, the command) #
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hp:n:f:", ["help"])
+    except getopt.GetoptError as err:
+        print(err, file=sys.stderr)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-p':
+            arg_dict['phase'] = arg
+        elif opt == '-n':
+            arg_dict['name'] = arg
+        elif opt == '-f':
+            arg_dict['timings_file'] = arg
+        elif opt == '-h':
+            arg_dict['usage'] = True
+        elif opt == '--help':
+            arg_dict['usage'] = True
+    arg_dict['cmd'] = args
+    return arg_dict
+
+if __name__ == '__main__':
+
+    # default configuration options
+    arg_dict['usage'] = False
+    arg_dict['phase'] = 'other'
+
+    # call function to parse CLI arguments to override defaults
+    arg_dict = parse_args(arg_dict)
+
+    if arg_dict['usage'] or not arg_dict['cmd']:
+        usage(2)
+
+    setup_logging(log_file=None, log_file_level='info', log_print_level='warn')
+
+    record = {
+        'time': int(time()),
+        'phase': arg_dict['phase'],
+        'name': arg_dict.get('name', os.path.basename(arg_dict['cmd'][0])),
+    }
+    start = monotonic()
+    process = None
+    try:
+        # stdin, stdout and stderr are inherited so the command behaves as if run directly
+        process = RusagePopen(arg_dict['cmd'])
+
+        # pass termination signals (e.g. from the cron timeout) on to the command and still record its timing
+        def forward_signal(signum, _frame):
+            process.send_signal(signum)
+        signal.signal(signal.SIGTERM, forward_signal)
+        signal.signal(signal.SIGINT, forward_signal)
+        signal.signal(signal.SIGHUP, forward_signal)
+
+        rc = process.wait()
+    except OSError as err:
+        print('{0}: {1}'.format(arg_dict['cmd'][0], err.strerror), file=sys.stderr)
+        rc = 127
+
+    record['rc'] = rc
+    record['wall_secs'] = round(monotonic() - start, 3)
+    record.update(get_rusage_stats(process.rusage if process is not None else None))
+    append_timings([record], arg_dict.get('timings_file'))
+
+    # exit like a shell does for a command killed by a signal
+    sys.exit(128 - rc if rc < 0 else rc)
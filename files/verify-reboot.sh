@@ -7,8 +7,13 @@ start() {
   # if do_verify is set, do verification
   do_verify=0
 
-  # Check that command output exists prior to reboot
+  # Check that command output exists prior to reboot (cmds.json may be compressed)
   cmds_file="/var/log/auto-patch/current/cmds.json"
+  for suffix in .gz .zst; do
+    if [ ! -f $cmds_file ] && [ -f ${cmds_file}${suffix} ]; then
+      cmds_file=${cmds_file}${suffix}
+    fi
+  done
   if [ ! -f $cmds_file ]; then
     echo "$cmds_file not found: verification will not continue" | tee -a $LOG
     RETVAL=1; return 1
@@ -16,7 +21,7 @@ start() {
 
   # Find time of last commands in epoch seconds from pre-patching
   patch_secs=0
-  patch_file="/var/log/auto-patch/current/cmds.json"
+  patch_file=$cmds_file
   if [ -e $patch_file ]; then
     patch_sec_current=$(stat -c "%Y" $patch_file)
     [ $patch_sec_current -gt $patch_secs ] && patch_secs=$patch_sec_current
@@ -45,20 +50,33 @@ start() {
   BASEDIR=$(dirname "$0")
   cd $BASEDIR
 
-  if [ \( ! -L /var/log/auto-patch/current \) -o \( ! -e /var/log/auto-patch/current/cmds.json \) ]; then
+  if [ \( ! -L /var/log/auto-patch/current \) -o \( ! -e $cmds_file \) ]; then
     echo "Pre-requisite scripts for automatic validation not found." | tee -a $LOG
     RETVAL=1; return 1
   fi
 
-  # sleep minimum of 30s to allow other processes to start
-  sleep_sec=$(awk -v min=30 -v max=60 'BEGIN{srand(); print int(min+rand()*(max-min+1))}')
+  # verify.py polls failing validators until they converge when wait mode is enabled in auto-patch.conf,
+  # otherwise sleep minimum of 30s to allow other processes to start
+  if grep -Eqs '^wait *= *(true|yes|1|on)' ./auto-patch.conf; then
+    sleep_sec=0
+  else
+    sleep_sec=$(awk -v min=30 -v max=60 'BEGIN{srand(); print int(min+rand()*(max-min+1))}')
+  fi
   echo "Sleeping $sleep_sec, collect commands, comparing to pre-reboot state" | tee -a $LOG
   cd /tmp
   sleep $sleep_sec
   CMD="${BASEDIR}/post_reboot.sh"
   echo $CMD | tee -a $LOG
   $CMD >>$LOG 2>&1
+  rc=$?
   # /usr/bin/nohup sh -c "$CMD" </dev/null >>$LOG 2>&1 &
+  # Release the reboot gate slot once verification passed (a failed host keeps its slot until the lease expires,
+  # which holds back the rest of the group)
+  if [ $rc -eq 0 ]; then
+    python3 ${BASEDIR}/reboot-gate.py release >>$LOG 2>&1
+  else
+    echo "verification failed (rc=$rc), reboot gate slot kept until its lease expires" | tee -a $LOG
+  fi
   RETVAL=0
 }
 
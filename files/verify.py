@@ -5,10 +5,12 @@ import os
 import shutil
 import subprocess
 import json
-from time import time, localtime, strftime
+from time import time, monotonic, sleep, localtime, strftime
 import getopt
 
 from common import *
+from history import update_history
+from metrics import export_metrics
 
 ####################
 # Global variables #
@@ -23,17 +25,21 @@ report_dict = dict()
 # Help message
 def usage(exit_code=0):
     """ Display help message if -h option used or invalid syntax. """
-    print(os.path.basename(__file__) + ' [-i <cmd_file.json>] [-o <out_file.json>] [-v] [-l <log_file>]')
+    print(os.path.basename(__file__) + ' [-i <cmd_file.json>] [-o <out_file.json>] [-w] [-j <workers>] [-t <deadline>] [-c <config_file>] [-v] [-l <log_file>]')
     print("\t-l\tlog file for report (default /var/log/auto-patch/current/report.log)")
-    print("\t-i\tJSON file to read command output from (default /var/log/auto-patch/current/cmds.json)")
+    print("\t-i\tJSON file to read command output from, plain or compressed (default /var/log/auto-patch/current/cmds.json[.gz|.zst])")
     print("\t-o\tJSON file to write report to (default report.json in directory for -i)")
+    print("\t-w\twait mode: re-collect sections of failing validators with exponential backoff until all pass or the wait deadline passes (--wait)")
+    print("\t-j\tnumber of commands to collect concurrently (default {0})".format(COLLECT_WORKERS))
+    print("\t-t\tdeadline in seconds for collecting all commands, 0 to disable (default {0})".format(COLLECT_DEADLINE))
+    print("\t-c\tconfiguration file (default {0})".format(CONFIG_FILE))
     print("\t-v\tverbose output")
     sys.exit(exit_code)
 
 def parse_args(arg_dict):
     # Parse CLI input #
     try:
-        opts, _args = getopt.getopt(sys.argv[1:], "hvl:i:o:", ["help"])
+        opts, _args = getopt.getopt(sys.argv[1:], "hvwl:i:o:j:t:c:", ["help", "wait"])
     except getopt.GetoptError as err:
         logging.error(err)
         sys.exit(2)
@@ -46,55 +52,22 @@ def parse_args(arg_dict):
             arg_dict['save_file'] = arg
         elif opt == '-o':
             arg_dict['report_file'] = arg
+        elif opt in ('-w', '--wait'):
+            arg_dict['wait'] = True
+        elif opt == '-c':
+            arg_dict['config_file'] = arg
+        elif opt == '-j':
+            arg_dict['workers'] = int(arg)
+        elif opt == '-t':
+            arg_dict['deadline'] = int(arg)
         elif opt == '-h':
             arg_dict['usage'] = True
         elif opt == '--help':
             arg_dict['usage'] = True
     return arg_dict
 
-def save_cmd_to_dict(cmd, timeout=None, key=None):
-    rc, stdout, stderr = get_cmd3(cmd, timeout=timeout)
-    if key == None:
-        key = cmd
-    cmds_dict_curr[key] = {}
-    if key != cmd:
-        cmds_dict_curr[key]['cmd'] = cmd
-    cmds_dict_curr[key]['stdout'] = stdout
-    cmds_dict_curr[key]['stderr'] = stderr
-    cmds_dict_curr[key]['rc'] = rc
-
-def collect_cmds():
-    save_cmd_to_dict("date +\"%Y-%m-%d %H:%M:%S\"")
-    save_cmd_to_dict("date +\"%s\"")
-    save_cmd_to_dict('uname')
-    # save_cmd_to_dict("echo \$TZ")
-    save_cmd_to_dict('uptime')
-    save_cmd_to_dict('netstat -rn')
-    save_cmd_to_dict('/sbin/ifconfig -a', key='ifconfig -a')
-    save_cmd_to_dict('cat /proc/swaps')
-    save_cmd_to_dict('df -k', timeout=15)
-    save_cmd_to_dict('mount')
-    save_cmd_to_dict('cat /etc/resolv.conf')
-    # save_cmd_to_dict('ntpq -pn')
-    if os.path.exists('/usr/bin/dpkg'):
-        save_cmd_to_dict('dpkg --list')
-    if os.path.exists('/usr/bin/rpm'):
-        save_cmd_to_dict("rpm -qa --queryformat=\"%{NAME}:%{VERSION}\\n\"", key='rpm_custom')
-    save_cmd_to_dict('netstat -an')
-    save_cmd_to_dict("ps -www -eo \"pmem pcpu time vsz rss user pid args\"", key='ps_custom')
-    save_cmd_to_dict('cat /etc/ssh/sshd_config')
-
-def save_cmd_dict_to_file(cmd_out_file):
-
-    output_text = json.dumps(cmds_dict_curr, indent=4)
-
-    # write output to specified file
-    fh = open(cmd_out_file, "w")
-    fh.write(output_text)
-    fh.close()
-    os.chmod(cmd_out_file, 0o600)
-
-def validate_ifconfig():
+@register_validator('ifconfig', sections=['ifconfig -a'])
+def validate_ifconfig(cmds_dict_prev, cmds_dict_curr):
 
     cmd_key = 'ifconfig -a'
     results = {}
@@ -112,74 +85,24 @@ def validate_ifconfig():
         results[cmd_key]['status'] = 'failed'
         return results
 
-    # Variables and regex for parsing command output
-    re_interface = re.compile(r'(^\S.*?)\s')
-    interfaces_prev = {}
-    interfaces_curr = {}
-    re_ip1 = re.compile(r'inet addr:(.*?)\s')
-    re_ip2 = re.compile(r'inet (.*?)\s')
-
-    # Parse previous info
-    for line in cmds_dict_prev[cmd_key]['stdout'].split('\n'):
-        line = line.rstrip()
-
-        # Find each interface
-        m = re_interface.search(line)
-        if m:
-            interface = m.group(1)
-            interface = interface.replace(':', '')  # remove colon
-            interfaces_prev[interface] = []
-
-        # Check for IP using 2 patterns (covers multiple Operating Systems)
-        m = re_ip1.search(line)
-        if m:
-            ip = m.group(1)
-            interfaces_prev[interface].append(ip)
-        else:
-            m = re_ip2.search(line)
-            if m:
-                ip = m.group(1)
-                interfaces_prev[interface].append(ip)
-
-    # Parse current info
-    for line in cmds_dict_curr[cmd_key]['stdout'].split('\n'):
-        line = line.rstrip()
-
-        # Find each interface
-        m = re_interface.search(line)
-        if m:
-            interface = m.group(1)
-            interface = interface.replace(':', '')  # remove colon
-            interfaces_curr[interface] = []
-
-        # Check for IP using 2 patterns (covers multiple Operating Systems)
-        m = re_ip1.search(line)
-        if m:
-            ip = m.group(1)
-            interfaces_curr[interface].append(ip)
-        else:
-            m = re_ip2.search(line)
-            if m:
-                ip = m.group(1)
-                interfaces_curr[interface].append(ip)
-
-    # Compare previous and current
-    d = DictDiffer(interfaces_curr, interfaces_prev)
-    if len(d.added()) > 0:
-        results[cmd_key]['msgs'].append('added: ' + ', '.join(d.added()))
+    # Compare previous and current parsed sections (interface -> IPs), identical output is not parsed or diffed
+    added, removed, changed = diff_sections(cmds_dict_curr, cmds_dict_prev, cmd_key)
+    if len(added) > 0:
+        results[cmd_key]['msgs'].append('added: ' + ', '.join(added))
         results[cmd_key]['status'] = 'failed'
 
-    if len(d.removed()) > 0:
-        results[cmd_key]['msgs'].append('removed: ' + ', '.join(d.removed()))
+    if len(removed) > 0:
+        results[cmd_key]['msgs'].append('removed: ' + ', '.join(removed))
         results[cmd_key]['status'] = 'failed'
 
-    if len(d.changed()) > 0:
-        results[cmd_key]['msgs'].append('changed: ' + ', '.join(d.changed()))
+    if len(changed) > 0:
+        results[cmd_key]['msgs'].append('changed: ' + ', '.join(changed))
         results[cmd_key]['status'] = 'failed'
 
     return results
 
-def validate_fs_mounts():
+@register_validator('fs_mounts', sections=['mount'])
+def validate_fs_mounts(cmds_dict_prev, cmds_dict_curr):
 
     cmd_key = 'mount'
     results = {}
@@ -200,102 +123,109 @@ def validate_fs_mounts():
     # Only check specific filesystem types
     fs_types = {"ext2", "ext3", "ext4", "xfs", "nfs", "nfs3", "nfs4", "gpfs"}
 
-    # Capture mount order to check for overmounted filesystems
-    mount_order = []
-
-    # Variables and regex for parsing command output
-    mps_prev = {}
-    mps_curr = {}
-
-    # Parse previous info
-    for line in cmds_dict_prev[cmd_key]['stdout'].split('\n'):
-        fields = line.rstrip().split()
-        if len(fields) > 0:
-            dev, _on, mp, _type, fs_type, options = fields
-            # Skip if fs_type isn't one we're interested in
-            if fs_type not in fs_types:
-                continue
-            mps_prev[mp] = {'dev': dev, 'type': fs_type, 'options': options}
-
-    # Parse current info
-    for line in cmds_dict_curr[cmd_key]['stdout'].split('\n'):
-        fields = line.rstrip().split()
-        if len(fields) > 0:
-            dev, _on, mp, _type, fs_type, options = fields
-            # Skip if fs_type isn't one we're interested in
-            if fs_type not in fs_types:
-                continue
-            mps_curr[mp] = {'dev': dev, 'type': fs_type, 'options': options}
-            mount_order.append(mp)  # capture mount order to check for overmounts
-
-    # Compare previous and current
-    d = DictDiffer(mps_curr, mps_prev)
-    if len(d.added()) > 0:
-        results[cmd_key]['msgs'].append('added: ' + ', '.join(d.added()))
+    # Compare previous and current parsed sections (mountpoint -> dev, type, options)
+    def select(mp, m):
+        return m['type'] in fs_types
+
+    if bool(cmds_dict_prev[cmd_key].get('mountinfo')) == bool(cmds_dict_curr[cmd_key].get('mountinfo')):
+        added, removed, changed = diff_sections(cmds_dict_curr, cmds_dict_prev, cmd_key, select=select)
+    else:
+        # Options rebuilt from mountinfo don't match the mount(8) output saved by earlier versions
+        # (order, superblock options), so only the device and type are compared across collectors
+        results[cmd_key]['msgs'].append('mount options not compared (previous snapshot collected with {0})'.format(
+            'mountinfo' if cmds_dict_prev[cmd_key].get('mountinfo') else 'mount'))
+        mounts = []
+        for cmds_dict in (cmds_dict_curr, cmds_dict_prev):
+            mounts.append(dict((mp, {'dev': m['dev'], 'type': m['type']}) for mp, m in get_parsed(cmds_dict, cmd_key).items() if select(mp, m)))
+        added, removed, changed = diff_dicts(*mounts)
+
+    if len(added) > 0:
+        results[cmd_key]['msgs'].append('added: ' + ', '.join(added))
         results[cmd_key]['status'] = 'failed'
 
-    if len(d.removed()) > 0:
-        results[cmd_key]['msgs'].append('removed: ' + ', '.join(d.removed()))
+    if len(removed) > 0:
+        results[cmd_key]['msgs'].append('removed: ' + ', '.join(removed))
         results[cmd_key]['status'] = 'failed'
 
-    if len(d.changed()) > 0:
-        results[cmd_key]['msgs'].append('changed: ' + ', '.join(d.changed()))
+    if len(changed) > 0:
+        results[cmd_key]['msgs'].append('changed: ' + ', '.join(changed))
         results[cmd_key]['status'] = 'failed'
 
-    # Check mount order to see that each mounted fs with "/" appended does not match (regex/begin) a previously mounted fs
-    mps_checked = []  # initialize empty list to store mounts as they are checked against prior mounts
+    # Check mount order for filesystems hidden by a later mount on the same or a parent mountpoint
+    mounts = get_mount_list(cmds_dict_curr[cmd_key])
     print_heading = True
-    for mp_curr in mount_order:
-        for mp_check in mps_checked:
-            mp_curr_slash = '{0}/'.format(mp_check)
-            if re.match(mp_curr_slash, mp_check):
-                if print_heading:
-                    results[cmd_key]['msgs'].append('mount order problems:')
-                    results[cmd_key]['status'] = 'failed'
-                    print_heading = False
-                results[cmd_key]['msgs'].append('{0}: is set to mount before {1}'.format(mp_curr, mp_check))
-        mps_checked.append(mp_curr)
-    mps_checked = []  # done with this
+    for hidden, covering in find_overmounts(mounts):
+        if mounts[hidden]['type'] not in fs_types:
+            continue
+        if print_heading:
+            results[cmd_key]['msgs'].append('mount order problems:')
+            results[cmd_key]['status'] = 'failed'
+            print_heading = False
+        if mounts[hidden]['mp'] == mounts[covering]['mp']:
+            results[cmd_key]['msgs'].append('{0}: is overmounted by a later {1} mount'.format(mounts[hidden]['mp'], mounts[covering]['type']))
+        else:
+            results[cmd_key]['msgs'].append('{0}: is set to mount before {1}'.format(mounts[hidden]['mp'], mounts[covering]['mp']))
 
     return results
 
-def validate_packages():
+@register_validator('packages', sections=['packages'])
+def validate_packages(cmds_dict_prev, cmds_dict_curr):
 
+    cmd_key = 'packages'
     results = {}
+    results[cmd_key] = {}
+    results[cmd_key]['status'] = 'success'
+    results[cmd_key]['msgs'] = []
 
-    # Check dpkg (if exists)
-    cmd_key = 'dpkg --list'
-    if cmd_key in cmds_dict_curr:
-        results[cmd_key] = {}
-        results[cmd_key]['status'] = 'success'
-        results[cmd_key]['msgs'] = []
-
-        # Parse current info
-        if len(cmds_dict_curr[cmd_key]['stderr']) > 0:
-            results[cmd_key]['msgs'].append('stderr was returned')
-            results[cmd_key]['status'] = 'failed'
+    if cmd_key not in cmds_dict_curr:
+        results[cmd_key]['msgs'].append('{0}: not found in current command output'.format(cmd_key))
+        results[cmd_key]['status'] = 'failed'
+        return results
 
-    # Check rpm (if exists)
-    cmd_key = 'rpm_custom'
-    if cmd_key in cmds_dict_curr:
-        results[cmd_key] = {}
-        results[cmd_key]['status'] = 'success'
-        results[cmd_key]['msgs'] = []
+    # Check for errors reading the package database
+    stderr = cmds_dict_curr[cmd_key]['stderr']
+    if len(stderr) > 0 or cmds_dict_curr[cmd_key]['rc'] != 0:
+        results[cmd_key]['msgs'].append('stderr was returned')
+        results[cmd_key]['status'] = 'failed'
 
-        # Parse current info
-        if len(cmds_dict_curr[cmd_key]['stderr']) > 0:
-            results[cmd_key]['msgs'].append('stderr was returned')
-            results[cmd_key]['status'] = 'failed'
+        # Check for RPM DB corrupt message in stderr
+        re_rpm_corrupt = re.compile(r'DB_RUNRECOVERY')
+        m = re_rpm_corrupt.search(stderr)
+        if m:
+            results[cmd_key]['msgs'].append('RPM database is corrupt')
 
-            # Check for RPM DB corrupt message in stderr
-            re_rpm_corrupt = re.compile(r'DB_RUNRECOVERY')
-            m = re_rpm_corrupt.search(cmds_dict_curr[cmd_key]['stderr'])
-            if m:
-                results[cmd_key]['msgs'].append('RPM database is corrupt')
+    # Snapshots saved by earlier versions have the package list as dpkg --list or rpm_custom output
+    prev_key = cmd_key if cmd_key in cmds_dict_prev else get_legacy_package_key(cmds_dict_prev)
+    if prev_key is None:
+        results[cmd_key]['msgs'].append('{0}: not found in previous command output'.format(cmd_key))
+        results[cmd_key]['status'] = 'failed'
+        return results
+    if prev_key != cmd_key:
+        results[cmd_key]['msgs'].append('{0}: comparing with {1} output of the previous snapshot'.format(cmd_key, prev_key))
+
+    # Package changes are expected after patching, so they are reported without failing validation
+    start = monotonic()
+    packages_prev = get_parsed(cmds_dict_prev, prev_key)
+    packages_curr = get_parsed(cmds_dict_curr, cmd_key)
+    if prev_key == cmd_key:
+        added, removed, changed = diff_sections(cmds_dict_curr, cmds_dict_prev, cmd_key, parsed_curr=packages_curr, parsed_prev=packages_prev)
+    else:
+        if prev_key == 'rpm_custom':
+            # rpm_custom saved %{VERSION} only, so packages are compared by name without epoch, release and architecture
+            packages_curr = dict((name.split(':')[0], [get_rpm_upstream_version(pkg[0]), '']) for name, pkg in packages_curr.items())
+        added, removed, changed = diff_dicts(dict((name, pkg[0]) for name, pkg in packages_curr.items()),
+                                             dict((name, pkg[0]) for name, pkg in packages_prev.items()))
+    results[cmd_key]['upgraded'] = dict((name, [packages_prev[name][0], packages_curr[name][0]]) for name in sorted(changed))
+    results[cmd_key]['added'] = dict((name, packages_curr[name][0]) for name in sorted(added))
+    results[cmd_key]['removed'] = dict((name, packages_prev[name][0]) for name in sorted(removed))
+    results[cmd_key]['diff_secs'] = round(monotonic() - start, 3)
+    results[cmd_key]['msgs'].append('{0} packages: {1} upgraded, {2} added, {3} removed'.format(
+        len(packages_curr), len(results[cmd_key]['upgraded']), len(results[cmd_key]['added']), len(results[cmd_key]['removed'])))
 
     return results
 
-def validate_paging_space():
+@register_validator('paging_space', sections=['cat /proc/swaps'])
+def validate_paging_space(cmds_dict_prev, cmds_dict_curr):
 
     cmd_key = 'cat /proc/swaps'
     results = {}
@@ -313,58 +243,123 @@ def validate_paging_space():
         results[cmd_key]['status'] = 'failed'
         return results
 
-    # Variables and regex for parsing command output
-    re_heading = re.compile(r'^File')
-    swaps_prev = {}
-    swaps_curr = {}
+    # Compare previous and current parsed sections (swap -> size)
+    added, removed, changed = diff_sections(cmds_dict_curr, cmds_dict_prev, cmd_key)
+    # if len(added) > 0:
+    #     results[cmd_key]['msgs'].append('added: ' + ', '.join(added))
+    #     results[cmd_key]['status'] = 'failed'
 
-    # Parse previous info
-    for line in cmds_dict_prev[cmd_key]['stdout'].split('\n'):
-        line = line.rstrip()
+    if len(removed) > 0:
+        results[cmd_key]['msgs'].append('removed: ' + ', '.join(removed))
+        results[cmd_key]['status'] = 'failed'
 
-        # Find each swap
-        m = re_heading.search(line)
-        if m:
-            continue
-        swap_info = line.split()
-        if len(swap_info) > 2:  # Check number of fields because last line is blank
-            swaps_prev[swap_info[0]] = swap_info[2]
+    if len(changed) > 0:
+        results[cmd_key]['msgs'].append('changed: ' + ', '.join(changed))
+        results[cmd_key]['status'] = 'failed'
 
-    # Parse current info
-    for line in cmds_dict_curr[cmd_key]['stdout'].split('\n'):
-        line = line.rstrip()
+    return results
 
-        # Find each swap
-        m = re_heading.search(line)
-        if m:
-            continue
-        swap_info = line.split()
-        if len(swap_info) > 2:  # Check number of fields because last line is blank
-            swaps_curr[swap_info[0]] = swap_info[2]
-
-    # Compare previous and current
-    d = DictDiffer(swaps_curr, swaps_prev)
-    # if len(d.added()) > 0:
-    #     results[cmd_key]['msgs'].append('added: ' + ', '.join(d.added()))
-    #     results[cmd_key]['status'] = 'failed'
+@register_validator('listeners', sections=['sockets'])
+def validate_listeners(cmds_dict_prev, cmds_dict_curr):
+
+    cmd_key = 'sockets'
+    results = {}
+    results[cmd_key] = {}
+    results[cmd_key]['status'] = 'success'
+    results[cmd_key]['msgs'] = []
+
+    # Snapshots saved by earlier versions have netstat -an output, which is not comparable to the parsed listeners
+    if cmd_key not in cmds_dict_prev and 'netstat -an' in cmds_dict_prev:
+        results[cmd_key]['msgs'].append('{0}: not compared (previous snapshot has netstat -an output)'.format(cmd_key))
+        return results
+
+    if cmd_key not in cmds_dict_prev:
+        results[cmd_key]['msgs'].append('{0}: not found in previous command output'.format(cmd_key))
+        results[cmd_key]['status'] = 'failed'
+        return results
 
-    if len(d.removed()) > 0:
-        results[cmd_key]['msgs'].append('removed: ' + ', '.join(d.removed()))
+    if cmd_key not in cmds_dict_curr:
+        results[cmd_key]['msgs'].append('{0}: not found in current command output'.format(cmd_key))
         results[cmd_key]['status'] = 'failed'
+        return results
 
-    if len(d.changed()) > 0:
-        results[cmd_key]['msgs'].append('changed: ' + ', '.join(d.changed()))
+    # Parsed sections are <proto> <address>:<port> -> [proto, address, port].
+    # Listeners on ephemeral ports (e.g. RPC services) get a new port after a reboot, so only fixed ports are compared.
+    ephemeral = cmds_dict_prev[cmd_key].get('ephemeral_ports') or [0, -1]
+    listeners_prev = get_parsed(cmds_dict_prev, cmd_key)
+    listeners_curr = get_parsed(cmds_dict_curr, cmd_key)
+    added, removed, _changed = diff_sections(cmds_dict_curr, cmds_dict_prev, cmd_key, parsed_curr=listeners_curr, parsed_prev=listeners_prev)
+    removed = [k for k in removed if not ephemeral[0] <= listeners_prev[k][2] <= ephemeral[1]]
+    added = [k for k in added if not ephemeral[0] <= listeners_curr[k][2] <= ephemeral[1]]
+
+    # Every pre-patch listener (proto, address, port) must be back, new listeners are only reported
+    if len(removed) > 0:
+        results[cmd_key]['msgs'].append('missing: ' + ', '.join(sorted(removed)))
         results[cmd_key]['status'] = 'failed'
 
+    if len(added) > 0:
+        results[cmd_key]['msgs'].append('new: ' + ', '.join(sorted(added)))
+
     return results
 
 
+def wait_for_validators(report_dict, names, verify_start, deadline, interval, max_interval, workers, validator_workers, cache=None, capture=None):
+    """
+    Re-collect only the sections read by failing validators and re-run them with exponential backoff
+    until every validator passes or the deadline (seconds since verify_start) passes.
+    Each report entry gets converge_secs (None if it never passed) and attempts.
+    """
+    attempts = dict((name, 1) for name in names)
+    converge = {}
+
+    def failing(report):
+        failed = set(entry['validator'] for entry in report.values() if entry['status'] != 'success')
+        for name in names:
+            if name not in failed and name not in converge:
+                converge[name] = round(monotonic() - verify_start, 3)
+        return [name for name in names if name in failed]
+
+    pending = failing(report_dict)
+    while pending:
+        remaining = verify_start + deadline - monotonic()
+        if remaining <= 0:
+            logging.warning('wait_for_validators: deadline of {0}s reached, still failing: {1}'.format(deadline, ', '.join(pending)))
+            break
+        logging.info('wait_for_validators: {0} failing, retrying in {1}s'.format(', '.join(pending), interval))
+        sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+
+        # Re-collect only the sections the failing validators read
+        sections = set()
+        for name in pending:
+            sections.update(VALIDATORS[name]['sections'])
+        cmd_list = [cmd_spec for cmd_spec in get_cmd_list() if cmd_spec.get('key', cmd_spec['cmd']) in sections]
+        if cmd_list:
+            remaining = verify_start + deadline - monotonic()
+            collect_cmds(cmds_dict_curr, cmd_list=cmd_list, workers=workers, deadline=max(1, int(remaining)), cache=cache, capture=capture)
+            append_timings(get_cmd_timings(cmds_dict_curr, 'verify'), arg_dict['timings_file'])
+
+        # Replace the failing validators' entries with their new results
+        for key in [key for key, entry in report_dict.items() if entry['validator'] in pending]:
+            del report_dict[key]
+        report_dict.update(run_validators(cmds_dict_prev, cmds_dict_curr, names=pending, workers=validator_workers))
+        for name in pending:
+            attempts[name] += 1
+        pending = failing(report_dict)
+
+    for entry in report_dict.values():
+        entry['converge_secs'] = converge.get(entry['validator'])
+        entry['attempts'] = attempts[entry['validator']]
+    return report_dict
+
 def process_report(report_dict):
     rc = 0
     if arg_dict['verbose']:
         print(json.dumps(report_dict, indent=4))
         print()
     for cmd_key in report_dict.keys():
+        if 'status' not in report_dict[cmd_key]:
+            continue  # not a validator result (timings)
         if report_dict[cmd_key]['status'] != 'success':
             rc = 1
             logging.error(report_dict[cmd_key])
@@ -375,13 +370,8 @@ def process_report(report_dict):
     else:
         print('validation=failed')
 
-    output_text = json.dumps(report_dict, indent=4)
-
-    # write output to specified file
-    fh = open(arg_dict['report_file'], "w")
-    fh.write(output_text)
-    fh.close()
-    os.chmod(arg_dict['report_file'], 0o600)
+    # write output to specified file (atomic rename so readers never see a partial report)
+    save_dict_to_file(report_dict, arg_dict['report_file'], fmt=arg_dict['report_format'])
 
     return rc
 
@@ -402,7 +392,7 @@ if __name__ == '__main__':
 
     # default configurations to set if not set in CLI
     if 'save_file' not in arg_dict:
-        arg_dict['save_file'] = os.path.join(arg_dict['data_dir'], 'current', 'cmds.json')
+        arg_dict['save_file'] = find_snapshot_file(os.path.join(arg_dict['data_dir'], 'current', 'cmds.json'))
 
     # default to write report to report.json in the same directory as the input file
     if 'report_file' not in arg_dict:
@@ -416,15 +406,48 @@ if __name__ == '__main__':
     else:
         setup_logging(log_file=None, log_file_level='info', log_print_level='warn')
 
-    cmds_dict_prev = get_dict_from_file(arg_dict['save_file'])[0]
-    collect_cmds()
+    # configuration file settings apply unless overridden by CLI
+    config = get_config(arg_dict.get('config_file'))
+    arg_dict.setdefault('workers', int(config['snapshot']['workers']))
+    arg_dict.setdefault('deadline', int(config['snapshot']['deadline']))
+    # report.json is read by other tools, so it is never compressed
+    arg_dict['report_format'] = 'compact' if config['report']['format'] == 'compact' else 'json'
+
+    arg_dict.setdefault('wait', config_bool(config['verify']['wait']))
 
-    # Update report dictionary with results from validation functions
-    report_dict.update(validate_ifconfig())
-    report_dict.update(validate_paging_space())
-    report_dict.update(validate_packages())
-    report_dict.update(validate_fs_mounts())
+    verify_start = monotonic()
+    cmds_dict_prev = get_dict_from_file(arg_dict['save_file'])[0]
+    cache = get_section_cache(config)
+    capture = get_capture_settings(config, os.path.join(os.path.dirname(os.path.realpath(arg_dict['report_file'])), 'spill', 'verify'))
+    collect_cmds(cmds_dict_curr, workers=arg_dict['workers'], deadline=arg_dict['deadline'], cache=cache, capture=capture)
+    arg_dict['timings_file'] = os.path.join(os.path.dirname(arg_dict['report_file']), TIMINGS_FILE)
+    append_timings(get_cmd_timings(cmds_dict_curr, 'verify'), arg_dict['timings_file'])
+
+    # Load site-specific validators from validate_*.py modules in this directory, then run all enabled validators
+    load_validator_modules(os.path.dirname(os.path.abspath(__file__)))
+    disable = [name.strip() for name in config['validators']['disable'].split(',') if name.strip()]
+    validator_names = get_validator_names(disable)
+    validator_workers = int(config['validators']['workers'])
+    report_dict.update(run_validators(cmds_dict_prev, cmds_dict_curr, names=validator_names, workers=validator_workers))
+
+    # In wait mode keep polling failing validators until they converge instead of relying on a fixed sleep before verify
+    if arg_dict['wait']:
+        wait_for_validators(report_dict, validator_names, verify_start,
+                            deadline=int(config['verify']['wait_deadline']),
+                            interval=float(config['verify']['wait_interval']),
+                            max_interval=float(config['verify']['wait_max_interval']),
+                            workers=arg_dict['workers'], validator_workers=validator_workers, cache=cache, capture=capture)
+
+    # Timings of this run (commands, hooks and package manager phases) recorded in the timings file
+    report_dict['timings'] = summarize_timings(read_timings(arg_dict['timings_file']))
 
     # Process report (print errors via logger, save report, determine return code)
     rc = process_report(report_dict)
+
+    # Record validation results and package changes in the history database (default data directory layout only)
+    # and export metrics for node_exporter's textfile collector (disabled unless textfile_dir is set)
+    if os.path.realpath(arg_dict['report_file']).startswith(os.path.realpath(arg_dict['data_dir']) + os.sep):
+        if config_bool(config['history']['enabled']):
+            update_history(config['history']['db_file'], report_file=arg_dict['report_file'], report_dict=report_dict)
+        export_metrics(config['metrics']['textfile_dir'], os.path.dirname(os.path.realpath(arg_dict['report_file'])))
     sys.exit(rc)
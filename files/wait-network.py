@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+# Wait for network traffic on the default route interfaces to quiesce before the reboot.
+# Deployed as post_update.d/80-wait-network.py when auto_patch_wait_network is enabled (after the service
+# restarts, before 99-reboot.sh).  No action is taken unless /var/run/reboot-required exists.
+# rx/tx packet counters are sampled from /sys/class/net/<if>/statistics every interval seconds.  Traffic is quiet
+# when the moving average rate over window_secs is below max_pps in both directions, and the reboot continues
+# once it stayed quiet for min_quiet_secs (or max_wait_secs passed).
+
+import sys
+import os
+from collections import deque
+from time import sleep, monotonic
+import getopt
+
+from common import *
+
+####################
+# Global variables #
+####################
+
+# Initialize arg_dict
+arg_dict = dict()
+
+SYS_CLASS_NET = '/sys/class/net'
+PROC_NET_ROUTE = '/proc/net/route'
+PROC_NET_IPV6_ROUTE = '/proc/net/ipv6_route'
+RTF_UP = 0x1
+
+# Help message
+def usage(exit_code=0):
+    """ Display help message if -h option used or invalid syntax. """
+    print(os.path.basename(__file__) + ' [-f] [-i <interfaces>] [-p <max_pps>] [-q <min_quiet_secs>] [-w <max_wait_secs>] [-c <config_file>] [-v]')
+    print("\t-f\twait even if {0} doesn't exist".format(REBOOT_REQUIRED_FILE))
+    print("\t-i\tcomma separated interfaces to sample (default from config file or the default route interfaces)")
+    print("\t-p\tmaximum moving average rx and tx packets/s considered quiet (default from config file or 10)")
+    print("\t-q\tseconds traffic must stay quiet (default from config file or 5)")
+    print("\t-w\tmaximum seconds to wait before continuing anyway (default from config file or 1200)")
+    print("\t-c\tconfiguration file (default {0})".format(CONFIG_FILE))
+    print("\t-v\tverbose output (log every sample)")
+    sys.exit(exit_code)
+
+def parse_args(arg_dict):
+    # Parse CLI input #
+    try:
+        opts, _args = getopt.getopt(sys.argv[1:], "hvfi:p:q:w:c:", ["help"])
+    except getopt.GetoptError as err:
+        logging.error(err)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-v':
+            arg_dict['verbose'] = True
+        elif opt == '-f':
+            arg_dict['force'] = True
+        elif opt == '-i':
+            arg_dict['interfaces'] = arg
+        elif opt == '-p':
+            arg_dict['max_pps'] = float(arg)
+        elif opt == '-q':
+            arg_dict['min_quiet_secs'] = float(arg)
+        elif opt == '-w':
+            arg_dict['max_wait_secs'] = float(arg)
+        elif opt == '-c':
+            arg_dict['config_file'] = arg
+        elif opt == '-h':
+            arg_dict['usage'] = True
+        elif opt == '--help':
+            arg_dict['usage'] = True
+    return arg_dict
+
+def get_default_route_interfaces():
+    """ Interfaces of the IPv4 and IPv6 default routes (replaces netstat -rn) """
+    interfaces = set()
+    try:
+        with open(PROC_NET_ROUTE) as fh:
+            next(fh, None)
+            for line in fh:
+                fields = line.split()
+                # Iface Destination Gateway Flags RefCnt Use Metric Mask ...
+                if len(fields) >= 8 and fields[1] == '00000000' and fields[7] == '00000000' and int(fields[3], 16) & RTF_UP:
+                    interfaces.add(fields[0])
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        with open(PROC_NET_IPV6_ROUTE) as fh:
+            for line in fh:
+                fields = line.split()
+                # dest dest_plen src src_plen next_hop metric refcnt use flags iface
+                if len(fields) >= 10 and fields[0] == '0' * 32 and fields[1] == '00' and int(fields[8], 16) & RTF_UP:
+                    interfaces.add(fields[9])
+    except (IOError, OSError, ValueError):
+        pass
+    interfaces.discard('lo')
+    return sorted(interfaces)
+
+def read_counters(interfaces):
+    """ Total (rx_packets, tx_packets) of interfaces (replaces netstat -in), interfaces that vanished are skipped """
+    rx = tx = 0
+    for interface in interfaces:
+        stats_dir = os.path.join(SYS_CLASS_NET, interface, 'statistics')
+        try:
+            with open(os.path.join(stats_dir, 'rx_packets')) as fh:
+                rx_packets = int(fh.read())
+            with open(os.path.join(stats_dir, 'tx_packets')) as fh:
+                tx_packets = int(fh.read())
+        except (IOError, OSError, ValueError):
+            continue
+        rx += rx_packets
+        tx += tx_packets
+    return rx, tx
+
+class RateWindow(object):
+    """ Moving average packet rates over the last window_secs of (monotonic time, rx, tx) samples """
+
+    def __init__(self, window_secs):
+        self.window_secs = window_secs
+        self.samples = deque()
+
+    def add(self, now, rx, tx):
+        if self.samples and (rx < self.samples[-1][1] or tx < self.samples[-1][2]):
+            # counters were reset (interface re-created), restart the window
+            self.samples.clear()
+        self.samples.append((now, rx, tx))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.window_secs:
+            self.samples.popleft()
+
+    def full(self):
+        return len(self.samples) > 1 and self.samples[-1][0] - self.samples[0][0] >= self.window_secs * 0.99
+
+    def rates(self):
+        """ (rx_pps, tx_pps) averaged over the window, None until there are two samples """
+        if len(self.samples) < 2:
+            return None
+        (start, rx_start, tx_start), (end, rx_end, tx_end) = self.samples[0], self.samples[-1]
+        secs = end - start
+        return (rx_end - rx_start) / secs, (tx_end - tx_start) / secs
+
+def wait_for_quiesce(interfaces, max_pps=10, window_secs=5, min_quiet_secs=5, max_wait_secs=1200, interval=1):
+    """
+    Sample the packet counters of interfaces until the moving average rates stayed below max_pps for min_quiet_secs
+    or max_wait_secs passed.  Return the decision data: quiet (bool), waited_secs, quiet_secs, rx_pps, tx_pps,
+    peak_rx_pps, peak_tx_pps and samples.
+    """
+    window = RateWindow(window_secs)
+    start = monotonic()
+    quiet_since = None
+    decision = {'interfaces': interfaces, 'max_pps': max_pps, 'quiet': False, 'quiet_secs': 0.0, 'rx_pps': None, 'tx_pps': None,
+                'peak_rx_pps': 0.0, 'peak_tx_pps': 0.0, 'samples': 0}
+    next_report = start
+    while True:
+        now = monotonic()
+        window.add(now, *read_counters(interfaces))
+        decision['samples'] += 1
+        rates = window.rates()
+        if rates is not None:
+            rx_pps, tx_pps = rates
+            decision.update({'rx_pps': round(rx_pps, 1), 'tx_pps': round(tx_pps, 1),
+                             'peak_rx_pps': round(max(decision['peak_rx_pps'], rx_pps), 1),
+                             'peak_tx_pps': round(max(decision['peak_tx_pps'], tx_pps), 1)})
+            # quiet only counts once the window is full, so a single idle second inside a burst isn't enough
+            # (an idle host continues after window_secs + min_quiet_secs)
+            if window.full() and rx_pps < max_pps and tx_pps < max_pps:
+                if quiet_since is None:
+                    quiet_since = now
+            else:
+                quiet_since = None
+            decision['quiet_secs'] = round(now - quiet_since, 1) if quiet_since is not None else 0.0
+            logging.debug('wait_for_quiesce: rx_pps={0[rx_pps]} tx_pps={0[tx_pps]} quiet_secs={0[quiet_secs]}'.format(decision))
+            if now >= next_report:
+                logging.info('wait_for_quiesce: {0:g}s average rx={1[rx_pps]} tx={1[tx_pps]} pps (max {1[max_pps]:g}), quiet for {1[quiet_secs]}s'.format(
+                    window_secs, decision))
+                next_report = now + 30
+            if quiet_since is not None and now - quiet_since >= min_quiet_secs:
+                decision['quiet'] = True
+                break
+        if now - start >= max_wait_secs:
+            break
+        # sample on a fixed cadence regardless of how long reading the counters took
+        sleep(max(0, interval - (monotonic() - now)))
+    decision['waited_secs'] = round(monotonic() - start, 1)
+    return decision
+
+
+if __name__ == '__main__':
+
+    # default configuration options
+    arg_dict['usage'] = False
+    arg_dict['verbose'] = False
+    arg_dict['force'] = False
+
+    # call function to parse CLI arguments to override defaults
+    arg_dict = parse_args(arg_dict)
+
+    if arg_dict['usage']:
+        usage(2)
+
+    # Setup logging options based on verbose setting
+    if arg_dict['verbose']:
+        setup_logging(log_file=None, log_file_level='debug', log_print_level='debug')
+    else:
+        setup_logging(log_file=None, log_file_level='info', log_print_level='info')
+
+    if not os.path.exists(REBOOT_REQUIRED_FILE) and not arg_dict['force']:
+        print('auto-patch: skipping network activity check because no reboot is required')
+        sys.exit(0)
+
+    # configuration file settings apply unless overridden by CLI
+    config = get_config(arg_dict.get('config_file'))
+    quiesce = config['quiesce']
+    arg_dict.setdefault('interfaces', quiesce['interfaces'])
+    arg_dict.setdefault('max_pps', float(quiesce['max_pps']))
+    arg_dict.setdefault('min_quiet_secs', float(quiesce['min_quiet_secs']))
+    arg_dict.setdefault('max_wait_secs', float(quiesce['max_wait_secs']))
+
+    interfaces = [interface.strip() for interface in arg_dict['interfaces'].split(',') if interface.strip()]
+    if not interfaces:
+        interfaces = get_default_route_interfaces()
+    if not interfaces:
+        print('auto-patch: no default route interface found, skipping network activity check')
+        sys.exit(0)
+
+    decision = wait_for_quiesce(interfaces, max_pps=arg_dict['max_pps'], window_secs=float(quiesce['window_secs']),
+                                min_quiet_secs=arg_dict['min_quiet_secs'], max_wait_secs=arg_dict['max_wait_secs'],
+                                interval=float(quiesce['interval']))
+    logging.info('wait_for_quiesce: {0}'.format(json.dumps(decision, sort_keys=True)))
+    if decision['quiet']:
+        print('auto-patch: rx/tx packet rate on {0} below {1:g} pps for {2}s after {3}s (rx={4} tx={5} pps), continuing'.format(
+            ','.join(interfaces), arg_dict['max_pps'], decision['quiet_secs'], decision['waited_secs'], decision['rx_pps'], decision['tx_pps']))
+    else:
+        print('auto-patch: rx/tx packet rate on {0} still above {1:g} pps after {2}s (rx={3} tx={4} pps), continuing anyway'.format(
+            ','.join(interfaces), arg_dict['max_pps'], decision['waited_secs'], decision['rx_pps'], decision['tx_pps']))
+    sys.exit(0)
@@ -0,0 +1,125 @@
+# Jinja filter that spreads the auto-patch cron schedule evenly across a
+# group of hosts (used by tasks/patch-enable-Linux.yml)
+#
+#   {{ inventory_hostname | auto_patch_schedule(groups['all'],
+#        hr_min=3, hr_max=5) }}  ->  {'hr': 4, 'min': 17}
+#
+# The window is split into slots of slot_minutes.  hr_max and min_max are
+# exclusive (hours hr_min..hr_max-1), the same window as the random time
+# picked when no group is set.  Hosts are placed with consistent hashing
+# with bounded loads: every host hashes to a home slot and, in hash order,
+# takes the first slot from there (wrapping around) that still has room.
+# A slot holds up to max_per_slot weight units (by default the average load
+# plus overload, rounded up), so no slot gets more than its share while
+# placements stay deterministic and mostly stable when hosts are added or
+# removed (only hosts probing past a changed slot move).
+#
+# A host's weight (hostvars[host][weight_var], default 1) is the number of
+# units it uses in its slot, so big hosts share their slot with fewer hosts.
+
+import hashlib
+import math
+
+from ansible.errors import AnsibleFilterError
+
+DEFAULT_WEIGHT_VAR = 'auto_patch_schedule_weight'
+
+# Schedules keyed by group and filter arguments (the filter is called once
+# per host with the same group, so the group is only scheduled once)
+_cache = {}
+
+
+def host_hash(host, seed=''):
+    """ Return a stable integer hash of seed + host name. """
+    return int(hashlib.sha1((seed + host).encode('utf-8')).hexdigest(), 16)
+
+
+def get_slots(hr_min, hr_max, min_min, min_max, slot_minutes):
+    """ Return list of (hr, min) slot start times in the window.  The
+    upper bounds are exclusive like random(start=...) in the fallback. """
+    return [(hr, mn) for hr in range(hr_min, hr_max)
+            for mn in range(min_min, min_max, slot_minutes)]
+
+
+def get_weights(hosts, hostvars, weight_var):
+    """ Return weight of each host from hostvars (default 1). """
+    weights = dict()
+    for host in hosts:
+        weight = 1
+        if hostvars is not None and host in hostvars:
+            weight = hostvars[host].get(weight_var, 1)
+        try:
+            weights[host] = max(int(weight), 1)
+        except (TypeError, ValueError):
+            raise AnsibleFilterError(
+                '{0}: invalid {1} {2!r}'.format(host, weight_var, weight))
+    return weights
+
+
+def assign_slots(weights, num_slots, max_per_slot=0, overload=0.1, seed=''):
+    """ Return dict of host -> slot index using consistent hashing with
+    bounded loads. """
+    if num_slots < 1:
+        raise AnsibleFilterError('auto_patch_schedule: empty window')
+    total = sum(weights.values())
+    if max_per_slot:
+        capacity = int(max_per_slot)
+    else:
+        capacity = int(math.ceil(total * (1 + overload) / num_slots))
+    capacity = max(capacity, 1)
+    if total > capacity * num_slots:
+        raise AnsibleFilterError(
+            'auto_patch_schedule: {0} hosts (total weight {1}) do not fit in '
+            '{2} slots of {3}'.format(len(weights), total, num_slots,
+                                      capacity))
+
+    # Place hosts in hash order so the result doesn't depend on inventory
+    # order.  A host heavier than a slot takes an empty slot to itself.
+    load = [0] * num_slots
+    assignment = dict()
+    hashes = dict((host, host_hash(host, seed)) for host in weights)
+    for host in sorted(weights, key=lambda h: (hashes[h], h)):
+        weight = weights[host]
+        home = hashes[host] % num_slots
+        for i in range(num_slots):
+            slot = (home + i) % num_slots
+            if load[slot] + weight <= capacity or \
+                    (load[slot] == 0 and weight > capacity):
+                break
+        else:
+            raise AnsibleFilterError(
+                'auto_patch_schedule: no slot left for {0}'.format(host))
+        load[slot] += weight
+        assignment[host] = slot
+    return assignment
+
+
+def auto_patch_schedule(host, hosts, hr_min=3, hr_max=5, min_min=0,
+                        min_max=59, slot_minutes=1, max_per_slot=0,
+                        overload=0.1, hostvars=None,
+                        weight_var=DEFAULT_WEIGHT_VAR, seed=''):
+    """ Return {'hr': hour, 'min': minute} cron schedule for host. """
+    hosts = tuple(hosts)
+    if host not in hosts:
+        hosts += (host,)
+    key = (hosts, hr_min, hr_max, min_min, min_max, slot_minutes,
+           max_per_slot, overload, weight_var, seed)
+    if key not in _cache:
+        slots = get_slots(int(hr_min), int(hr_max), int(min_min),
+                          int(min_max), max(int(slot_minutes), 1))
+        weights = get_weights(hosts, hostvars, weight_var)
+        assignment = assign_slots(weights, len(slots), int(max_per_slot),
+                                  float(overload), seed)
+        _cache[key] = dict((h, slots[slot])
+                           for h, slot in assignment.items())
+    hr, mn = _cache[key][host]
+    return {'hr': hr, 'min': mn}
+
+
+class FilterModule(object):
+    """ auto-patch scheduling filters """
+
+    def filters(self):
+        return {
+            'auto_patch_schedule': auto_patch_schedule,
+        }
@@ -0,0 +1,42 @@
+# Unit tests import the scripts in files/ the way they are deployed:
+# common.py as a module and the dashed CLI scripts by file name.
+
+import os
+import sys
+import importlib.util
+
+import pytest
+
+FILES_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'files')
+sys.path.insert(0, FILES_DIR)
+
+
+def load_script(file_name):
+    """ Import files/<file_name> (e.g. reboot-gate.py) as a module """
+    name = os.path.splitext(file_name)[0].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(FILES_DIR, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='session')
+def reboot_gate():
+    return load_script('reboot-gate.py')
+
+
+@pytest.fixture(scope='session')
+def verify():
+    return load_script('verify.py')
+
+
+@pytest.fixture(scope='session')
+def restart_services():
+    return load_script('restart-services.py')
+
+
+@pytest.fixture(scope='session')
+def history():
+    return load_script('history.py')
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('ansible')
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'filter_plugins'))
+
+from auto_patch_schedule import auto_patch_schedule, get_slots  # noqa: E402
+
+
+def test_slots_exclude_upper_bounds():
+    slots = get_slots(3, 5, 1, 59, 1)
+    assert set(hr for hr, _mn in slots) == {3, 4}
+    assert min(mn for _hr, mn in slots) == 1
+    assert max(mn for _hr, mn in slots) == 58
+
+
+def test_schedule_stays_in_window():
+    hosts = ['host{0}'.format(n) for n in range(500)]
+    for host in hosts:
+        schedule = auto_patch_schedule(host, hosts, hr_min=3, hr_max=5,
+                                       min_min=1, min_max=59)
+        assert 3 <= schedule['hr'] < 5
+        assert 1 <= schedule['min'] < 59
+
+
+def test_prefetch_window():
+    hosts = ['host{0}'.format(n) for n in range(200)]
+    hours = set(auto_patch_schedule(host, hosts, hr_min=0, hr_max=2,
+                                    min_min=0, min_max=59,
+                                    seed='prefetch')['hr']
+                for host in hosts)
+    assert hours == {0, 1}
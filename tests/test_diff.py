@@ -0,0 +1,83 @@
+import common
+
+KEY = 'cat /proc/swaps'
+HEADER = 'Filename\tType\tSize\tUsed\tPriority\n'
+
+
+def swaps(*rows):
+    """ A /proc/swaps section as collected now (parsed, with digests) """
+    stdout = HEADER + ''.join(' '.join(row) + '\n' for row in rows)
+    section = {'rc': 0, 'stdout': stdout, 'stderr': ''}
+    section['parsed'] = common.parse_section(KEY, section)
+    return common.set_section_digests(section)
+
+
+def without_digests(section):
+    """ The same section as saved by a version without digests """
+    return dict((field, value) for field, value in section.items()
+                if field not in ('parsed', 'digest', 'record_digests'))
+
+
+def record_digests(records):
+    return dict((key, common.get_digest(value))
+                for key, value in records.items())
+
+
+PAST = {'/dev/sda2': '1024', '/swapfile': '2048', '/dev/sdb1': '512'}
+CURRENT = {'/dev/sda2': '1024', '/swapfile': '4096', '/dev/sdc1': '256'}
+EXPECTED = ({'/dev/sdc1'}, {'/dev/sdb1'}, {'/swapfile'})
+
+
+def test_diff_dicts():
+    assert common.diff_dicts(CURRENT, PAST) == EXPECTED
+    assert common.diff_dicts(CURRENT, PAST, record_digests(CURRENT),
+                             record_digests(PAST)) == EXPECTED
+    assert common.diff_dicts(PAST, dict(PAST)) == (set(), set(), set())
+
+
+def test_diff_dicts_same_digest_is_unchanged():
+    # values are only compared by digest when both sides have one
+    digests = record_digests(PAST)
+    assert common.diff_dicts(CURRENT, PAST, digests, digests) == (
+        {'/dev/sdc1'}, {'/dev/sdb1'}, set())
+
+
+def test_dict_differ():
+    for digests in ((None, None), (record_digests(CURRENT),
+                                   record_digests(PAST))):
+        diff = common.DictDiffer(CURRENT, PAST, *digests)
+        assert (diff.added(), diff.removed(), diff.changed()) == EXPECTED
+        assert diff.unchanged() == {'/dev/sda2'}
+
+
+def test_diff_sections_identical():
+    prev = swaps(('/dev/sda2', 'partition', '1024', '0', '-2'))
+    curr = swaps(('/dev/sda2', 'partition', '1024', '0', '-2'))
+    assert common.sections_identical(prev, curr)
+    assert common.diff_sections({KEY: curr}, {KEY: prev}, KEY) == (
+        set(), set(), set())
+    assert common.diff_sections({KEY: without_digests(curr)},
+                                {KEY: without_digests(prev)}, KEY) == (
+        set(), set(), set())
+
+
+def test_diff_sections_with_and_without_digests():
+    prev = swaps(('/dev/sda2', 'partition', '1024', '0', '-2'),
+                 ('/swapfile', 'file', '2048', '0', '-3'),
+                 ('/dev/sdb1', 'partition', '512', '0', '-4'))
+    curr = swaps(('/dev/sda2', 'partition', '1024', '10', '-2'),
+                 ('/swapfile', 'file', '4096', '0', '-3'),
+                 ('/dev/sdc1', 'partition', '256', '0', '-4'))
+    assert not common.sections_identical(prev, curr)
+    expected = common.diff_sections({KEY: curr}, {KEY: prev}, KEY)
+    assert expected == EXPECTED
+    # snapshots saved before digests (either side) diff the same way
+    assert common.diff_sections({KEY: without_digests(curr)},
+                                {KEY: without_digests(prev)}, KEY) == expected
+    assert common.diff_sections({KEY: curr},
+                                {KEY: without_digests(prev)}, KEY) == expected
+    # select limits the compared records
+    assert common.diff_sections(
+        {KEY: curr}, {KEY: prev}, KEY,
+        select=lambda name, size: name.startswith('/dev/')) == (
+        {'/dev/sdc1'}, {'/dev/sdb1'}, set())
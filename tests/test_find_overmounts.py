@@ -0,0 +1,76 @@
+import common
+
+ROOT = '1 0 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw\n'
+
+
+def mountinfo(tmp_path, *lines):
+    """ Mounts read from a synthetic mountinfo file (root mount first) """
+    path = tmp_path / 'mountinfo'
+    path.write_text(ROOT + ''.join(line + '\n' for line in lines))
+    return common.read_mountinfo(str(path))
+
+
+def plain(*mountpoints):
+    """ Mounts as parsed from plain mount output (no mount ids) """
+    return [{'mp': mp, 'type': 'xfs'} for mp in mountpoints]
+
+
+def test_no_overmount(tmp_path):
+    mounts = mountinfo(
+        tmp_path,
+        '20 1 8:2 / /data rw - xfs /dev/sda2 rw',
+        '21 20 8:3 / /data/a rw - xfs /dev/sda3 rw',
+        '22 1 0:5 / /proc rw - proc proc rw')
+    assert common.find_overmounts(mounts) == []
+
+
+def test_no_overmount_out_of_order(tmp_path):
+    # mountinfo is not always in mount order, the parent ids decide
+    mounts = mountinfo(
+        tmp_path,
+        '21 20 8:3 / /data/a rw - xfs /dev/sda3 rw',
+        '20 1 8:2 / /data rw - xfs /dev/sda2 rw')
+    assert common.find_overmounts(mounts) == []
+
+
+def test_shadowed_by_parent_directory(tmp_path):
+    # /data/a was mounted on the root filesystem before /data covered it
+    mounts = mountinfo(
+        tmp_path,
+        '20 1 8:3 / /data/a rw - xfs /dev/sda3 rw',
+        '21 1 8:2 / /data rw - xfs /dev/sda2 rw')
+    assert common.find_overmounts(mounts) == [(1, 2)]
+
+
+def test_shadowed_by_stacked_mount(tmp_path):
+    mounts = mountinfo(
+        tmp_path,
+        '20 1 8:2 / /data rw - xfs /dev/sda2 rw',
+        '21 20 0:40 / /data rw - nfs srv:/data rw')
+    assert common.find_overmounts(mounts) == [(1, 2)]
+
+
+def test_bind_mount(tmp_path):
+    mounts = mountinfo(
+        tmp_path,
+        '20 1 8:2 / /data rw - xfs /dev/sda2 rw',
+        '21 1 8:2 /www /srv/www rw - xfs /dev/sda2 rw')
+    assert common.find_overmounts(mounts) == []
+
+
+def test_bind_mount_over_mountpoint(tmp_path):
+    # a bind mount stacked on /data hides it and the /data/a mount below it
+    mounts = mountinfo(
+        tmp_path,
+        '20 1 8:2 / /data rw - xfs /dev/sda2 rw',
+        '21 20 8:3 / /data/a rw - xfs /dev/sda3 rw',
+        '22 20 8:4 /backup /data rw - xfs /dev/sda4 rw')
+    assert common.find_overmounts(mounts) == [(1, 3), (2, 3)]
+
+
+def test_plain_mounts():
+    assert common.find_overmounts(plain('/', '/data', '/data/a')) == []
+    assert common.find_overmounts(plain('/', '/data/a', '/data')) == [(1, 2)]
+    assert common.find_overmounts(plain('/', '/data', '/data')) == [(1, 2)]
+    # everything is mounted after / and /datastore is not under /data
+    assert common.find_overmounts(plain('/', '/datastore', '/data')) == []
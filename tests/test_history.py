@@ -0,0 +1,43 @@
+import os
+import json
+
+import common
+
+
+def save_run(data_dir, run, cmds_dict):
+    os.makedirs(os.path.join(data_dir, run))
+    with open(os.path.join(data_dir, run, 'cmds.json'), 'w') as fh:
+        json.dump(cmds_dict, fh)
+
+
+def mount_section(stdout, mount_id):
+    section = {'rc': 0, 'stdout': stdout, 'stderr': '',
+               'mountinfo': [[mount_id, 1, '/data', 'xfs']]}
+    return common.set_section_digests(section)
+
+
+def get_changes(conn, key):
+    rows = conn.execute('SELECT run, hash FROM sections WHERE key = ? '
+                        'ORDER BY run', (key,)).fetchall()
+    return [run for (run, digest), (_prev_run, prev_digest)
+            in zip(rows[1:], rows) if digest != prev_digest]
+
+
+def test_reindex_changes_by_digest(history, tmp_path):
+    data_dir = str(tmp_path)
+    line = '/dev/sda2 on /data type xfs (rw)\n'
+    # mount ids change on every boot, only the output counts as a change
+    save_run(data_dir, '2024-01-01_000000', {'mount': mount_section(line, 20)})
+    save_run(data_dir, '2024-01-02_000000', {'mount': mount_section(line, 31)})
+    save_run(data_dir, '2024-01-03_000000', {'mount': mount_section(
+        line.replace('(rw)', '(ro)'), 42)})
+    # a truncated snapshot is skipped
+    os.makedirs(os.path.join(data_dir, '2024-01-04_000000'))
+    with open(os.path.join(data_dir, '2024-01-04_000000', 'cmds.json'),
+              'w') as fh:
+        fh.write('{"mount": {')
+
+    conn = history.open_db(os.path.join(data_dir, 'history.db'))
+    assert history.reindex(conn, data_dir) == 3
+    assert get_changes(conn, 'mount') == ['2024-01-03_000000']
+    conn.close()
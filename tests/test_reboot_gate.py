@@ -0,0 +1,77 @@
+import os
+import json
+from time import time
+
+
+def age(path, secs):
+    """ Set the mtime of path secs seconds in the past """
+    then = time() - secs
+    os.utime(path, (then, then))
+
+
+def test_acquire_until_slots_taken(reboot_gate, tmp_path):
+    backend = reboot_gate.DirBackend(str(tmp_path), 'web')
+    assert backend.acquire('h1', 2, 600)
+    assert backend.acquire('h2', 2, 600)
+    assert not backend.acquire('h3', 2, 600)
+    assert sorted(backend.status(2, 600)) == ['h1', 'h2']
+
+
+def test_acquire_refreshes_own_slot(reboot_gate, tmp_path):
+    backend = reboot_gate.DirBackend(str(tmp_path), 'web')
+    assert backend.acquire('h1', 1, 600)
+    assert backend.acquire('h1', 1, 600)
+    assert list(backend.status(1, 600)) == ['h1']
+
+
+def test_release_frees_slot(reboot_gate, tmp_path):
+    backend = reboot_gate.DirBackend(str(tmp_path), 'web')
+    assert backend.acquire('h1', 1, 600)
+    assert backend.release('h1', 1, 600)
+    assert not os.path.exists(backend.get_slot_file(0))
+    assert backend.acquire('h2', 1, 600)
+
+
+def test_expired_lease_is_broken(reboot_gate, tmp_path):
+    backend = reboot_gate.DirBackend(str(tmp_path), 'web')
+    assert backend.acquire('h1', 1, 600)
+    path = backend.get_slot_file(0)
+    with open(path, 'w') as fh:
+        json.dump({'holder': 'h1', 'expires': int(time()) - 1}, fh)
+    assert backend.acquire('h2', 1, 600)
+    assert list(backend.status(1, 600)) == ['h2']
+
+
+def test_stale_empty_lease_is_broken(reboot_gate, tmp_path):
+    # the holder crashed between the O_EXCL create and writing the lease
+    backend = reboot_gate.DirBackend(str(tmp_path), 'web')
+    os.makedirs(backend.group_dir)
+    path = backend.get_slot_file(0)
+    open(path, 'w').close()
+    age(path, 7200)
+    assert backend.acquire('h1', 1, 3600)
+    with open(path) as fh:
+        assert json.load(fh)['holder'] == 'h1'
+    assert os.listdir(backend.group_dir) == ['slot-0.lease']
+
+
+def test_fresh_empty_lease_holds_slot(reboot_gate, tmp_path):
+    # a lease still being written is not broken before its mtime expiry
+    backend = reboot_gate.DirBackend(str(tmp_path), 'web')
+    os.makedirs(backend.group_dir)
+    open(backend.get_slot_file(0), 'w').close()
+    assert not backend.acquire('h1', 1, 3600)
+
+
+def test_replaced_lease_is_not_removed(reboot_gate, tmp_path):
+    # another host broke the expired lease and took the slot first
+    backend = reboot_gate.DirBackend(str(tmp_path), 'web')
+    os.makedirs(backend.group_dir)
+    path = backend.get_slot_file(0)
+    open(path, 'w').close()
+    age(path, 7200)
+    identity, _lease = backend.read_lease(path, 3600)
+    os.unlink(path)
+    backend.write_lease(path, 'h2', 3600)
+    assert not backend.remove_lease(path, identity, 'h1')
+    assert list(backend.status(1, 3600)) == ['h2']
@@ -0,0 +1,60 @@
+import pytest
+
+RESTART_PKGS = ['libssl*', 'openssl']
+
+
+@pytest.fixture
+def reboot_required(restart_services, tmp_path, monkeypatch):
+    """ Write reboot-required (and .pkgs if pkgs are given) in tmp_path """
+    path = str(tmp_path / 'reboot-required')
+    monkeypatch.setattr(restart_services, 'REBOOT_REQUIRED_FILE', path)
+    monkeypatch.setattr(restart_services, 'REBOOT_REQUIRED_PKGS_FILE',
+                        path + '.pkgs')
+
+    def write(text, pkgs=None):
+        with open(path, 'w') as fh:
+            fh.write(text)
+        if pkgs is not None:
+            with open(path + '.pkgs', 'w') as fh:
+                fh.write(''.join(pkg + '\n' for pkg in pkgs))
+    return write
+
+
+def test_no_reboot_required(restart_services, reboot_required):
+    assert restart_services.get_reboot_reasons({}, RESTART_PKGS) == []
+
+
+def test_restart_pkgs_only(restart_services, reboot_required):
+    reboot_required('*** System restart required ***\n',
+                    ['libssl3', 'openssl'])
+    assert restart_services.get_reboot_reasons({}, RESTART_PKGS) == []
+
+
+def test_microcode_keeps_reboot(restart_services, reboot_required):
+    reboot_required('*** System restart required ***\n', ['intel-microcode'])
+    assert restart_services.get_reboot_reasons({}, RESTART_PKGS) == [
+        'intel-microcode updated']
+
+
+def test_unlisted_package_keeps_reboot(restart_services, reboot_required):
+    reboot_required('*** System restart required ***\n',
+                    ['libssl3', 'linux-firmware', 'dbus'])
+    assert restart_services.get_reboot_reasons({}, RESTART_PKGS) == [
+        'dbus updated', 'linux-firmware updated']
+
+
+def test_no_package_list_keeps_reboot(restart_services, reboot_required):
+    reboot_required('*** System restart required ***\n')
+    assert len(restart_services.get_reboot_reasons({}, RESTART_PKGS)) == 1
+
+
+def test_kernel_tag_keeps_reboot(restart_services, reboot_required):
+    reboot_required('Mon Jan  1: [KERNEL] new kernel installed\n')
+    assert restart_services.get_reboot_reasons({}, RESTART_PKGS) == [
+        'kernel updated']
+
+
+def test_glibc_replaced_keeps_reboot(restart_services, reboot_required):
+    affected = {1234: ['/usr/lib/x86_64-linux-gnu/libc.so.6']}
+    reasons = restart_services.get_reboot_reasons(affected, RESTART_PKGS)
+    assert reasons == ['glibc replaced: /usr/lib/x86_64-linux-gnu/libc.so.6']
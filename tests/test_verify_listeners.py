@@ -0,0 +1,34 @@
+NETSTAT = '''\
+Active Internet connections (servers and established)
+Proto Recv-Q Send-Q Local Address           Foreign Address         State
+tcp        0      0 0.0.0.0:22              0.0.0.0:*               LISTEN
+'''
+
+
+def sockets(*listeners):
+    stdout = ''.join('{0}\t{1}\n'.format(*listener) for listener in listeners)
+    return {'rc': 0, 'stdout': stdout, 'stderr': '',
+            'ephemeral_ports': [32768, 60999]}
+
+
+def test_listeners_missing(verify):
+    prev = {'sockets': sockets(('tcp', '0.0.0.0:22'), ('tcp', '[::]:443'),
+                               ('udp', '0.0.0.0:40000'))}
+    curr = {'sockets': sockets(('tcp', '0.0.0.0:22'), ('tcp', '[::]:8080'))}
+    result = verify.validate_listeners(prev, curr)['sockets']
+    assert result['status'] == 'failed'
+    assert result['msgs'] == ['missing: tcp [::]:443', 'new: tcp [::]:8080']
+
+
+def test_listeners_legacy_netstat_snapshot(verify):
+    prev = {'netstat -an': {'rc': 0, 'stdout': NETSTAT, 'stderr': ''}}
+    curr = {'sockets': sockets(('tcp', '0.0.0.0:22'))}
+    result = verify.validate_listeners(prev, curr)['sockets']
+    assert result['status'] == 'success'
+    assert 'not compared' in result['msgs'][0]
+
+
+def test_listeners_not_in_snapshot(verify):
+    curr = {'sockets': sockets(('tcp', '0.0.0.0:22'))}
+    result = verify.validate_listeners({}, curr)['sockets']
+    assert result['status'] == 'failed'
@@ -0,0 +1,58 @@
+import common
+
+# mount(8) output saved by the legacy collector
+LEGACY = '''\
+/dev/sda1 on / type ext4 (rw,relatime,seclabel,errors=remount-ro)
+/dev/sda2 on /data type xfs (rw,noatime,seclabel,attr2,inode64,noquota)
+proc on /proc type proc (rw,nosuid,nodev,noexec,relatime)
+'''
+
+# the same mounts read from mountinfo (superblock options merged after)
+MOUNTINFO = '''\
+1 0 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw,errors=remount-ro,seclabel
+20 1 8:2 / /data rw,noatime shared:2 - xfs /dev/sda2 rw,seclabel,attr2,inode64
+22 1 0:5 / /proc rw,nosuid,nodev,noexec,relatime - proc proc rw
+'''
+
+
+def legacy_section():
+    return {'rc': 0, 'stdout': LEGACY, 'stderr': ''}
+
+
+def native_section(tmp_path, text=MOUNTINFO):
+    """ The mount section as collected by get_mount_native() """
+    path = tmp_path / 'mountinfo'
+    path.write_text(text)
+    mounts = common.read_mountinfo(str(path))
+    stdout = ''.join('{0} on {1} type {2} ({3})\n'.format(
+        m['dev'], m['mp'], m['type'], m['options']) for m in mounts)
+    section = {'rc': 0, 'stdout': stdout, 'stderr': '',
+               'mountinfo': [[m['id'], m['parent'], m['mp'], m['type']]
+                             for m in mounts]}
+    section['parsed'] = common.parse_section('mount', section)
+    return common.set_section_digests(section)
+
+
+def test_legacy_snapshot_options_not_compared(verify, tmp_path):
+    prev = {'mount': legacy_section()}
+    curr = {'mount': native_section(tmp_path)}
+    result = verify.validate_fs_mounts(prev, curr)['mount']
+    assert result['status'] == 'success', result['msgs']
+
+
+def test_legacy_snapshot_device_change(verify, tmp_path):
+    prev = {'mount': legacy_section()}
+    curr = {'mount': native_section(
+        tmp_path, MOUNTINFO.replace('xfs /dev/sda2', 'xfs /dev/sdb2'))}
+    result = verify.validate_fs_mounts(prev, curr)['mount']
+    assert result['status'] == 'failed'
+    assert 'changed: /data' in result['msgs']
+
+
+def test_native_snapshot_option_change(verify, tmp_path):
+    prev = {'mount': native_section(tmp_path)}
+    curr = {'mount': native_section(
+        tmp_path, MOUNTINFO.replace('/data rw,noatime', '/data ro,noatime'))}
+    result = verify.validate_fs_mounts(prev, curr)['mount']
+    assert result['status'] == 'failed'
+    assert 'changed: /data' in result['msgs']
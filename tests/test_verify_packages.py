@@ -0,0 +1,93 @@
+import common
+
+DPKG_LIST = '''\
+Desired=Unknown/Install/Remove/Purge/Hold
+| Status=Not/Inst/Conf-files/Unpacked/halF-conf/Half-inst/trig-aWait/Trig-pend
+|/ Err?=(none)/Reinst-required (Status,Err: uppercase=bad)
+||/ Name           Version      Architecture Description
++++-==============-============-============-=========================
+ii  bash           5.1-6        amd64        GNU Bourne Again SHell
+ii  libc6:amd64    2.35-0       amd64        GNU C Library
+ii  libc6:i386     2.35-0       i386         GNU C Library
+rc  oldpkg         1.0          amd64        removed, config files left
+ii  zlib1g:amd64   1:1.2.11     amd64        compression library
+'''
+
+
+def section(stdout):
+    return {'rc': 0, 'stdout': stdout, 'stderr': ''}
+
+
+def packages(*rows):
+    return section(''.join('\t'.join(row) + '\n' for row in rows))
+
+
+def test_parse_dpkg_list():
+    assert common.parse_dpkg_list(DPKG_LIST) == {
+        'bash': ['5.1-6', 'amd64'],
+        'libc6:amd64': ['2.35-0', 'amd64'],
+        'libc6:i386': ['2.35-0', 'i386'],
+        'zlib1g': ['1:1.2.11', 'amd64'],
+    }
+
+
+def test_parse_rpm_custom():
+    assert common.parse_rpm_custom('bash:5.1.8\nkernel:5.14.0\n') == {
+        'bash': ['5.1.8', ''],
+        'kernel': ['5.14.0', ''],
+    }
+
+
+def test_packages_diff(verify):
+    prev = {'packages': packages(('bash', '5.1-6', 'amd64'),
+                                 ('oldpkg', '1.0', 'amd64'))}
+    curr = {'packages': packages(('bash', '5.1-7', 'amd64'),
+                                 ('newpkg', '2.0', 'amd64'))}
+    result = verify.validate_packages(prev, curr)['packages']
+    assert result['status'] == 'success'
+    assert result['upgraded'] == {'bash': ['5.1-6', '5.1-7']}
+    assert result['added'] == {'newpkg': '2.0'}
+    assert result['removed'] == {'oldpkg': '1.0'}
+
+
+def test_packages_legacy_dpkg_snapshot(verify):
+    prev = {'dpkg --list': section(DPKG_LIST)}
+    curr = {'packages': packages(('bash', '5.1-6', 'amd64'),
+                                 ('libc6', '2.35-1', 'amd64'),
+                                 ('libc6', '2.35-1', 'i386'),
+                                 ('zlib1g', '1:1.2.11', 'amd64'))}
+    result = verify.validate_packages(prev, curr)['packages']
+    assert result['status'] == 'success'
+    assert result['upgraded'] == {'libc6:amd64': ['2.35-0', '2.35-1'],
+                                  'libc6:i386': ['2.35-0', '2.35-1']}
+    assert result['added'] == {}
+    assert result['removed'] == {}
+
+
+def test_packages_legacy_rpm_snapshot(verify):
+    prev = {'rpm_custom': section('bash:5.1.8\nglibc:2.34\nglibc:2.34\n'
+                                  'openssl:3.0.7\nkernel:5.14.0\n')}
+    curr = {'packages': packages(('bash', '5.1.8-6.el9', 'x86_64'),
+                                 ('glibc', '2.34-60.el9', 'x86_64'),
+                                 ('glibc', '2.34-60.el9', 'i686'),
+                                 ('openssl', '1:3.0.7-24.el9', 'x86_64'),
+                                 ('kernel', '5.14.0-362.8.1.el9', 'x86_64'),
+                                 ('zlib', '1.2.11-40.el9', 'x86_64'))}
+    result = verify.validate_packages(prev, curr)['packages']
+    assert result['status'] == 'success'
+    assert result['upgraded'] == {}
+    assert result['added'] == {'zlib': '1.2.11'}
+    assert result['removed'] == {}
+
+    curr['packages'] = packages(('bash', '5.2.15-1.el9', 'x86_64'),
+                                ('glibc', '2.34-60.el9', 'x86_64'),
+                                ('openssl', '1:3.0.7-25.el9', 'x86_64'))
+    result = verify.validate_packages(prev, curr)['packages']
+    assert result['upgraded'] == {'bash': ['5.1.8', '5.2.15']}
+    assert result['removed'] == {'kernel': '5.14.0'}
+
+
+def test_packages_missing_from_snapshot(verify):
+    curr = {'packages': packages(('bash', '5.1-6', 'amd64'))}
+    result = verify.validate_packages({}, curr)['packages']
+    assert result['status'] == 'failed'